@@ -1,6 +1,12 @@
 """Vumi AAT USSD transport."""
-from .ussd import AatUssdTransport
+import sys
 
 __version__ = "0.5.6"
 
-__all__ = ['AatUssdTransport']
+__all__ = []
+
+# vumi, and so the Twisted transport, needs Python 2. On Python 3 only the
+# asyncio engine in vxaat.aio and the helper modules it uses are available.
+if sys.version_info[0] < 3:
+    from .ussd import AatUssdTransport
+    __all__ += ['AatUssdTransport']
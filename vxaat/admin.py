@@ -0,0 +1,286 @@
+# -*- test-case-name: vxaat.tests.test_admin -*-
+"""
+An admin resource, mounted next to the transport's ``web_path``, for
+looking into a running transport.
+"""
+import json
+import threading
+
+from twisted.cred.portal import Portal
+from twisted.web import http
+from twisted.web.guard import BasicCredentialFactory, HTTPAuthSessionWrapper
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from vumi.transports.httprpc.httprpc import HttpRpcHealthResource
+from vumi.transports.httprpc.auth import HttpRpcRealm, StaticAuthChecker
+
+from vxaat.benchmarks.stats import percentile
+from vxaat.memory import MemorySnapshot, tracing
+from vxaat.profiling import Profile, StackSampler
+
+
+def authenticated(resource, username, password, domain):
+    """
+    Wrap ``resource`` so that it requires HTTP basic authentication.
+    """
+    portal = Portal(
+        HttpRpcRealm(resource), [StaticAuthChecker(username, password)])
+    return HTTPAuthSessionWrapper(portal, [BasicCredentialFactory(domain)])
+
+
+def get_arg(request, name, default=None):
+    values = request.args.get(name)
+    if not values:
+        return default
+    return values[0]
+
+
+def render_json(request, data, code=http.OK):
+    request.setResponseCode(code)
+    request.setHeader('Content-Type', 'application/json; charset=utf-8')
+    return json.dumps(data, sort_keys=True)
+
+
+def to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+
+def summarise(values):
+    """
+    The median, 95th and 99th percentiles and maximum of a sorted list of
+    seconds, in milliseconds.
+    """
+    if not values:
+        return {}
+    summary = {'max': values[-1] * 1000}
+    for q in (50, 95, 99):
+        summary['p%d' % (q,)] = percentile(values, q) * 1000
+    return summary
+
+
+class BadRequest(Exception):
+    pass
+
+
+class ProfileResource(Resource):
+    """
+    Profiles the reactor thread for ``seconds`` and returns the result.
+
+    ``mode=cprofile`` (the default) returns the ``pstats`` report, sorted
+    by ``sort``, or with ``format=pstats`` the profile in the format
+    ``pstats.Stats`` loads. ``mode=sample`` samples the stack every
+    ``interval`` seconds and returns collapsed stacks.
+
+    Only one session may run at a time.
+    """
+    isLeaf = True
+
+    MODES = ('cprofile', 'sample')
+    FORMATS = ('text', 'pstats')
+    SORTS = ('cumulative', 'tottime', 'calls', 'ncalls')
+
+    def __init__(self, clock, max_seconds=60):
+        Resource.__init__(self)
+        self.clock = clock
+        self.max_seconds = max_seconds
+        self.active = False
+
+    def get_options(self, request):
+        try:
+            seconds = float(get_arg(request, 'seconds', 10))
+            interval = float(get_arg(request, 'interval', 0.005))
+        except ValueError:
+            raise BadRequest('seconds and interval must be numbers')
+        if not 0 < seconds <= self.max_seconds:
+            raise BadRequest(
+                'seconds must be more than 0 and at most %s'
+                % (self.max_seconds,))
+        if not 0 < interval <= 1:
+            raise BadRequest('interval must be more than 0 and at most 1')
+        options = {'seconds': seconds, 'interval': interval}
+        for name, choices in [('mode', self.MODES),
+                              ('format', self.FORMATS),
+                              ('sort', self.SORTS)]:
+            options[name] = get_arg(request, name, choices[0])
+            if options[name] not in choices:
+                raise BadRequest(
+                    '%s must be one of %s' % (name, ', '.join(choices)))
+        return options
+
+    def render_GET(self, request):
+        try:
+            options = self.get_options(request)
+        except BadRequest as e:
+            return render_json(
+                request, {'error': str(e)}, http.BAD_REQUEST)
+        if self.active:
+            return render_json(
+                request, {'error': 'A profile is already running.'},
+                http.CONFLICT)
+
+        if options['mode'] == 'sample':
+            session = StackSampler(
+                threading.current_thread().ident, options['interval'])
+        else:
+            session = Profile()
+        self.active = True
+        session.start()
+
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+        self.clock.callLater(
+            options['seconds'], self.finish, request, session, options, gone)
+        return NOT_DONE_YET
+
+    def finish(self, request, session, options, gone):
+        session.stop()
+        self.active = False
+        if gone:
+            return
+        if options['mode'] == 'sample':
+            request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+            request.write(to_bytes(session.collapsed()))
+        elif options['format'] == 'pstats':
+            request.setHeader('Content-Type', 'application/octet-stream')
+            request.write(session.dump())
+        else:
+            request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+            request.write(to_bytes(session.text(options['sort'])))
+        request.finish()
+
+
+class FunctionsResource(Resource):
+    """
+    Returns the calls to, and time spent in, the transport's hot functions
+    since it started.
+    """
+    isLeaf = True
+
+    def __init__(self, function_times):
+        Resource.__init__(self)
+        self.function_times = function_times
+
+    def render_GET(self, request):
+        return render_json(request, self.function_times.snapshot())
+
+
+class StatsResource(Resource):
+    """
+    Returns the transport's readiness, outstanding requests and counters.
+    """
+    isLeaf = True
+
+    def __init__(self, transport):
+        Resource.__init__(self)
+        self.transport = transport
+
+    def render_GET(self, request):
+        return render_json(request, self.transport.get_stats())
+
+
+class DrainResource(Resource):
+    """
+    ``POST`` starts draining the transport. ``GET`` returns its stats,
+    with a ``200`` status once it is safe to stop and ``503`` before.
+    """
+    isLeaf = True
+
+    def __init__(self, transport):
+        Resource.__init__(self)
+        self.transport = transport
+
+    def render_GET(self, request):
+        stats = self.transport.get_stats()
+        return render_json(
+            request, stats,
+            http.OK if stats['drained'] else http.SERVICE_UNAVAILABLE)
+
+    def render_POST(self, request):
+        self.transport.start_drain()
+        stats = self.transport.get_stats()
+        return render_json(
+            request, stats, http.OK if stats['drained'] else http.ACCEPTED)
+
+
+class MemoryResource(Resource):
+    """
+    Returns the ``limit`` allocation sites holding the most memory, or the
+    object types if ``tracemalloc`` is not tracing. ``POST`` also keeps the
+    snapshot as a baseline, and later requests return the ``limit`` sites
+    that changed most since then as well.
+
+    Taking a snapshot blocks the reactor for as long as it takes, which
+    grows with the number of objects or traced allocations.
+    """
+    isLeaf = True
+
+    def __init__(self, max_limit=100):
+        Resource.__init__(self)
+        self.max_limit = max_limit
+        self.baseline = None
+
+    def get_limit(self, request):
+        try:
+            limit = int(get_arg(request, 'limit', 20))
+        except ValueError:
+            raise BadRequest('limit must be a whole number.')
+        if not 0 < limit <= self.max_limit:
+            raise BadRequest(
+                'limit must be between 1 and %d.' % (self.max_limit,))
+        return limit
+
+    def render_snapshot(self, request):
+        try:
+            limit = self.get_limit(request)
+        except BadRequest as e:
+            return None, render_json(
+                request, {'error': str(e)}, http.BAD_REQUEST)
+        snapshot = MemorySnapshot.take()
+        data = {
+            'tracing': tracing(),
+            'kind': snapshot.kind,
+            'total_bytes': snapshot.total,
+            'top': snapshot.top(limit),
+        }
+        if self.baseline is not None:
+            data['baseline_bytes'] = self.baseline.total
+            data['growth'] = snapshot.compare(self.baseline, limit)
+        return snapshot, render_json(request, data)
+
+    def render_GET(self, request):
+        _, body = self.render_snapshot(request)
+        return body
+
+    def render_POST(self, request):
+        snapshot, body = self.render_snapshot(request)
+        if snapshot is not None:
+            self.baseline = snapshot
+        return body
+
+
+class ReadinessResource(HttpRpcHealthResource):
+    """
+    The transport's health resource, which fails while it drains so that
+    load balancers stop sending it new sessions.
+    """
+
+    def render_GET(self, request):
+        body = HttpRpcHealthResource.render_GET(self, request)
+        if self.transport.draining:
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        return body
+
+
+class AdminResource(Resource):
+
+    def __init__(self, transport):
+        Resource.__init__(self)
+        self.putChild(b'profile', ProfileResource(transport.get_clock()))
+        self.putChild(
+            b'functions', FunctionsResource(transport.function_times))
+        self.putChild(b'stats', StatsResource(transport))
+        self.putChild(b'drain', DrainResource(transport))
+        self.putChild(b'memory', MemoryResource())
@@ -0,0 +1,58 @@
+# -*- test-case-name: vxaat.tests.test_admission -*-
+"""
+Limits on the number of requests in flight, globally and per provider.
+"""
+
+
+class AdmissionControl(object):
+    """
+    Admits requests while fewer than ``max_requests`` are in flight in
+    total and fewer than ``max_per_provider`` are in flight for the
+    request's provider. A limit of ``0`` means no limit.
+
+    Rejections are counted per provider in :attr:`rejected`.
+    """
+
+    def __init__(self, max_requests=0, max_per_provider=0):
+        self.max_requests = max_requests
+        self.max_per_provider = max_per_provider
+        self.rejected = {}
+        self._requests = {}
+        self._per_provider = {}
+
+    def __len__(self):
+        return len(self._requests)
+
+    def in_flight(self, provider):
+        return self._per_provider.get(provider, 0)
+
+    def admit(self, request_id, provider):
+        """
+        Return whether the request may proceed. An admitted request counts
+        towards the limits until it is released.
+        """
+        if self.max_requests and len(self._requests) >= self.max_requests:
+            return self._reject(provider)
+        in_flight = self._per_provider.get(provider, 0)
+        if self.max_per_provider and in_flight >= self.max_per_provider:
+            return self._reject(provider)
+        self._requests[request_id] = provider
+        self._per_provider[provider] = in_flight + 1
+        return True
+
+    def release(self, request_id):
+        """
+        Stop counting a request. Unknown ids are ignored.
+        """
+        provider = self._requests.pop(request_id, None)
+        if provider is None:
+            return
+        in_flight = self._per_provider[provider] - 1
+        if in_flight:
+            self._per_provider[provider] = in_flight
+        else:
+            del self._per_provider[provider]
+
+    def _reject(self, provider):
+        self.rejected[provider] = self.rejected.get(provider, 0) + 1
+        return False
@@ -0,0 +1,8 @@
+"""
+An AAT USSD engine on asyncio, for Python 3, that serves the gateway and
+talks to vumi applications like :class:`~vxaat.ussd.AatUssdTransport`.
+"""
+from vxaat.aio.broker import BrokerAdapter, InMemoryBroker
+from vxaat.aio.engine import AatUssdEngine, ConfigError
+
+__all__ = ['AatUssdEngine', 'BrokerAdapter', 'ConfigError', 'InMemoryBroker']
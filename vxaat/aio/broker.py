@@ -0,0 +1,145 @@
+# -*- test-case-name: vxaat.tests.test_aio -*-
+"""
+The message broker interface the engine publishes and consumes through,
+and an in-memory broker for tests and benchmarks.
+"""
+import logging
+
+from vxaat.aio.messages import from_json, to_json
+
+
+log = logging.getLogger(__name__)
+
+
+class BrokerAdapter(object):
+    """
+    What :class:`~vxaat.aio.engine.AatUssdEngine` needs from a message
+    broker. Messages are dicts in vumi's format (see
+    :mod:`vxaat.aio.messages`), and an adapter for an AMQP client uses the
+    routing keys vumi does: ``<transport_name>.inbound``,
+    ``<transport_name>.event`` and ``<transport_name>.outbound`` on the
+    ``vumi`` exchange.
+    """
+
+    def publish_inbound(self, message):
+        """
+        Publish a message from a user to the application.
+        """
+        raise NotImplementedError()
+
+    def publish_event(self, event):
+        """
+        Publish an ack or nack for a reply.
+        """
+        raise NotImplementedError()
+
+    def consume_outbound(self, transport_name, handler):
+        """
+        Call ``handler`` with each reply published for ``transport_name``
+        until :meth:`stop_consuming` is called.
+        """
+        raise NotImplementedError()
+
+    def stop_consuming(self, transport_name):
+        raise NotImplementedError()
+
+
+class InMemoryBroker(BrokerAdapter):
+    """
+    Delivers messages on the next turn of ``loop``, encoded to JSON and
+    back on the way as they would be by a real broker. Published messages
+    are kept in :attr:`inbound` and :attr:`events` unless ``record`` is
+    false.
+
+    The application's side of the broker is :meth:`consume_inbound`,
+    :meth:`consume_events` and :meth:`publish_outbound`.
+    """
+
+    def __init__(self, loop, record=True):
+        self.loop = loop
+        self.record = record
+        self.inbound = []
+        self.events = []
+        self._inbound_handlers = []
+        self._event_handlers = []
+        self._outbound_handlers = {}
+        self._queued_outbound = {}
+        self._waiters = []
+
+    def publish_inbound(self, message):
+        self._deliver(self.inbound, self._inbound_handlers, message)
+
+    def publish_event(self, event):
+        self._deliver(self.events, self._event_handlers, event)
+
+    def consume_outbound(self, transport_name, handler):
+        self._outbound_handlers[transport_name] = handler
+        for data in self._queued_outbound.pop(transport_name, []):
+            self.loop.call_soon(self._handle, handler, data)
+
+    def stop_consuming(self, transport_name):
+        self._outbound_handlers.pop(transport_name, None)
+
+    def consume_inbound(self, handler):
+        self._inbound_handlers.append(handler)
+
+    def consume_events(self, handler):
+        self._event_handlers.append(handler)
+
+    def publish_outbound(self, message):
+        """
+        Publish a reply to the engine consuming its transport's replies,
+        or queue it until one does.
+        """
+        data = to_json(message)
+        handler = self._outbound_handlers.get(message['transport_name'])
+        if handler is None:
+            self._queued_outbound.setdefault(
+                message['transport_name'], []).append(data)
+        else:
+            self.loop.call_soon(self._handle, handler, data)
+
+    def wait_for_inbound(self, count):
+        """
+        A future that is done once ``count`` inbound messages have been
+        published, with the list of them.
+        """
+        return self._wait(self.inbound, count)
+
+    def wait_for_events(self, count):
+        return self._wait(self.events, count)
+
+    def clear(self):
+        del self.inbound[:]
+        del self.events[:]
+
+    def _deliver(self, dispatched, handlers, message):
+        data = to_json(message)
+        if self.record:
+            dispatched.append(from_json(data))
+            if self._waiters:
+                self._notify()
+        for handler in handlers:
+            self.loop.call_soon(self._handle, handler, data)
+
+    def _handle(self, handler, data):
+        try:
+            handler(from_json(data))
+        except Exception:
+            log.exception('Error handling message: %s', data)
+
+    def _wait(self, dispatched, count):
+        future = self.loop.create_future()
+        self._waiters.append((dispatched, count, future))
+        self._notify()
+        return future
+
+    def _notify(self):
+        waiting = []
+        for dispatched, count, future in self._waiters:
+            if len(dispatched) >= count:
+                if not future.done():
+                    future.set_result(dispatched[:count])
+            else:
+                waiting.append((dispatched, count, future))
+        self._waiters = waiting
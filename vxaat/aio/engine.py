@@ -0,0 +1,436 @@
+# -*- test-case-name: vxaat.tests.test_aio -*-
+"""
+The AAT USSD transport's core on asyncio, for Python 3.
+
+:class:`AatUssdEngine` parses requests, normalises providers, renders
+reply bodies and keeps track of the requests waiting for replies as
+:class:`~vxaat.ussd.AatUssdTransport` does, with the same helper modules,
+and publishes and consumes the same messages through a
+:class:`~vxaat.aio.broker.BrokerAdapter`.
+"""
+import json
+import logging
+from urllib.parse import quote
+
+from vxaat import envelope
+from vxaat.aio import messages
+from vxaat.aio.server import HttpChannel
+from vxaat.cache import LRUCache
+from vxaat.parsing import RequestParser
+from vxaat.providers import ProviderNormaliser, ProviderRuleError
+from vxaat.render import parse_options, render_body
+
+
+log = logging.getLogger(__name__)
+
+
+class ConfigError(ValueError):
+    """
+    Raised for an invalid engine config.
+    """
+
+
+class EngineConfig(object):
+    """
+    The engine's config, from a dict with the same keys, meanings and
+    defaults as the transport's. Only the transport options listed in
+    :attr:`DEFAULTS` are supported, and any others are an error rather
+    than silently ignored.
+    """
+
+    REQUIRED = ('transport_name', 'base_url', 'web_path', 'web_port')
+
+    DEFAULTS = {
+        'health_path': 'health',
+        'validation_mode': 'strict',
+        'request_cleanup_interval': 5,
+        'request_timeout': 4 * 60,
+        'request_timeout_status_code': 504,
+        'request_timeout_body': '',
+        'provider_mappings': {},
+        'provider_rules': [],
+        'provider_cache_size': 1024,
+        'unknown_provider_summary_interval': 300,
+        'reply_cache_size': 0,
+        'reply_cache_max_bytes': 0,
+        'compact_envelope': False,
+        'reuse_port': False,
+    }
+
+    VALIDATION_MODES = ('strict', 'permissive')
+
+    def __init__(self, config):
+        unknown = set(config) - set(self.REQUIRED) - set(self.DEFAULTS)
+        if unknown:
+            raise ConfigError(
+                'Not supported by the asyncio engine: %s'
+                % (', '.join(sorted(unknown)),))
+        missing = [name for name in self.REQUIRED if name not in config]
+        if missing:
+            raise ConfigError('Missing config: %s' % (', '.join(missing),))
+        values = dict(self.DEFAULTS)
+        values.update(config)
+        self.__dict__.update(values)
+        if self.validation_mode not in self.VALIDATION_MODES:
+            raise ConfigError(
+                'Invalid validation mode: %s' % (self.validation_mode,))
+        self.web_port = int(self.web_port)
+
+
+class PendingRequest(object):
+    """
+    A request waiting for a reply.
+    """
+    __slots__ = ('request', 'timestamp', 'to_addr')
+
+    def __init__(self, request, timestamp):
+        self.request = request
+        self.timestamp = timestamp
+        self.to_addr = None
+
+
+class AatUssdEngine(object):
+    """
+    AAT USSD over HTTP on an asyncio event loop.
+
+    :param dict config:
+        See :class:`EngineConfig`.
+    :param broker:
+        A :class:`~vxaat.aio.broker.BrokerAdapter`.
+    :param loop:
+        The event loop to run on.
+    """
+    transport_type = 'ussd'
+    content_type = 'text/plain'
+    ENCODING = 'utf-8'
+    EXPECTED_FIELDS = set(['msisdn', 'provider'])
+    OPTIONAL_FIELDS = set(['request', 'ussdSessionId', 'to_addr'])
+    RPC_METHODS = ('GET', 'POST', 'PUT')
+
+    # errors
+    RESPONSE_FAILURE_ERROR = "Response to http request failed."
+    NOT_REPLY_ERROR = "Outbound message is not a reply"
+    NO_CONTENT_ERROR = "Outbound message has no content."
+    INVALID_OPTIONS_ERROR = "Outbound message has invalid menu options."
+
+    STATS_COUNTERS = (
+        'requests', 'bad_requests', 'acks', 'nacks', 'timeouts', 'abandoned')
+
+    def __init__(self, config, broker, loop):
+        self.config = config = EngineConfig(config)
+        self.broker = broker
+        self.loop = loop
+        self.transport_name = config.transport_name
+        try:
+            self.provider_normaliser = ProviderNormaliser(
+                config.provider_mappings, config.provider_rules,
+                config.provider_cache_size, log.warning)
+        except ProviderRuleError as e:
+            raise ConfigError(str(e))
+        self.request_parser = RequestParser(
+            self.EXPECTED_FIELDS, self.OPTIONAL_FIELDS,
+            config.validation_mode == 'strict', self.ENCODING)
+        self.web_path = config.web_path.rstrip('/')
+        self.health_path = '/' + config.health_path.strip('/')
+        self.callback_base = config.base_url.rstrip('/') + config.web_path
+        self.request_timeout_body = config.request_timeout_body.encode(
+            self.ENCODING)
+        self.compact_envelope = config.compact_envelope
+
+        self.reply_cache = None
+        if config.reply_cache_size > 0:
+            self.reply_cache = LRUCache(
+                config.reply_cache_size,
+                max_bytes=config.reply_cache_max_bytes or None)
+
+        # In arrival order, so that the oldest requests are first
+        self._requests = {}
+        self.request_cleanup = None
+        self.stats = dict.fromkeys(self.STATS_COUNTERS, 0)
+        self.channels = set()
+        self.server = None
+        self.provider_summary = None
+
+    def start(self):
+        """
+        Start consuming replies and listening on ``web_port``. Returns a
+        future that is done, with the ``asyncio.Server``, once the engine
+        is listening.
+        """
+        self.broker.consume_outbound(
+            self.transport_name, self.handle_outbound_message)
+        if self.config.unknown_provider_summary_interval > 0:
+            self.schedule_provider_summary()
+        if self.config.request_cleanup_interval >= 1:
+            self.schedule_request_cleanup()
+        task = self.loop.create_task(self.loop.create_server(
+            lambda: HttpChannel(self.handle_request, self.channels),
+            # IPv4 only, like Twisted's listenTCP. Left to itself asyncio
+            # also listens on IPv6, on a different port when it is 0.
+            host='0.0.0.0', port=self.config.web_port,
+            reuse_port=self.config.reuse_port or None))
+        task.add_done_callback(self.listening)
+        return task
+
+    def listening(self, task):
+        if not task.cancelled() and task.exception() is None:
+            self.server = task.result()
+
+    def stop(self):
+        """
+        Stop listening and consuming, and close every connection. Requests
+        still waiting for replies are abandoned.
+        """
+        self.broker.stop_consuming(self.transport_name)
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        for channel in list(self.channels):
+            channel.close()
+        if self.request_cleanup is not None:
+            self.request_cleanup.cancel()
+            self.request_cleanup = None
+        if self.provider_summary is not None:
+            self.provider_summary.cancel()
+            self.provider_summary = None
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    def schedule_provider_summary(self):
+        self.provider_summary = self.loop.call_later(
+            self.config.unknown_provider_summary_interval,
+            self.log_provider_summary)
+
+    def log_provider_summary(self):
+        self.provider_normaliser.log_summary()
+        self.schedule_provider_summary()
+
+    def schedule_request_cleanup(self):
+        self.request_cleanup = self.loop.call_later(
+            self.config.request_cleanup_interval, self.cleanup_requests)
+
+    def cleanup_requests(self):
+        self.close_old_requests()
+        self.schedule_request_cleanup()
+
+    def close_old_requests(self):
+        """
+        Time out the requests that have waited longer than
+        ``request_timeout``, which are always the oldest ones.
+        """
+        now = self.loop.time()
+        expired = []
+        for request_id, pending in self._requests.items():
+            if now - pending.timestamp <= self.config.request_timeout:
+                break
+            expired.append(request_id)
+        for request_id in expired:
+            self.close_request(request_id)
+
+    def handle_request(self, request):
+        if request.path == self.health_path:
+            if request.method != 'GET':
+                return request.finish(405, b'')
+            return request.finish(
+                200, self.get_health_response().encode(self.ENCODING))
+        if not (request.path.rstrip('/') == self.web_path or
+                request.path.startswith(self.web_path + '/')):
+            return request.finish(404, b'No such resource.')
+        if request.method not in self.RPC_METHODS:
+            return request.finish(405, b'')
+        message_id = messages.generate_id()
+        self.set_request(message_id, request)
+        try:
+            self.handle_raw_inbound_message(message_id, request)
+        except Exception:
+            # The request is answered when it times out, as the Twisted
+            # transport does.
+            log.exception('Error handling request %s.', message_id)
+
+    def get_health_response(self):
+        return json.dumps({
+            'pending_requests': len(self._requests),
+            'ready': True,
+        })
+
+    def get_stats(self):
+        now = self.loop.time()
+        ages = sorted(now - r.timestamp for r in self._requests.values())
+        return {
+            'outstanding': len(ages),
+            'oldest_request_age': ages[-1] if ages else None,
+            'counters': dict(self.stats),
+        }
+
+    def set_request(self, request_id, request):
+        self._requests[request_id] = PendingRequest(
+            request, self.loop.time())
+        request.on_lost = lambda: self.handle_request_lost(request_id)
+
+    def remove_request(self, request_id):
+        del self._requests[request_id]
+
+    def handle_request_lost(self, request_id):
+        # The gateway hung up. Forget the request now rather than holding
+        # on to it until it times out.
+        if request_id not in self._requests:
+            return
+        self.stats['abandoned'] += 1
+        self.remove_request(request_id)
+
+    def close_request(self, request_id):
+        self.stats['timeouts'] += 1
+        log.warning(
+            'Timing out %s', self._requests[request_id].to_addr or 'Unknown')
+        self.finish_request(
+            request_id, self.request_timeout_body,
+            self.config.request_timeout_status_code)
+
+    def finish_request(self, request_id, data, code=200):
+        """
+        Write the response to a request and return whether it was still
+        waiting for one.
+        """
+        pending = self._requests.get(request_id)
+        if pending is None:
+            return False
+        self.remove_request(request_id)
+        pending.request.finish(code, data, self.content_type)
+        return True
+
+    def get_callback_url(self, to_addr):
+        return '%s?to_addr=%s' % (self.callback_base, quote(to_addr))
+
+    def handle_raw_inbound_message(self, message_id, request):
+        self.stats['requests'] += 1
+        values, errors = self.request_parser.parse(request.args)
+
+        if errors:
+            log.info('Unhappy incoming message: %s ', errors)
+            self.stats['bad_requests'] += 1
+            self.finish_request(
+                message_id, json.dumps(errors).encode(self.ENCODING),
+                code=400)
+            return
+
+        from_addr = values.msisdn
+        provider = self.provider_normaliser.normalise(values.provider)
+
+        if values.to_addr is not None:
+            session_event = messages.SESSION_RESUME
+            to_addr = values.to_addr
+            content = values.request
+        else:
+            session_event = messages.SESSION_NEW
+            to_addr = values.request
+            content = None
+
+        log.info(
+            'AatUssdEngine receiving inbound message (%s) from %s to %s.',
+            message_id, from_addr, to_addr)
+        self.publish_ussd_message(
+            message_id=message_id,
+            content=content,
+            to_addr=to_addr,
+            from_addr=from_addr,
+            session_event=session_event,
+            provider=provider,
+            ussd_session_id=values.ussd_session_id,
+        )
+
+    def publish_ussd_message(self, message_id, content, to_addr, from_addr,
+                             session_event, provider, ussd_session_id):
+        pending = self._requests.get(message_id)
+        if pending is not None:
+            pending.to_addr = to_addr
+        self.broker.publish_inbound(messages.user_message(
+            message_id=message_id,
+            content=content,
+            to_addr=to_addr,
+            from_addr=from_addr,
+            session_event=session_event,
+            transport_name=self.transport_name,
+            transport_type=self.transport_type,
+            helper_metadata=envelope.helper_metadata(
+                ussd_session_id, self.compact_envelope),
+            transport_metadata={
+                'aat_ussd': envelope.aat_metadata(
+                    provider, ussd_session_id,
+                    compact=self.compact_envelope),
+            },
+            provider=provider,
+        ))
+
+    def publish_ack(self, user_message_id, sent_message_id):
+        self.stats['acks'] += 1
+        self.broker.publish_event(messages.ack(
+            user_message_id, sent_message_id,
+            transport_name=self.transport_name))
+
+    def publish_nack(self, user_message_id, reason):
+        self.stats['nacks'] += 1
+        self.broker.publish_event(messages.nack(
+            user_message_id, reason, transport_name=self.transport_name))
+
+    def generate_body(self, reply, callback, session_event, options=None):
+        # If this is not a session close event, then send options
+        return render_body(
+            reply, callback, session_event != messages.SESSION_CLOSE,
+            options)
+
+    def get_reply_body(self, content, to_addr, session_event, options=None):
+        if self.reply_cache is None or options:
+            return self.generate_body(
+                content, self.get_callback_url(to_addr), session_event,
+                options)
+
+        key = (content, to_addr, session_event)
+        body = self.reply_cache.get(key)
+        if body is None:
+            body = self.generate_body(
+                content, self.get_callback_url(to_addr), session_event)
+            self.reply_cache.set(key, body)
+        return body
+
+    def handle_outbound_message(self, message):
+        message_id = message['message_id']
+        try:
+            error = self.render_reply(message)
+        except Exception:
+            log.exception('Could not send reply (%s).', message_id)
+            return
+        if error is None:
+            self.publish_ack(message_id, message_id)
+        else:
+            self.publish_nack(message_id, error)
+
+    def render_reply(self, message):
+        """
+        Render a reply and write it to its request, if it can be. Returns
+        ``None`` if it was written and otherwise the reason to nack it.
+        """
+        message_id = message['message_id']
+        try:
+            options = parse_options(
+                message['helper_metadata'].get('aat_ussd', {}).get(
+                    'options'))
+        except ValueError as e:
+            log.warning('Invalid menu options in %s: %s', message_id, e)
+            return self.INVALID_OPTIONS_ERROR
+
+        body = self.get_reply_body(
+            message['content'], message['from_addr'],
+            message['session_event'], options)
+        log.info(
+            'AatUssdEngine outbound message (%s) with content: %r',
+            message_id, body)
+
+        if not message['content']:
+            return self.NO_CONTENT_ERROR
+        if not message['in_reply_to']:
+            return self.NOT_REPLY_ERROR
+        if not self.finish_request(message['in_reply_to'], body):
+            return self.RESPONSE_FAILURE_ERROR
+        return None
@@ -0,0 +1,128 @@
+# -*- test-case-name: vxaat.tests.test_aio -*-
+"""
+Vumi's message format without vumi. Messages are dicts with the fields,
+defaults and JSON encoding of ``vumi.message.TransportUserMessage`` and
+``TransportEvent``, so that the engine and vumi workers can share a
+broker.
+"""
+import json
+from datetime import datetime
+from uuid import uuid4
+
+
+MESSAGE_VERSION = '20110921'
+VUMI_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+_VUMI_DATE_FORMAT_NO_MICROSECONDS = '%Y-%m-%d %H:%M:%S'
+
+SESSION_NONE, SESSION_NEW, SESSION_RESUME, SESSION_CLOSE = (
+    None, 'new', 'resume', 'close')
+
+
+def generate_id():
+    return uuid4().hex
+
+
+def _metadata_fields(message_type):
+    return {
+        'message_version': MESSAGE_VERSION,
+        'message_type': message_type,
+        'timestamp': datetime.utcnow(),
+        'routing_metadata': {},
+        'helper_metadata': {},
+    }
+
+
+def user_message(**fields):
+    """
+    A user message with vumi's defaults for the fields not given.
+    """
+    message = _metadata_fields('user_message')
+    message.update({
+        'in_reply_to': None,
+        'provider': None,
+        'session_event': SESSION_NONE,
+        'content': None,
+        'transport_metadata': {},
+        'group': None,
+        'to_addr_type': None,
+        'from_addr_type': None,
+    })
+    message.update(fields)
+    if 'message_id' not in message:
+        message['message_id'] = generate_id()
+    return message
+
+
+def event(event_type, user_message_id, **fields):
+    message = _metadata_fields('event')
+    message.update({
+        'event_type': event_type,
+        'user_message_id': user_message_id,
+        'transport_metadata': {},
+    })
+    message.update(fields)
+    if 'event_id' not in message:
+        message['event_id'] = generate_id()
+    return message
+
+
+def ack(user_message_id, sent_message_id, **fields):
+    return event(
+        'ack', user_message_id, sent_message_id=sent_message_id, **fields)
+
+
+def nack(user_message_id, reason, **fields):
+    return event('nack', user_message_id, nack_reason=reason, **fields)
+
+
+def reply(message, content, continue_session=True, **fields):
+    """
+    A reply to ``message``, as ``TransportUserMessage.reply`` makes it.
+    ``fields`` may replace its ``helper_metadata`` or add other fields.
+    """
+    fields.setdefault('helper_metadata', message['helper_metadata'])
+    return user_message(
+        content=content,
+        session_event=None if continue_session else SESSION_CLOSE,
+        to_addr=message['from_addr'],
+        from_addr=message['to_addr'],
+        group=message['group'],
+        in_reply_to=message['message_id'],
+        provider=message['provider'],
+        transport_name=message['transport_name'],
+        transport_type=message['transport_type'],
+        transport_metadata=message['transport_metadata'],
+        routing_metadata={
+            'endpoint_name': message['routing_metadata'].get(
+                'endpoint_name') or 'default',
+        },
+        **fields)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.strftime(VUMI_DATE_FORMAT)
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def _decode_dates(obj):
+    # vumi tries every value; only strings the length of one of its
+    # timestamps can be one.
+    for key, value in obj.items():
+        if isinstance(value, str) and len(value) in (19, 26):
+            date_format = (
+                VUMI_DATE_FORMAT if len(value) == 26
+                else _VUMI_DATE_FORMAT_NO_MICROSECONDS)
+            try:
+                obj[key] = datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+    return obj
+
+
+def to_json(message):
+    return json.dumps(message, default=_encode)
+
+
+def from_json(data):
+    return json.loads(data, object_hook=_decode_dates)
@@ -0,0 +1,206 @@
+# -*- test-case-name: vxaat.tests.test_aio -*-
+"""
+A minimal HTTP/1.1 server for the engine, as an ``asyncio.Protocol``.
+
+It supports what AAT gateways send: ``GET``, ``POST`` and ``PUT``
+requests with query string or form encoded arguments and a
+``Content-Length``, on keep-alive connections. Pipelined requests are
+answered in order, one at a time.
+"""
+import asyncio
+import email.utils
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qs
+
+
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+
+
+def _status_line(code):
+    try:
+        phrase = HTTPStatus(code).phrase
+    except ValueError:
+        phrase = 'Unknown'
+    return ('HTTP/1.1 %d %s\r\n' % (code, phrase)).encode('latin-1')
+
+
+def parse_args(query, args=None):
+    """
+    Parse a query string or form body into a dict of lists of byte
+    strings, like ``twisted.web`` does for ``request.args`` but with text
+    keys.
+    """
+    if args is None:
+        args = {}
+    for key, values in parse_qs(query, keep_blank_values=True).items():
+        args.setdefault(key.decode('utf-8', 'replace'), []).extend(values)
+    return args
+
+
+class HttpRequest(object):
+    """
+    A request waiting for its response. :meth:`finish` writes the
+    response, and ``on_lost`` is called with no arguments if the
+    connection is lost first.
+    """
+
+    def __init__(self, channel, method, path, args, keep_alive):
+        self.channel = channel
+        self.method = method
+        self.path = path
+        self.args = args
+        self.keep_alive = keep_alive
+        self.finished = False
+        self.lost = False
+        self.on_lost = None
+
+    def finish(self, code, body, content_type='text/plain'):
+        if self.lost:
+            raise RuntimeError('Finished after the connection was lost.')
+        if self.finished:
+            raise RuntimeError('Finished twice.')
+        self.finished = True
+        self.channel.write_response(self, code, body, content_type)
+
+    def connection_lost(self):
+        self.lost = True
+        if self.on_lost is not None:
+            self.on_lost()
+
+
+class HttpChannel(asyncio.Protocol):
+    """
+    One client connection. Each complete request is passed to
+    ``handle_request`` as an :class:`HttpRequest`.
+    """
+
+    MAX_HEAD_BYTES = 64 * 1024
+    MAX_BODY_BYTES = 1024 * 1024
+
+    _date = None
+    _date_second = None
+
+    def __init__(self, handle_request, channels=None):
+        self.handle_request = handle_request
+        self.channels = channels
+        self.transport = None
+        self.buffer = b''
+        self.current = None
+        self._processing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.channels is not None:
+            self.channels.add(self)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.channels is not None:
+            self.channels.discard(self)
+        request, self.current = self.current, None
+        if request is not None:
+            request.connection_lost()
+
+    def data_received(self, data):
+        self.buffer += data
+        self.process()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def process(self):
+        if self._processing:
+            return
+        self._processing = True
+        try:
+            while self.current is None and self.transport is not None:
+                if not self.next_request():
+                    break
+        finally:
+            self._processing = False
+
+    def next_request(self):
+        """
+        Start the next request in the buffer, and return whether there was
+        a complete one.
+        """
+        buf = self.buffer
+        end = buf.find(b'\r\n\r\n')
+        if end < 0:
+            if len(buf) > self.MAX_HEAD_BYTES:
+                self.reject(431)
+            return False
+        lines = buf[:end].decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            self.reject(400)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'transfer-encoding' in headers:
+            self.reject(501)
+            return False
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            self.reject(400)
+            return False
+        if length > self.MAX_BODY_BYTES:
+            self.reject(413)
+            return False
+        start = end + 4
+        if len(buf) < start + length:
+            return False
+        body = buf[start:start + length]
+        self.buffer = buf[start + length:]
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+        path, _, query = target.partition('?')
+        args = parse_args(query.encode('latin-1'))
+        if body and headers.get('content-type', '').startswith(
+                FORM_CONTENT_TYPE):
+            parse_args(body, args)
+        self.current = HttpRequest(self, method, path, args, keep_alive)
+        self.handle_request(self.current)
+        return True
+
+    def reject(self, code):
+        """
+        Answer a request that cannot be parsed and close the connection.
+        """
+        self.current = HttpRequest(self, None, None, {}, False)
+        self.current.finish(code, b'')
+
+    @classmethod
+    def date(cls):
+        now = int(time.time())
+        if now != cls._date_second:
+            cls._date = email.utils.formatdate(now, usegmt=True)
+            cls._date_second = now
+        return cls._date
+
+    def write_response(self, request, code, body, content_type):
+        if request is not self.current:
+            raise RuntimeError('Responses must be written in order.')
+        self.current = None
+        if self.transport is None:
+            return
+        head = 'Content-Type: %s\r\nContent-Length: %d\r\nDate: %s\r\n' % (
+            content_type, len(body), self.date())
+        if not request.keep_alive:
+            head += 'Connection: close\r\n'
+        self.transport.write(b''.join([
+            _status_line(code), head.encode('latin-1'), b'\r\n', body]))
+        if not request.keep_alive:
+            self.transport.close()
+        elif self.buffer:
+            self.process()
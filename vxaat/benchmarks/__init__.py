@@ -0,0 +1,9 @@
+"""
+Benchmarks for the AAT USSD transport.
+
+None of these need a network or a message broker. Run them as modules,
+for example::
+
+    python -m vxaat.benchmarks.hot_paths --output before.json
+    python -m vxaat.benchmarks.hot_paths --compare before.json
+"""
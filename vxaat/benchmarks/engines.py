@@ -0,0 +1,417 @@
+"""
+Head-to-head throughput and latency of the Twisted transport and the
+asyncio engine. Run it with Python 3::
+
+    python3 -m vxaat.benchmarks.engines --twisted-python /path/to/python2
+
+Each engine runs in its own process, with an echo application on an
+in-memory broker: the Twisted transport under ``--twisted-python`` (which
+needs vumi) as ``vxaat.benchmarks.scale`` runs its workers, and the
+asyncio engine under this interpreter. The same fake AAT gateway, in this
+process, then drives each one over HTTP with ``--concurrency`` keep-alive
+connections, running sessions of ``--depth`` requests that follow the
+callback URL in every reply, as ``vxaat.benchmarks.loadgen`` does.
+
+The brokers are not equivalent, so broker overhead is not controlled for:
+the Twisted transport publishes through vumi's ``FakeAMQPBroker``, which
+scans its list of unacknowledged messages on every ack, and the asyncio
+engine through the much lighter ``InMemoryBroker``. The gap between the
+engines is an upper bound on what the asyncio engine itself gains.
+"""
+import argparse
+import asyncio
+import json
+import shutil
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+from xml.etree.ElementTree import fromstring
+
+from vxaat.aio import AatUssdEngine, InMemoryBroker, messages
+from vxaat.benchmarks.processes import reserve_port, spawn
+from vxaat.benchmarks.stats import latency_summary
+
+
+ENGINES = ('twisted', 'asyncio')
+
+# The broker each engine's echo application is on
+BROKERS = {
+    'twisted': 'FakeAMQPBroker',
+    'asyncio': 'InMemoryBroker',
+}
+
+# The same as vxaat.benchmarks.harness.DEFAULT_CONFIG
+DEFAULT_CONFIG = {
+    'transport_name': 'aat_ussd',
+    'web_path': '/api/aat/ussd/',
+    'web_port': 0,
+    'base_url': 'http://www.example.com/foo',
+}
+
+
+class EchoApplication(object):
+    """
+    Replies to every message with its content and counts the events it
+    receives for its replies, like ``loadgen.EchoApplication``.
+    """
+
+    def __init__(self, loop, broker, app_latency=0.0, end_input='0'):
+        self.loop = loop
+        self.broker = broker
+        self.app_latency = app_latency
+        self.end_input = end_input
+        self.replies = 0
+        self.acks = 0
+        self.nacks = 0
+        broker.consume_inbound(self.consume_user_message)
+        broker.consume_events(self.consume_event)
+
+    def consume_user_message(self, message):
+        content = message['content'] or message['to_addr']
+        reply = messages.reply(
+            message, u'You said: %s' % (content,),
+            message['content'] != self.end_input)
+        self.replies += 1
+        if self.app_latency > 0:
+            self.loop.call_later(
+                self.app_latency, self.broker.publish_outbound, reply)
+        else:
+            self.broker.publish_outbound(reply)
+
+    def consume_event(self, event):
+        if event['event_type'] == 'ack':
+            self.acks += 1
+        elif event['event_type'] == 'nack':
+            self.nacks += 1
+
+
+def parse_response(data):
+    """
+    The status and body of the HTTP response in ``data``, or ``None`` if
+    it is not all there yet. Twisted sends chunked bodies.
+    """
+    end = data.find(b'\r\n\r\n')
+    if end < 0:
+        return None
+    lines = data[:end].decode('latin-1').split('\r\n')
+    code = int(lines[0].split(' ', 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    rest = data[end + 4:]
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size_end = rest.find(b'\r\n')
+            if size_end < 0:
+                return None
+            size = int(rest[:size_end].split(b';')[0], 16)
+            if len(rest) < size_end + 2 + size + 2:
+                return None
+            if size == 0:
+                return code, b''.join(chunks)
+            chunks.append(rest[size_end + 2:size_end + 2 + size])
+            rest = rest[size_end + 2 + size + 2:]
+    length = int(headers.get('content-length', 0))
+    if len(rest) < length:
+        return None
+    return code, rest[:length]
+
+
+class GatewayConnection(asyncio.Protocol):
+    """
+    A keep-alive connection that runs one session after another for a
+    :class:`FakeGateway`.
+    """
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.transport = None
+        self.buffer = b''
+        self.sent = None
+        self.timer = None
+        self.finished = False
+        self.hop = 0
+        self.params = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.gateway.next_session(self)
+
+    def send(self, target):
+        self.buffer = b''
+        self.sent = time.perf_counter()
+        self.timer = self.gateway.loop.call_later(
+            self.gateway.options.gateway_timeout, self.timed_out)
+        self.transport.write((
+            'GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n' % (target,)
+        ).encode('latin-1'))
+
+    def data_received(self, data):
+        self.buffer += data
+        response = parse_response(self.buffer)
+        if response is None:
+            return
+        latency = time.perf_counter() - self.sent
+        self.sent = None
+        self.timer.cancel()
+        self.gateway.response(self, response[0], response[1], latency)
+
+    def timed_out(self):
+        self.gateway.timeouts += 1
+        self.sent = None
+        self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.sent is not None:
+            self.timer.cancel()
+            self.gateway.http_errors += 1
+        self.gateway.connection_closed(self, not self.finished)
+
+
+class FakeGateway(object):
+    """
+    Plays the part of the AAT gateway for ``--sessions`` sessions, with
+    ``--concurrency`` connections.
+    """
+
+    def __init__(self, loop, port, options):
+        self.loop = loop
+        self.port = port
+        self.options = options
+        self.base_url = DEFAULT_CONFIG['base_url'].rstrip('/')
+        self.sessions = iter(range(options.sessions))
+        self.connections = 0
+        self.done = loop.create_future()
+        self.latencies = []
+        self.hops = 0
+        self.timeouts = 0
+        self.http_errors = 0
+        self.completed_sessions = 0
+
+    def run(self):
+        for _ in range(min(self.options.concurrency, self.options.sessions)):
+            self.connect()
+        return self.done
+
+    def connect(self):
+        self.connections += 1
+        task = self.loop.create_task(self.loop.create_connection(
+            lambda: GatewayConnection(self), '127.0.0.1', self.port))
+        task.add_done_callback(self.connected)
+
+    def connected(self, task):
+        if task.exception() is not None:
+            self.http_errors += 1
+            self.connection_closed(None, False)
+
+    def connection_closed(self, connection, reconnect):
+        self.connections -= 1
+        if reconnect:
+            # Closed before the sessions ran out; carry on with the next.
+            self.connect()
+        elif self.connections == 0 and not self.done.done():
+            self.done.set_result(None)
+
+    def next_session(self, connection):
+        index = next(self.sessions, None)
+        if index is None:
+            connection.finished = True
+            connection.transport.close()
+            return
+        options = self.options
+        connection.hop = 0
+        connection.params = {
+            'msisdn': '2770%07d' % (index,),
+            'provider': options.provider,
+            'ussdSessionId': 'load-%d' % (index,),
+            'request': options.ussd_code,
+        }
+        self.send(connection, DEFAULT_CONFIG['web_path'])
+
+    def send(self, connection, path):
+        separator = '&' if '?' in path else '?'
+        self.hops += 1
+        connection.send(path + separator + urlencode(connection.params))
+
+    def callback_path(self, body):
+        option = fromstring(body).find('options/option')
+        if option is None:
+            return None
+        callback = option.get('callback')
+        if callback.startswith(self.base_url):
+            callback = callback[len(self.base_url):]
+        return callback
+
+    def response(self, connection, code, body, latency):
+        if code != 200:
+            self.http_errors += 1
+            self.next_session(connection)
+            return
+        self.latencies.append(latency)
+        path = self.callback_path(body)
+        connection.hop += 1
+        if path is None or connection.hop >= self.options.depth:
+            self.completed_sessions += 1
+            self.next_session(connection)
+            return
+        last = connection.hop == self.options.depth - 1
+        connection.params['request'] = (
+            self.options.end_input if last else '1')
+        self.send(connection, path)
+
+
+def serve(options):
+    """
+    Run the asyncio engine and an echo application until stdin is
+    closed, then write their counts to stdout.
+    """
+    loop = asyncio.new_event_loop()
+    broker = InMemoryBroker(loop, record=False)
+    config = dict(DEFAULT_CONFIG)
+    config.update(options.transport_config)
+    config.update({'web_port': options.port, 'reuse_port': True})
+    engine = AatUssdEngine(config, broker, loop)
+    app = EchoApplication(
+        loop, broker, options.app_latency, options.end_input)
+    loop.run_until_complete(engine.start())
+    sys.stdout.write('ready\n')
+    sys.stdout.flush()
+    loop.run_until_complete(loop.run_in_executor(None, sys.stdin.read))
+    engine.stop()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    json.dump({'acks': app.acks, 'nacks': app.nacks}, sys.stdout)
+    sys.stdout.flush()
+
+
+def server_argv(engine, options, port, socket_dir):
+    argv = [
+        '--port', port,
+        '--app-latency', options.app_latency,
+        '--end-input', options.end_input,
+        '--transport-config', json.dumps(options.transport_config),
+    ]
+    if engine == 'twisted':
+        return [
+            options.twisted_python, '-m', 'vxaat.benchmarks.scale',
+            '--worker', 'twisted', '--socket-dir', socket_dir,
+        ] + argv
+    return [sys.executable, '-m', 'vxaat.benchmarks.engines', '--serve'] + argv
+
+
+def run_engine(engine, options):
+    """
+    Run the load against ``engine`` and return a results dict.
+    """
+    reserved = reserve_port()
+    port = reserved.getsockname()[1]
+    # Only the Twisted transport's reply forwarder needs this.
+    socket_dir = tempfile.mkdtemp()
+    server = spawn(server_argv(engine, options, port, socket_dir))
+    try:
+        if server.stdout.readline().strip() != b'ready':
+            raise RuntimeError('The %s server failed to start.' % (engine,))
+        loop = asyncio.new_event_loop()
+        try:
+            gateway = FakeGateway(loop, port, options)
+            start = time.perf_counter()
+            loop.run_until_complete(gateway.run())
+            duration = time.perf_counter() - start
+        finally:
+            loop.close()
+    finally:
+        output = server.communicate()[0]
+        reserved.close()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+    counts = json.loads(output) if output else {}
+    return {
+        'engine': engine,
+        'broker': BROKERS[engine],
+        'sessions': options.sessions,
+        'completed_sessions': gateway.completed_sessions,
+        'hops': gateway.hops,
+        'duration': duration,
+        'hops_per_sec': gateway.hops / duration if duration else None,
+        'latency_ms': latency_summary(gateway.latencies),
+        'timeouts': gateway.timeouts,
+        'http_errors': gateway.http_errors,
+        'acks': counts.get('acks'),
+        'nacks': counts.get('nacks'),
+    }
+
+
+def run_engines(options):
+    results = []
+    for engine in options.engines:
+        results.append(run_engine(engine, options))
+    return results
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--engines', type=lambda v: v.split(','), default=list(ENGINES),
+        help='Comma separated engines to run: twisted, asyncio or both.')
+    parser.add_argument(
+        '--twisted-python', default='python2',
+        help='A Python 2 interpreter with vumi installed.')
+    parser.add_argument(
+        '--sessions', type=int, default=2000, help='Sessions to run.')
+    parser.add_argument(
+        '--concurrency', type=int, default=100,
+        help='Sessions in progress at once.')
+    parser.add_argument(
+        '--depth', type=int, default=3, help='Requests per session.')
+    parser.add_argument(
+        '--app-latency', type=float, default=0.0,
+        help='Seconds the echo application takes to reply.')
+    parser.add_argument(
+        '--gateway-timeout', type=float, default=10.0,
+        help='Seconds the gateway waits for a reply.')
+    parser.add_argument('--ussd-code', default='*1234#')
+    parser.add_argument('--provider', default='MTN')
+    parser.add_argument('--end-input', default='0')
+    parser.add_argument(
+        '--transport-config', type=json.loads, default={},
+        help='JSON object of extra config for both engines.')
+    parser.add_argument(
+        '-o', '--output', help='Write the results as JSON to this file.')
+    # Used to start the server processes
+    parser.add_argument('--serve', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+    unknown = set(options.engines) - set(ENGINES)
+    if unknown:
+        parser.error('Unknown engines: %s' % (', '.join(sorted(unknown)),))
+    return options
+
+
+def main(argv=None, out=sys.stdout):
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    if options.serve:
+        return serve(options)
+    results = run_engines(options)
+    for result in results:
+        latency = result['latency_ms']
+        out.write(
+            '%-8s %10.1f hops/s, p50 %.2fms, p99 %.2fms, %d timeouts, '
+            '%d errors (%s)\n' % (
+                result['engine'], result['hops_per_sec'] or 0,
+                latency.get('p50', 0), latency.get('p99', 0),
+                result['timeouts'], result['http_errors'],
+                result['broker']))
+    if len(results) > 1:
+        out.write(
+            'The engines run on different brokers; broker overhead is not '
+            'controlled for.\n')
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
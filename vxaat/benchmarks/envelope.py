@@ -0,0 +1,71 @@
+"""
+The size of the inbound messages the transport publishes, and the time to
+encode and decode them, with full and compact envelopes.
+
+The messages are the ones the transport publishes for a resumed session
+with a USSD session id, through a worker that forwards replies, so that
+every AAT field is set.
+"""
+import sys
+
+from vumi.message import TransportUserMessage
+
+from vxaat.benchmarks.harness import (
+    FakeRequest, discard_logs, main, make_transport, teardown_transport)
+from vxaat.benchmarks.hot_paths import MSISDN, USSD_CODE
+
+
+ENVELOPES = ('full', 'compact')
+
+
+def published_message(compact):
+    """
+    The message a transport with or without ``compact_envelope`` publishes
+    for a resumed session.
+    """
+    transport = make_transport({
+        'provider_mappings': {'MTN': 'mtn'},
+        'compact_envelope': compact,
+    })
+    # Set after setup, so that no forwarding socket is opened
+    transport.worker_id = 'worker-1'
+    try:
+        request = FakeRequest({
+            'msisdn': [MSISDN],
+            'provider': [b'MTN'],
+            'request': [b'1'],
+            'ussdSessionId': [b'1234567890'],
+            'to_addr': [USSD_CODE],
+        })
+        transport.set_request('msg-1', request)
+        transport.handle_raw_inbound_message('msg-1', request)
+        return transport.connectors[transport.transport_name].last_inbound
+    finally:
+        teardown_transport(transport)
+
+
+def message_sizes():
+    return dict(
+        (envelope, len(published_message(envelope == 'compact').to_json()))
+        for envelope in ENVELOPES)
+
+
+def make_cases():
+    cases = []
+    for envelope in ENVELOPES:
+        message = published_message(envelope == 'compact')
+        data = message.to_json()
+        cases.append(('encode.%s' % (envelope,), message.to_json))
+        cases.append((
+            'decode.%s' % (envelope,),
+            lambda data=data: TransportUserMessage.from_json(data)))
+    return cases
+
+
+if __name__ == '__main__':
+    discard_logs()
+    sizes = message_sizes()
+    for envelope in ENVELOPES:
+        sys.stdout.write('%-40s %14d bytes\n' % (
+            'size.%s' % (envelope,), sizes[envelope]))
+    sys.exit(main(make_cases(), description=__doc__))
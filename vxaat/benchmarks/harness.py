@@ -0,0 +1,292 @@
+"""
+Shared plumbing for the benchmarks: a transport that runs without a web
+server or message broker, fake requests, timing, and JSON results that
+can be compared between runs.
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+from timeit import default_timer
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.http_headers import Headers
+
+import vxaat
+from vxaat.ussd import AatUssdTransport
+
+
+DEFAULT_CONFIG = {
+    'transport_name': 'aat_ussd',
+    'base_url': 'http://www.example.com/foo',
+    'web_path': '/api/aat/ussd/',
+    'web_port': 0,
+}
+
+
+class FakePort(object):
+    def getHost(self):
+        return IPv4Address('TCP', '127.0.0.1', 0)
+
+    def loseConnection(self):
+        return succeed(None)
+
+
+class NullConnector(object):
+    """
+    Stands in for the transport's message connector. Counts what gets
+    published and keeps only the last message of each kind.
+    """
+
+    def __init__(self):
+        self.inbound_count = 0
+        self.event_count = 0
+        self.last_inbound = None
+        self.last_event = None
+
+    def publish_inbound(self, msg, endpoint_name=None):
+        self.inbound_count += 1
+        self.last_inbound = msg
+        return succeed(msg)
+
+    def publish_event(self, msg, endpoint_name=None):
+        self.event_count += 1
+        self.last_event = msg
+        return succeed(msg)
+
+
+class FakeRequest(object):
+    """
+    The parts of a ``twisted.web`` request the transport touches.
+    """
+    client = IPv4Address('TCP', '127.0.0.1', 12345)
+
+    def __init__(self, args):
+        self.args = args
+        self.code = None
+        self.written = []
+        self.finished = False
+        self.lost = False
+        self.responseHeaders = Headers()
+        self._notify = []
+
+    def setHeader(self, name, value):
+        self.responseHeaders.setRawHeaders(name, [value])
+
+    def setResponseCode(self, code):
+        self.code = code
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        if self.lost:
+            raise RuntimeError('Finished after the connection was lost.')
+        self.finished = True
+        for d in self._notify:
+            d.callback(None)
+        self._notify = []
+
+    def notifyFinish(self):
+        d = Deferred()
+        self._notify.append(d)
+        return d
+
+    def lose_connection(self):
+        """
+        The gateway hangs up before the reply is written.
+        """
+        self.lost = True
+        for d in self._notify:
+            d.errback(Failure(ConnectionDone()))
+        self._notify = []
+
+
+def _result(d):
+    results = []
+    d.addBoth(results.append)
+    [result] = results
+    if isinstance(result, Failure):
+        result.raiseException()
+    return result
+
+
+def make_transport(config=None, transport_class=AatUssdTransport,
+                   clock=None):
+    """
+    Build and set up a transport that uses a :class:`NullConnector`
+    instead of a broker, a fake listening port and a
+    ``twisted.internet.task.Clock`` unless ``clock`` is given.
+    """
+    transport_config = dict(DEFAULT_CONFIG)
+    transport_config.update(config or {})
+    transport = transport_class({}, transport_config)
+    if clock is None:
+        clock = Clock()
+    transport.get_clock = lambda: clock
+    transport.start_web_resources = (
+        lambda resources, port, site_class=None: succeed(FakePort()))
+    transport._validate_config()
+    transport.connectors[transport.transport_name] = NullConnector()
+    _result(transport.setup_transport())
+    return transport
+
+
+def teardown_transport(transport):
+    _result(transport.teardown_transport())
+
+
+def _time_calls(func, number):
+    start = default_timer()
+    for _ in range(number):
+        func()
+    return default_timer() - start
+
+
+def count_gc_objects(func, number):
+    """
+    Net garbage-collector tracked objects per call, read from the
+    generation 0 counter with collection disabled. The counter goes up
+    when the gc allocator hands out a container and down when one is
+    released back to it, so it says nothing of strings, numbers and other
+    objects the collector does not track, nor of containers recycled
+    through the interpreter's free lists. It is not a count of
+    allocations, only a rough but repeatable measure of the work a call
+    leaves for the collector.
+    """
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for _ in range(number):
+            func()
+        after = gc.get_count()[0]
+    finally:
+        if enabled:
+            gc.enable()
+    return (after - before) / float(number)
+
+
+def measure(func, min_time=0.2, repeat=3):
+    """
+    Time ``func`` and return a dict of results. The number of calls per
+    run is scaled up until a run takes at least ``min_time`` seconds and
+    the best of ``repeat`` runs is reported.
+    """
+    func()
+    number = 1
+    while True:
+        elapsed = _time_calls(func, number)
+        if elapsed >= min_time or number >= 10 ** 7:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    best = min([elapsed] + [
+        _time_calls(func, number) for _ in range(repeat - 1)])
+    best = max(best, 1e-9)
+    return {
+        'calls': number,
+        'ops_per_sec': number / best,
+        'usec_per_call': best * 1e6 / number,
+        'gc_objects_per_call': count_gc_objects(func, min(number, 10000)),
+    }
+
+
+def run_cases(cases, min_time=0.2, repeat=3, out=None):
+    results = {}
+    for name, func in cases:
+        result = results[name] = measure(func, min_time, repeat)
+        if out is not None:
+            out.write('%-40s %14.1f ops/s %10.2f us %8.2f gc objs\n' % (
+                name, result['ops_per_sec'], result['usec_per_call'],
+                result['gc_objects_per_call']))
+    return results
+
+
+def metadata():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'vxaat': vxaat.__version__,
+        'time': time.time(),
+    }
+
+
+def compare(baseline, results, threshold=0.1):
+    """
+    Compare ``results`` against ``baseline`` (both ``results`` dicts).
+    Returns ``(name, old_ops, new_ops, ratio, regressed)`` tuples for the
+    cases present in both; a case has regressed when its throughput fell
+    by more than ``threshold``.
+    """
+    rows = []
+    for name in sorted(set(baseline) & set(results)):
+        old = baseline[name]['ops_per_sec']
+        new = results[name]['ops_per_sec']
+        ratio = new / old
+        rows.append((name, old, new, ratio, ratio < 1 - threshold))
+    return rows
+
+
+def discard_logs():
+    """
+    Send log events nowhere, so that they cost what formatting them costs
+    rather than piling up in Twisted's pre-startup log buffer.
+    """
+    log.startLoggingWithObserver(lambda event: None, setStdout=False)
+
+
+def main(cases, argv=None, description=None, out=sys.stdout):
+    """
+    Command line entry point shared by the benchmark modules. Returns an
+    exit code that is non-zero when ``--compare`` found a regression.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        '-o', '--output', help='Write the results as JSON to this file.')
+    parser.add_argument(
+        '-c', '--compare',
+        help='Compare the results against a JSON file from an earlier run.')
+    parser.add_argument(
+        '-t', '--threshold', type=float, default=0.1,
+        help='Fraction of throughput lost that counts as a regression.')
+    parser.add_argument(
+        '--min-time', type=float, default=0.2,
+        help='Minimum seconds per timing run.')
+    parser.add_argument(
+        '--repeat', type=int, default=3, help='Timing runs per case.')
+    parser.add_argument(
+        '-k', '--filter', help='Only run cases whose name contains this.')
+    args = parser.parse_args(argv)
+
+    if args.filter:
+        cases = [(n, f) for n, f in cases if args.filter in n]
+    results = run_cases(cases, args.min_time, args.repeat, out)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': metadata(), 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        rows = compare(baseline, results, args.threshold)
+        regressed = False
+        out.write('\n')
+        for name, old, new, ratio, is_regression in rows:
+            regressed = regressed or is_regression
+            flag = '  REGRESSION' if is_regression else ''
+            out.write('%-40s %14.1f -> %14.1f ops/s %7.2fx%s\n' % (
+                name, old, new, ratio, flag))
+        if regressed:
+            return 1
+    return 0
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for the functions on the transport's request/reply path.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+from twisted.internet.task import Clock
+
+from vumi.message import TransportUserMessage
+
+from vxaat.benchmarks.harness import (
+    FakeRequest, discard_logs, main, make_transport)
+
+
+CONTENT = {
+    'short': u'1. Yes\n2. No',
+    'long': u'Welcome to the service. ' * 7,
+    'unicode': u'Thrëë, my lord. Ngiyabonga kakhulu السلام',
+    'hostile': u'<menu> 1. Fish & chips\n2. "Spam" & <eggs> ' * 4,
+}
+
+MSISDN = b'27729042520'
+USSD_CODE = '*1234#'
+
+
+def generate_body_cases(transport):
+    callback = transport.get_callback_url(USSD_CODE)
+    cases = []
+    for name, content in sorted(CONTENT.items()):
+        cases.append((
+            'generate_body.%s' % (name,),
+            lambda content=content: transport.generate_body(
+                content, callback, TransportUserMessage.SESSION_RESUME)))
+    menu = [(str(i), u'Option %d' % (i,), None) for i in range(1, 6)]
+    cases.append((
+        'generate_body.menu',
+        lambda: transport.generate_body(
+            CONTENT['short'], callback, TransportUserMessage.SESSION_RESUME,
+            menu)))
+    cases.append((
+        'generate_body.close',
+        lambda: transport.generate_body(
+            CONTENT['short'], callback, TransportUserMessage.SESSION_CLOSE)))
+    return cases
+
+
+def cycle(transport, args, content):
+    """
+    Push one request through ``handle_raw_inbound_message`` and reply to
+    it through ``handle_outbound_message``.
+    """
+    connector = transport.connectors[transport.transport_name]
+    message_id = transport.generate_message_id()
+    request = FakeRequest(args)
+    transport.set_request(message_id, request)
+    transport.handle_raw_inbound_message(message_id, request)
+    msg = connector.last_inbound
+    transport.handle_outbound_message(msg.reply(content))
+    assert request.finished
+
+
+def make_cases(capture_dir=None):
+    transport = make_transport({
+        'provider_mappings': {'MTN': 'mtn', 'Vodacom': 'vodacom'},
+    })
+    new_args = {
+        'msisdn': [MSISDN],
+        'provider': [b'MTN'],
+        'request': [USSD_CODE],
+        'ussdSessionId': [b'1234567890'],
+    }
+    resume_args = {
+        'msisdn': [MSISDN],
+        'provider': [b'MTN'],
+        'request': [b'1'],
+        'ussdSessionId': [b'1234567890'],
+        'to_addr': [USSD_CODE],
+    }
+
+    if capture_dir is None:
+        capture_dir = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, capture_dir, True)
+    capture_clock = Clock()
+    capturing = make_transport({
+        'provider_mappings': {'MTN': 'mtn', 'Vodacom': 'vodacom'},
+        'capture_path': os.path.join(capture_dir, 'capture'),
+    }, clock=capture_clock)
+
+    def capture_cycle():
+        cycle(capturing, resume_args, CONTENT['long'])
+        # Runs the flush the writer schedules once its buffer is full.
+        capture_clock.advance(0)
+
+    cases = generate_body_cases(transport)
+    cases.extend([
+        ('get_callback_url',
+         lambda: transport.get_callback_url(USSD_CODE)),
+        ('normalise_provider.mapped',
+         lambda: transport.normalise_provider(u'MTN')),
+        ('normalise_provider.unmapped',
+         lambda: transport.normalise_provider(u'Camelot')),
+        ('parse_request',
+         lambda: transport.request_parser.parse(resume_args)),
+        ('cycle.new',
+         lambda: cycle(transport, new_args, CONTENT['short'])),
+        ('cycle.resume',
+         lambda: cycle(transport, resume_args, CONTENT['long'])),
+        ('cycle.resume.capture', capture_cycle),
+    ])
+    return cases
+
+
+if __name__ == '__main__':
+    discard_logs()
+    sys.exit(main(make_cases(), description=__doc__))
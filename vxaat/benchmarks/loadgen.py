@@ -0,0 +1,299 @@
+"""
+End-to-end load test: a fake AAT gateway drives concurrent USSD sessions
+over HTTP against an ``AatUssdTransport`` whose replies come from an echo
+application connected through vumi's in-memory message broker.
+
+Each session dials ``--ussd-code`` and then follows the callback URL in
+every reply for ``--depth`` hops in total. The final hop sends
+``--end-input``, which the echo application answers by closing the
+session.
+"""
+import argparse
+import json
+import sys
+import time
+from urllib import urlencode
+from urlparse import urlsplit
+from xml.etree.ElementTree import fromstring
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, gatherResults,
+    inlineCallbacks, returnValue)
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+
+from vumi.application import ApplicationWorker
+from vumi.config import ConfigFloat, ConfigText
+from vumi.tests.fake_amqp import FakeAMQPBroker
+from vumi.tests.helpers import WorkerHelper
+
+from vxaat.benchmarks.harness import DEFAULT_CONFIG, discard_logs
+from vxaat.benchmarks.stats import latency_summary
+from vxaat.ussd import AatUssdTransport
+
+
+class EchoApplicationConfig(ApplicationWorker.CONFIG_CLASS):
+    app_latency = ConfigFloat(
+        'Seconds to wait before replying to each message.',
+        static=True, default=0.0)
+    end_input = ConfigText(
+        'User input that makes the application close the session.',
+        static=True, default='0')
+
+
+class EchoApplication(ApplicationWorker):
+    """
+    Replies to every message with its content and counts the events it
+    receives for its replies.
+    """
+    CONFIG_CLASS = EchoApplicationConfig
+
+    def setup_application(self):
+        config = self.get_static_config()
+        self.app_latency = config.app_latency
+        self.end_input = config.end_input
+        self.replies = 0
+        self.acks = 0
+        self.nacks = 0
+
+    def consume_user_message(self, message):
+        content = message['content'] or message['to_addr']
+        continue_session = message['content'] != self.end_input
+        self.replies += 1
+        if self.app_latency > 0:
+            reactor.callLater(
+                self.app_latency, self.reply_to, message,
+                u'You said: %s' % (content,), continue_session)
+        else:
+            return self.reply_to(
+                message, u'You said: %s' % (content,), continue_session)
+
+    def consume_ack(self, event):
+        self.acks += 1
+
+    def consume_nack(self, event):
+        self.nacks += 1
+
+
+def sleep(seconds, clock=reactor):
+    d = Deferred()
+    clock.callLater(seconds, d.callback, None)
+    return d
+
+
+class FakeGateway(object):
+    """
+    Plays the part of the AAT gateway for many concurrent sessions.
+    """
+
+    def __init__(self, url, base_url, options, agent, clock=reactor):
+        self.url = url
+        self.base_url = base_url.rstrip('/')
+        self.options = options
+        self.agent = agent
+        self.clock = clock
+        self.latencies = []
+        self.hops = 0
+        self.timeouts = 0
+        self.http_errors = 0
+        self.completed_sessions = 0
+
+    def callback_url(self, body):
+        """
+        The URL for the next hop, taken from the reply's option and
+        pointed at the transport's real address instead of the configured
+        ``base_url``. Returns ``None`` if the session was closed.
+        """
+        option = fromstring(body).find('options/option')
+        if option is None:
+            return None
+        callback = option.get('callback')
+        if callback.startswith(self.base_url):
+            callback = callback[len(self.base_url):]
+        target = urlsplit(self.url)
+        return '%s://%s%s' % (target.scheme, target.netloc, callback)
+
+    @inlineCallbacks
+    def hop(self, url, params):
+        """
+        Make one request and return the response body, or ``None`` if the
+        request timed out or failed.
+        """
+        separator = '&' if '?' in url else '?'
+        d = self.agent.request('GET', url + separator + urlencode(params))
+        timed_out = []
+
+        def timeout():
+            timed_out.append(True)
+            d.cancel()
+
+        timer = self.clock.callLater(self.options.gateway_timeout, timeout)
+        start = time.time()
+        self.hops += 1
+        try:
+            response = yield d
+            body = yield readBody(response)
+        except Exception:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.http_errors += 1
+            returnValue(None)
+        finally:
+            if timer.active():
+                timer.cancel()
+        if response.code != 200:
+            self.http_errors += 1
+            returnValue(None)
+        self.latencies.append(time.time() - start)
+        returnValue(body)
+
+    @inlineCallbacks
+    def run_session(self, index):
+        options = self.options
+        params = {
+            'msisdn': '2770%07d' % (index,),
+            'provider': options.provider,
+            'ussdSessionId': 'load-%d' % (index,),
+            'request': options.ussd_code,
+        }
+        url = self.url
+        for hop in range(options.depth):
+            if hop > 0:
+                if options.think_time > 0:
+                    yield sleep(options.think_time, self.clock)
+                last = hop == options.depth - 1
+                params['request'] = options.end_input if last else '1'
+            body = yield self.hop(url, params)
+            if body is None:
+                return
+            url = self.callback_url(body)
+            if url is None:
+                break
+        self.completed_sessions += 1
+
+    def run(self, first=0):
+        """
+        Run ``--sessions`` sessions, numbered from ``first``.
+        """
+        semaphore = DeferredSemaphore(self.options.concurrency)
+        return gatherResults([
+            semaphore.run(self.run_session, i)
+            for i in range(first, first + self.options.sessions)])
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--sessions', type=int, default=1000, help='Sessions to run.')
+    parser.add_argument(
+        '--concurrency', type=int, default=100,
+        help='Sessions in progress at once.')
+    parser.add_argument(
+        '--depth', type=int, default=3, help='Requests per session.')
+    parser.add_argument(
+        '--think-time', type=float, default=0.0,
+        help='Seconds the user takes between hops.')
+    parser.add_argument(
+        '--app-latency', type=float, default=0.0,
+        help='Seconds the echo application takes to reply.')
+    parser.add_argument(
+        '--gateway-timeout', type=float, default=10.0,
+        help='Seconds the gateway waits for a reply.')
+    parser.add_argument('--ussd-code', default='*1234#')
+    parser.add_argument('--provider', default='MTN')
+    parser.add_argument('--end-input', default='0')
+    parser.add_argument(
+        '--transport-config', type=json.loads, default={},
+        help='JSON object of extra transport config.')
+    parser.add_argument(
+        '-o', '--output', help='Write the results as JSON to this file.')
+    return parser.parse_args(argv)
+
+
+@inlineCallbacks
+def run_load(options, clock=reactor, gateway_class=FakeGateway):
+    """
+    Start a transport and an echo application on an in-memory broker,
+    run the fake gateway against them and return a results dict.
+    """
+    broker = FakeAMQPBroker()
+    transport_config = dict(DEFAULT_CONFIG)
+    transport_config.update(options.transport_config)
+    transport = WorkerHelper.get_worker_raw(
+        AatUssdTransport, transport_config, broker)
+    yield transport.startWorker()
+    app = WorkerHelper.get_worker_raw(EchoApplication, {
+        'transport_name': transport_config['transport_name'],
+        'app_latency': options.app_latency,
+        'end_input': options.end_input,
+    }, broker)
+    yield app.startWorker()
+
+    # The in-memory broker keeps a copy of everything published, so count
+    # the failures the transport reports and then throw the copies away.
+    failures_rkey = '%s.failures' % (transport_config['transport_name'],)
+    failures = []
+
+    def trim():
+        failures.extend(broker.get_dispatched('vumi', failures_rkey))
+        broker.dispatched.clear()
+
+    trim_task = task.LoopingCall(trim)
+    trim_task.start(1.0)
+
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = options.concurrency
+    gateway = gateway_class(
+        transport.get_transport_url(transport.web_path),
+        transport_config['base_url'], options, Agent(reactor, pool=pool),
+        clock)
+
+    start = time.time()
+    try:
+        yield gateway.run()
+        duration = time.time() - start
+        # Let replies to abandoned requests arrive and be nacked.
+        yield sleep(options.app_latency, clock)
+        yield broker.wait_delivery()
+    finally:
+        trim_task.stop()
+        trim()
+        yield pool.closeCachedConnections()
+        yield app.stopWorker()
+        yield transport.stopWorker()
+        yield broker.wait_delivery()
+
+    replies = app.acks + app.nacks
+    returnValue({
+        'sessions': options.sessions,
+        'completed_sessions': gateway.completed_sessions,
+        'hops': gateway.hops,
+        'duration': duration,
+        'hops_per_sec': gateway.hops / duration if duration else None,
+        'latency_ms': latency_summary(gateway.latencies),
+        'timeouts': gateway.timeouts,
+        'timeout_rate': (
+            float(gateway.timeouts) / gateway.hops if gateway.hops else 0.0),
+        'http_errors': gateway.http_errors,
+        'acks': app.acks,
+        'nacks': app.nacks,
+        'nack_rate': float(app.nacks) / replies if replies else 0.0,
+        'failures': len(failures),
+    })
+
+
+@inlineCallbacks
+def main(reactor, *argv):
+    options = parse_args(argv)
+    discard_logs()
+    results = yield run_load(options)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
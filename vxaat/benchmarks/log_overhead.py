@@ -0,0 +1,67 @@
+"""
+The cost of the transport's logging on the request/reply path.
+
+Each case pushes a resume request and its reply through a transport with
+the given ``log_format``. In the ``written`` cases every info record is
+formatted, as a log file would; in the ``filtered`` cases info records
+are dropped without being formatted, as they are when only warnings are
+kept.
+"""
+import logging
+import sys
+
+from twisted.python import log
+
+from vxaat.benchmarks.harness import main, make_transport
+from vxaat.benchmarks.hot_paths import CONTENT, MSISDN, USSD_CODE, cycle
+
+
+class LevelObserver(object):
+    """
+    Formats the log events at or above ``level`` and drops the rest.
+    """
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+        self.written = 0
+
+    def __call__(self, event):
+        if event.get('logLevel', logging.INFO) >= self.level:
+            self.written += len(log.textFromEventDict(event) or '')
+
+
+def make_cases(observer):
+    resume_args = {
+        'msisdn': [MSISDN],
+        'provider': [b'MTN'],
+        'request': [b'1'],
+        'ussdSessionId': [b'1234567890'],
+        'to_addr': [USSD_CODE],
+    }
+    transports = [
+        ('text', make_transport()),
+        ('structured', make_transport({'log_format': 'structured'})),
+        ('structured.sampled', make_transport({
+            'log_format': 'structured',
+            'log_sample_rates': {'inbound': 0.01, 'outbound': 0.01},
+        })),
+    ]
+
+    def case(transport, level):
+        def run():
+            observer.level = level
+            cycle(transport, resume_args, CONTENT['long'])
+        return run
+
+    cases = []
+    for name, transport in transports:
+        cases.append(('%s.written' % (name,), case(transport, logging.INFO)))
+        cases.append(
+            ('%s.filtered' % (name,), case(transport, logging.WARNING)))
+    return cases
+
+
+if __name__ == '__main__':
+    observer = LevelObserver()
+    log.startLoggingWithObserver(observer, setStdout=False)
+    sys.exit(main(make_cases(observer), description=__doc__))
@@ -0,0 +1,134 @@
+"""
+Throughput of replies consumed from the broker one at a time, as they are
+by default, against micro-batches with ``outbound_prefetch_count``.
+
+For each case a transport on vumi's in-memory broker holds ``--burst``
+requests open, replies to all of them are published at once, and the
+time from the first delivery to the last request being written is
+measured. The serial cases use ``amqp_prefetch_count`` and the batched
+ones ``outbound_prefetch_count``, each set to the values in
+``--prefetch``.
+"""
+import argparse
+import json
+import sys
+from timeit import default_timer
+
+from twisted.internet import task
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
+
+from vumi.message import TransportUserMessage
+from vumi.tests.fake_amqp import FakeAMQPBroker
+from vumi.tests.helpers import WorkerHelper
+
+from vxaat.benchmarks.harness import DEFAULT_CONFIG, FakeRequest, discard_logs
+from vxaat.ussd import AatUssdTransport
+
+
+def make_replies(transport, burst):
+    """
+    Open ``burst`` requests on ``transport`` and return them with a reply
+    to each.
+    """
+    requests = []
+    replies = []
+    for i in range(burst):
+        message_id = 'burst-%d' % (i,)
+        request = FakeRequest({})
+        transport.set_request(message_id, request)
+        message = TransportUserMessage(
+            message_id=message_id,
+            to_addr='*1234#',
+            from_addr='2770%07d' % (i,),
+            transport_name=transport.transport_name,
+            transport_type='ussd',
+            session_event=TransportUserMessage.SESSION_NEW,
+            transport_metadata={'aat_ussd': {'provider': 'MTN'}})
+        requests.append(request)
+        replies.append(message.reply(u'Reply %d' % (i,)))
+    return requests, replies
+
+
+@inlineCallbacks
+def run_case(config, burst):
+    """
+    Time a burst of ``burst`` replies through a transport with the extra
+    ``config`` and return the replies written per second.
+    """
+    broker = FakeAMQPBroker()
+    transport_config = dict(DEFAULT_CONFIG)
+    transport_config.update(config)
+    transport = WorkerHelper.get_worker_raw(
+        AatUssdTransport, transport_config, broker)
+    yield transport.startWorker()
+    try:
+        requests, replies = make_replies(transport, burst)
+        finished = gatherResults(
+            [request.notifyFinish() for request in requests])
+        rkey = '%s.outbound' % (transport.transport_name,)
+        for reply in replies:
+            broker.publish_message('vumi', rkey, reply)
+        # Delivery starts once the reactor gets control back
+        start = default_timer()
+        yield finished
+        elapsed = default_timer() - start
+        yield broker.wait_delivery()
+    finally:
+        yield transport.stopWorker()
+    returnValue(burst / elapsed)
+
+
+def make_cases(prefetch_counts):
+    cases = []
+    for count in prefetch_counts:
+        cases.append(
+            ('serial.prefetch_%d' % (count,), {'amqp_prefetch_count': count}))
+    for count in prefetch_counts:
+        cases.append(
+            ('batched.prefetch_%d' % (count,),
+             {'outbound_prefetch_count': count}))
+    return cases
+
+
+@inlineCallbacks
+def run_outbound(options, out=None):
+    results = {}
+    for name, config in make_cases(options.prefetch):
+        rates = []
+        for _ in range(options.repeat):
+            rate = yield run_case(config, options.burst)
+            rates.append(rate)
+        results[name] = {'replies_per_sec': max(rates)}
+        if out is not None:
+            out.write('%-40s %14.1f replies/s\n' % (name, max(rates)))
+    returnValue(results)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--burst', type=int, default=5000, help='Replies per burst.')
+    parser.add_argument(
+        '--prefetch', type=lambda v: [int(c) for c in v.split(',')],
+        default=[20, 100, 500],
+        help='Comma separated prefetch counts to try.')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Bursts per case, of which the fastest is reported.')
+    parser.add_argument(
+        '-o', '--output', help='Write the results as JSON to this file.')
+    return parser.parse_args(argv)
+
+
+@inlineCallbacks
+def main(reactor, *argv):
+    options = parse_args(argv)
+    discard_logs()
+    results = yield run_outbound(options, sys.stdout)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,37 @@
+"""
+Starting the processes of a multi-process benchmark and reserving the port
+they share. This module has no dependencies, so that benchmarks on either
+Python can use it.
+"""
+import os
+import subprocess
+
+import vxaat
+from vxaat.sockets import reuse_port_socket
+
+
+# Resolved at import time, in case the working directory changes later.
+PACKAGE_ROOT = os.path.dirname(
+    os.path.dirname(os.path.abspath(vxaat.__file__)))
+
+
+def spawn(argv):
+    """
+    Start ``argv`` with pipes for its stdin and stdout.
+    """
+    # Children must import this copy of vxaat wherever they start.
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [PACKAGE_ROOT, env.get('PYTHONPATH')]))
+    return subprocess.Popen(
+        [str(arg) for arg in argv],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+
+
+def reserve_port():
+    """
+    Return a socket bound to a free local port with ``SO_REUSEPORT`` set.
+    Holding it keeps the port reserved for servers listening on it with
+    ``SO_REUSEPORT`` without accepting any of their connections.
+    """
+    return reuse_port_socket(0, '127.0.0.1')
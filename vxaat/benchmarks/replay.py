@@ -0,0 +1,157 @@
+"""
+Replays requests recorded with the transport's ``capture_path`` option
+against an ``AatUssdTransport`` and an echo application, as the load
+test does, and compares the round trip latencies with those recorded.
+
+``--speed`` replays at the recorded pace (``1``), ``N`` times faster or
+as fast as possible (``max``). The requests of each session, keyed by
+``ussdSessionId`` or else ``msisdn``, are always sent in their recorded
+order, each once the reply to the one before it has arrived.
+"""
+import argparse
+import json
+import sys
+import time
+from collections import OrderedDict
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import (
+    DeferredSemaphore, gatherResults, inlineCallbacks, returnValue)
+
+from vxaat.benchmarks.harness import discard_logs
+from vxaat.benchmarks.loadgen import (
+    FakeGateway, latency_summary, run_load, sleep)
+from vxaat.capture import capture_files, load_requests
+
+
+def session_key(args):
+    return args.get(b'ussdSessionId') or args.get(b'msisdn')
+
+
+def group_sessions(requests):
+    """
+    Group requests by session, keeping them in order.
+    """
+    sessions = OrderedDict()
+    for request in requests:
+        sessions.setdefault(session_key(request.args), []).append(request)
+    return list(sessions.values())
+
+
+class Replayer(FakeGateway):
+    """
+    A gateway that sends recorded requests instead of generating them.
+    """
+
+    def __init__(self, requests, url, base_url, options, agent,
+                 clock=reactor):
+        super(Replayer, self).__init__(url, base_url, options, agent, clock)
+        self.requests = requests
+        self.sessions = group_sessions(requests)
+        self.lags = []
+
+    @inlineCallbacks
+    def replay_session(self, requests, origin, start):
+        completed = True
+        for request in requests:
+            if self.options.speed > 0:
+                due = start + (request.timestamp - origin) / self.options.speed
+                delay = due - time.time()
+                if delay > 0:
+                    yield sleep(delay, self.clock)
+                self.lags.append(max(time.time() - due, 0))
+            body = yield self.hop(self.url, request.args)
+            completed = completed and body is not None
+        if completed:
+            self.completed_sessions += 1
+
+    def run(self):
+        if not self.requests:
+            return gatherResults([])
+        origin = self.requests[0].timestamp
+        start = time.time()
+        semaphore = DeferredSemaphore(self.options.concurrency)
+        return gatherResults([
+            semaphore.run(self.replay_session, requests, origin, start)
+            for requests in self.sessions])
+
+
+def speed(value):
+    if value == 'max':
+        return 0.0
+    value = float(value)
+    if value <= 0:
+        raise argparse.ArgumentTypeError('speed must be positive or "max"')
+    return value
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        'capture', nargs='+',
+        help='Capture files, or the capture_path they were written with.')
+    parser.add_argument(
+        '--speed', type=speed, default=1.0,
+        help='How many times faster than recorded to replay, or "max".')
+    parser.add_argument(
+        '--concurrency', type=int, default=500,
+        help='Sessions in progress at once.')
+    parser.add_argument(
+        '--app-latency', type=float, default=0.0,
+        help='Seconds the echo application takes to reply.')
+    parser.add_argument(
+        '--gateway-timeout', type=float, default=10.0,
+        help='Seconds the gateway waits for a reply.')
+    parser.add_argument('--end-input', default='0')
+    parser.add_argument(
+        '--transport-config', type=json.loads, default={},
+        help='JSON object of extra transport config.')
+    parser.add_argument(
+        '-o', '--output', help='Write the results as JSON to this file.')
+    return parser.parse_args(argv)
+
+
+def find_files(paths):
+    files = []
+    for path in paths:
+        files.extend(capture_files(path) or [path])
+    return files
+
+
+@inlineCallbacks
+def run_replay(options, requests, clock=reactor):
+    """
+    Replay ``requests`` and return the load test's results dict with the
+    recorded latencies and, when pacing, how late requests were sent.
+    """
+    options.sessions = len(group_sessions(requests))
+    gateways = []
+
+    def make_gateway(*args):
+        gateways.append(Replayer(requests, *args))
+        return gateways[0]
+
+    results = yield run_load(options, clock, make_gateway)
+    results['requests'] = len(requests)
+    results['recorded_latency_ms'] = latency_summary(
+        [r.latency for r in requests if r.latency is not None])
+    if options.speed > 0:
+        results['lag_ms'] = latency_summary(gateways[0].lags)
+    returnValue(results)
+
+
+@inlineCallbacks
+def main(reactor, *argv):
+    options = parse_args(argv)
+    requests = load_requests(find_files(options.capture))
+    discard_logs()
+    results = yield run_replay(options, requests)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,293 @@
+"""
+Throughput of several transport processes sharing one port.
+
+For each process count in ``--processes``, starts that many worker
+processes, each running an ``AatUssdTransport`` listening on the same
+port with ``SO_REUSEPORT`` and an echo application on its own in-memory
+broker. ``--gateway-processes`` fake AAT gateways then split the
+sessions between them and drive the workers over HTTP.
+
+Each worker's broker is private, so replies always reach the process
+that holds the request. ``--forward-fraction`` sends that share of the
+replies through the worker's forwarding socket anyway, so that the cost
+of forwarding replies between processes is included.
+"""
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+from zlib import crc32
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.protocol import Protocol
+from twisted.internet.stdio import StandardIO
+from twisted.web.client import Agent, HTTPConnectionPool
+
+from vumi.config import ConfigFloat
+from vumi.tests.fake_amqp import FakeAMQPBroker
+from vumi.tests.helpers import WorkerHelper
+
+from vxaat.benchmarks.harness import DEFAULT_CONFIG, discard_logs
+from vxaat.benchmarks.loadgen import (
+    EchoApplication, FakeGateway, latency_summary)
+from vxaat.benchmarks.processes import reserve_port, spawn
+from vxaat.ussd import AatUssdTransport
+
+
+class ScaleTransportConfig(AatUssdTransport.CONFIG_CLASS):
+    forward_fraction = ConfigFloat(
+        'The share of replies to send through the forwarding socket even '
+        'though this process holds their requests.',
+        static=True, default=0.0)
+
+
+class ScaleTransport(AatUssdTransport):
+    CONFIG_CLASS = ScaleTransportConfig
+
+    def setup_transport(self):
+        self.forward_per_mille = int(
+            self.get_static_config().forward_fraction * 1000)
+        return super(ScaleTransport, self).setup_transport()
+
+    def handle_outbound_message(self, message):
+        if (crc32(message['message_id'].encode('utf-8')) % 1000 <
+                self.forward_per_mille):
+            return self.forward_reply(self.worker_id, message)
+        return super(ScaleTransport, self).handle_outbound_message(message)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--processes', default='1,2,4',
+        help='Comma separated numbers of worker processes to try.')
+    parser.add_argument(
+        '--gateway-processes', type=int, default=2,
+        help='Fake gateway processes generating load.')
+    parser.add_argument(
+        '--forward-fraction', type=float, default=0.0,
+        help='Share of replies to forward between processes.')
+    parser.add_argument(
+        '--sessions', type=int, default=2000, help='Sessions to run.')
+    parser.add_argument(
+        '--concurrency', type=int, default=200,
+        help='Sessions in progress at once, across all gateways.')
+    parser.add_argument(
+        '--depth', type=int, default=3, help='Requests per session.')
+    parser.add_argument(
+        '--think-time', type=float, default=0.0,
+        help='Seconds the user takes between hops.')
+    parser.add_argument(
+        '--app-latency', type=float, default=0.0,
+        help='Seconds the echo application takes to reply.')
+    parser.add_argument(
+        '--gateway-timeout', type=float, default=10.0,
+        help='Seconds the gateway waits for a reply.')
+    parser.add_argument('--ussd-code', default='*1234#')
+    parser.add_argument('--provider', default='MTN')
+    parser.add_argument('--end-input', default='0')
+    parser.add_argument(
+        '--transport-config', type=json.loads, default={},
+        help='JSON object of extra transport config.')
+    parser.add_argument(
+        '-o', '--output', help='Write the results as JSON to this file.')
+    # Used to start the child processes
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--gateway', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--socket-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--first', type=int, default=0,
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+class _StdinClosed(Protocol):
+    def __init__(self):
+        self.closed = Deferred()
+
+    def connectionLost(self, reason):
+        self.closed.callback(None)
+
+
+@inlineCallbacks
+def run_worker(options):
+    """
+    Run a transport and an echo application until stdin is closed, then
+    write their counts to stdout.
+    """
+    broker = FakeAMQPBroker()
+    config = dict(DEFAULT_CONFIG)
+    config.update(options.transport_config)
+    config.update({
+        'web_port': options.port,
+        'reuse_port': True,
+        'worker_id': options.worker,
+        'forwarding_socket_dir': options.socket_dir,
+        'forward_fraction': options.forward_fraction,
+    })
+    transport = WorkerHelper.get_worker_raw(ScaleTransport, config, broker)
+    yield transport.startWorker()
+    app = WorkerHelper.get_worker_raw(EchoApplication, {
+        'transport_name': config['transport_name'],
+        'app_latency': options.app_latency,
+        'end_input': options.end_input,
+    }, broker)
+    yield app.startWorker()
+    trim_task = task.LoopingCall(broker.dispatched.clear)
+    trim_task.start(1.0)
+
+    stdin = _StdinClosed()
+    StandardIO(stdin)
+    sys.stdout.write('ready\n')
+    sys.stdout.flush()
+    yield stdin.closed
+
+    trim_task.stop()
+    forwarded = transport.forwarder.forwarded
+    yield app.stopWorker()
+    yield transport.stopWorker()
+    json.dump({
+        'worker': options.worker,
+        'acks': app.acks,
+        'nacks': app.nacks,
+        'forwarded': forwarded,
+    }, sys.stdout)
+    sys.stdout.flush()
+
+
+@inlineCallbacks
+def run_gateway(options):
+    """
+    Run ``--sessions`` sessions against the workers' port and write the
+    results to stdout.
+    """
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = options.concurrency
+    gateway = FakeGateway(
+        'http://127.0.0.1:%d%s' % (options.port, DEFAULT_CONFIG['web_path']),
+        DEFAULT_CONFIG['base_url'], options, Agent(reactor, pool=pool))
+    start = reactor.seconds()
+    yield gateway.run(options.first)
+    duration = reactor.seconds() - start
+    yield pool.closeCachedConnections()
+    json.dump({
+        'duration': duration,
+        'hops': gateway.hops,
+        'completed_sessions': gateway.completed_sessions,
+        'timeouts': gateway.timeouts,
+        'http_errors': gateway.http_errors,
+        'latencies': gateway.latencies,
+    }, sys.stdout)
+    sys.stdout.flush()
+
+
+def _spawn(argv, *extra):
+    return spawn(
+        [sys.executable, '-m', 'vxaat.benchmarks.scale'] + list(argv) +
+        list(extra))
+
+
+def _split(total, parts):
+    return [total // parts + (1 if i < total % parts else 0)
+            for i in range(parts)]
+
+
+def run_processes(argv, options, processes):
+    """
+    Run the load against ``processes`` workers and return a results dict.
+    """
+    reserved = reserve_port()
+    port = reserved.getsockname()[1]
+    socket_dir = tempfile.mkdtemp()
+    workers = []
+    try:
+        for i in range(processes):
+            workers.append(_spawn(
+                argv, '--worker', 'w%d' % (i,), '--port', port,
+                '--socket-dir', socket_dir))
+        for worker in workers:
+            if worker.stdout.readline().strip() != b'ready':
+                raise RuntimeError('A worker process failed to start.')
+
+        gateways = []
+        first = 0
+        sessions = _split(options.sessions, options.gateway_processes)
+        concurrency = _split(options.concurrency, options.gateway_processes)
+        for count, limit in zip(sessions, concurrency):
+            gateways.append(_spawn(
+                argv, '--gateway', '--port', port, '--first', first,
+                '--sessions', count, '--concurrency', max(limit, 1)))
+            first += count
+        gateway_results = [
+            json.loads(gateway.communicate()[0]) for gateway in gateways]
+    finally:
+        worker_results = []
+        for worker in workers:
+            output = worker.communicate()[0]
+            if output:
+                worker_results.append(json.loads(output))
+        reserved.close()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+    duration = max(result['duration'] for result in gateway_results)
+    hops = sum(result['hops'] for result in gateway_results)
+    latencies = []
+    for result in gateway_results:
+        latencies.extend(result['latencies'])
+    return {
+        'processes': processes,
+        'sessions': options.sessions,
+        'completed_sessions': sum(
+            result['completed_sessions'] for result in gateway_results),
+        'hops': hops,
+        'duration': duration,
+        'hops_per_sec': hops / duration if duration else None,
+        'latency_ms': latency_summary(latencies),
+        'timeouts': sum(result['timeouts'] for result in gateway_results),
+        'http_errors': sum(
+            result['http_errors'] for result in gateway_results),
+        'acks': sum(result['acks'] for result in worker_results),
+        'nacks': sum(result['nacks'] for result in worker_results),
+        'forwarded': sum(result['forwarded'] for result in worker_results),
+    }
+
+
+def run_scale(argv, options):
+    results = []
+    for processes in [int(n) for n in options.processes.split(',')]:
+        result = run_processes(argv, options, processes)
+        if results and results[0]['hops_per_sec']:
+            result['speedup'] = (
+                result['hops_per_sec'] / results[0]['hops_per_sec'])
+        else:
+            result['speedup'] = 1.0
+        results.append(result)
+    return results
+
+
+def main(argv=None, out=sys.stdout):
+    if argv is None:
+        argv = sys.argv[1:]
+    options = parse_args(argv)
+    if options.worker or options.gateway:
+        discard_logs()
+        task.react(
+            lambda reactor: (run_worker if options.worker else run_gateway)(
+                options))
+    results = run_scale(argv, options)
+    for result in results:
+        out.write(
+            '%(processes)2d processes: %(hops_per_sec)10.1f hops/s '
+            '(x%(speedup).2f), %(timeouts)d timeouts, '
+            '%(forwarded)d forwarded\n' % result)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+"""
+Soak test: pushes many simulated USSD sessions through an
+``AatUssdTransport``, with the gateway hanging up on some requests and the
+application never answering others, and checks that the transport's
+memory returns to where it started once they are all over.
+
+The transport runs in-process with a fake clock and fake requests and
+without a message broker, as in the other benchmarks, so that millions of
+requests take minutes. The gateway sends ``--rate`` requests per second of
+fake time and the application answers the rest at once; a hung up request
+is still answered, after the gateway has gone.
+
+Memory is measured with ``tracemalloc`` where it is available (``--frames``
+sets how much of each allocation's traceback to keep) and otherwise
+estimated from the objects the garbage collector tracks. The results
+include the memory held per outstanding request, the memory left behind
+per inbound message and the sites that grew the most. The exit code is
+non-zero if memory grew by more than ``--max-growth`` bytes.
+"""
+import argparse
+import itertools
+import json
+import sys
+from random import Random
+
+from twisted.internet.task import Clock
+
+from vxaat.benchmarks.harness import (
+    FakeRequest, discard_logs, make_transport, teardown_transport)
+from vxaat.memory import (
+    MemorySnapshot, start_tracing, stop_tracing, tracemalloc)
+
+
+DEFAULT_TRANSPORT_CONFIG = {
+    'request_timeout': 30,
+    'session_idle_timeout': 60,
+}
+
+
+class SoakGateway(object):
+    """
+    Plays both the AAT gateway and the application for a transport made
+    by :func:`~vxaat.benchmarks.harness.make_transport`.
+    """
+
+    def __init__(self, transport, clock, options):
+        self.transport = transport
+        self.clock = clock
+        self.options = options
+        self.connector = transport.connectors[transport.transport_name]
+        self.random = Random(options.seed)
+        self.tick = 1.0 / options.rate
+        self._ids = itertools.count()
+        self._sessions = itertools.count()
+        self.requests = 0
+        self.abandoned = 0
+        self.unanswered = 0
+        self.max_outstanding = 0
+
+    def send(self, args):
+        """
+        Send a request and return it, with the message the transport
+        published for it or ``None`` if the transport answered it itself.
+        """
+        message_id = 'soak-%d' % (next(self._ids),)
+        request = FakeRequest(args)
+        inbound_count = self.connector.inbound_count
+        self.transport.set_request(message_id, request)
+        self.transport.handle_raw_inbound_message(message_id, request)
+        self.requests += 1
+        if self.requests % 1000 == 0:
+            self.max_outstanding = max(
+                self.max_outstanding, len(self.transport._requests))
+        self.clock.advance(self.tick)
+        if self.connector.inbound_count == inbound_count:
+            return request, None
+        return request, self.connector.last_inbound
+
+    def run_session(self):
+        options = self.options
+        index = next(self._sessions)
+        args = {
+            'msisdn': ['2770%07d' % (index % 10 ** 7,)],
+            'provider': [options.provider],
+            'ussdSessionId': ['soak-%d' % (index,)],
+            'request': [options.ussd_code],
+        }
+        for hop in range(options.depth):
+            if hop > 0:
+                args['request'] = ['1']
+                args['to_addr'] = [options.ussd_code]
+            request, message = self.send(args)
+            if message is None:
+                return
+            fate = self.random.random()
+            if fate < options.abandon_rate:
+                self.abandoned += 1
+                request.lose_connection()
+                self.reply(message, False)
+                return
+            if fate < options.abandon_rate + options.unanswered_rate:
+                self.unanswered += 1
+                return
+            self.reply(message, hop < options.depth - 1)
+
+    def reply(self, message, continue_session):
+        self.transport.handle_outbound_message(message.reply(
+            u'You said: %s' % (message['content'] or message['to_addr'],),
+            continue_session))
+
+    def run(self, sessions):
+        for _ in range(sessions):
+            self.run_session()
+
+    def open_requests(self, number):
+        """
+        Send ``number`` requests that are left unanswered.
+        """
+        return [self.send({
+            'msisdn': ['2771%07d' % (i,)],
+            'provider': [self.options.provider],
+            'ussdSessionId': ['soak-open-%d' % (i,)],
+            'request': [self.options.ussd_code],
+        }) for i in range(number)]
+
+
+def settle_time(transport):
+    """
+    Fake seconds after which every request has timed out and every
+    session, duplicate and page has expired.
+    """
+    config = transport.get_static_config()
+    times = [
+        config.request_timeout + config.request_cleanup_interval,
+        config.session_idle_timeout, config.dedup_window,
+        config.reply_deadline]
+    if transport.page_cache is not None:
+        times.append(config.page_cache_ttl)
+    return 1 + max(times)
+
+
+def settle(transport, clock):
+    for _ in range(int(settle_time(transport))):
+        clock.advance(1)
+    # Expired entries are only dropped as these caches are used, and are
+    # bounded by their sizes rather than leaked.
+    if transport.dedup is not None:
+        transport.dedup.expire()
+    if transport.page_cache is not None:
+        transport.page_cache.expire()
+
+
+def run_soak(options):
+    """
+    Run the soak test and return a results dict.
+    """
+    config = dict(DEFAULT_TRANSPORT_CONFIG)
+    config.update(options.transport_config)
+    clock = Clock()
+    transport = make_transport(config, clock=clock)
+    gateway = SoakGateway(transport, clock, options)
+    try:
+        gateway.run(options.warmup)
+        settle(transport, clock)
+        baseline = MemorySnapshot.take()
+
+        opened = gateway.open_requests(options.probe)
+        probed = MemorySnapshot.take()
+        del opened
+        settle(transport, clock)
+
+        requests = gateway.requests
+        inbound_count = gateway.connector.inbound_count
+        gateway.run(options.sessions)
+        requests = gateway.requests - requests
+        messages = gateway.connector.inbound_count - inbound_count
+        outstanding = len(transport._requests)
+        loaded = MemorySnapshot.take()
+        settle(transport, clock)
+        final = MemorySnapshot.take()
+    finally:
+        teardown_transport(transport)
+
+    growth = final.total - baseline.total
+    return {
+        'memory': final.kind,
+        'sessions': options.sessions,
+        'requests': requests,
+        'messages': messages,
+        'abandoned': gateway.abandoned,
+        'unanswered': gateway.unanswered,
+        'max_outstanding': gateway.max_outstanding,
+        'outstanding_at_end': outstanding,
+        'baseline_bytes': baseline.total,
+        'loaded_bytes': loaded.total,
+        'final_bytes': final.total,
+        'growth_bytes': growth,
+        'bytes_per_outstanding_request': (
+            float(probed.total - baseline.total) / options.probe
+            if options.probe else None),
+        'bytes_per_message': float(growth) / messages if messages else None,
+        'top_growth': final.compare(baseline, options.top),
+        'top_loaded': loaded.compare(baseline, options.top),
+        'passed': growth <= options.max_growth,
+    }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--sessions', type=int, default=100000, help='Sessions to run.')
+    parser.add_argument(
+        '--warmup', type=int, default=20000,
+        help='Sessions to run before the baseline is taken, to fill the '
+             "transport's caches.")
+    parser.add_argument(
+        '--depth', type=int, default=3, help='Requests per session.')
+    parser.add_argument(
+        '--rate', type=float, default=500.0,
+        help='Requests per second of fake time.')
+    parser.add_argument(
+        '--abandon-rate', type=float, default=0.05,
+        help='Share of requests the gateway hangs up on.')
+    parser.add_argument(
+        '--unanswered-rate', type=float, default=0.01,
+        help='Share of requests the application never answers.')
+    parser.add_argument(
+        '--probe', type=int, default=10000,
+        help='Unanswered requests to measure the memory each holds with.')
+    parser.add_argument(
+        '--max-growth', type=int, default=256 * 1024,
+        help='Bytes memory may grow by before the test fails.')
+    parser.add_argument(
+        '--top', type=int, default=10, help='Sites that grew to report.')
+    parser.add_argument(
+        '--frames', type=int, default=1,
+        help='Frames of each allocation traceback tracemalloc keeps.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ussd-code', default='*1234#')
+    parser.add_argument('--provider', default='MTN')
+    parser.add_argument(
+        '--transport-config', type=json.loads, default={},
+        help='JSON object of extra transport config.')
+    parser.add_argument(
+        '-o', '--output', help='Write the results as JSON to this file.')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = parse_args(argv)
+    discard_logs()
+    started = tracemalloc is not None and start_tracing(options.frames)
+    try:
+        results = run_soak(options)
+    finally:
+        if started:
+            stop_tracing()
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0 if results['passed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
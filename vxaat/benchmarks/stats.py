@@ -0,0 +1,32 @@
+"""
+Summaries of benchmark measurements. This module has no dependencies, so
+that benchmarks on either Python can use it.
+"""
+import math
+
+
+def percentile(values, q):
+    """
+    The ``q``-th percentile (0-100) of the sorted sequence ``values``,
+    using the nearest-rank method.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(q / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def latency_summary(latencies):
+    """
+    Summarise a list of latencies in seconds as milliseconds.
+    """
+    values = sorted(latencies)
+    if not values:
+        return {}
+    return {
+        'p50': percentile(values, 50) * 1000,
+        'p95': percentile(values, 95) * 1000,
+        'p99': percentile(values, 99) * 1000,
+        'max': values[-1] * 1000,
+        'mean': sum(values) / len(values) * 1000,
+    }
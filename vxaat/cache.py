@@ -0,0 +1,178 @@
+# -*- test-case-name: vxaat.tests.test_cache -*-
+"""
+Small in-process caches.
+"""
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A bounded least-recently-used mapping.
+
+    :param int maxsize:
+        The maximum number of entries to keep.
+    :param int max_bytes:
+        If given, the maximum total ``sizeof(value)`` of the cached values.
+    :param sizeof:
+        Callable returning the size of a value. Defaults to ``len``.
+    """
+
+    def __init__(self, maxsize, max_bytes=None, sizeof=len):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, not %r" % (maxsize,))
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        data = self._data
+        if key not in data:
+            self.misses += 1
+            return default
+        value = data.pop(key)
+        data[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.pop(key)
+        size = 0
+        if self.max_bytes is not None:
+            size = self.sizeof(value)
+            if size > self.max_bytes:
+                # Never worth evicting everything else for.
+                return
+        data = self._data
+        data[key] = value
+        self.bytes += size
+        while len(data) > self.maxsize or (
+                self.max_bytes is not None and self.bytes > self.max_bytes):
+            self._evict()
+
+    def pop(self, key, default=None):
+        if key not in self._data:
+            return default
+        value = self._data.pop(key)
+        if self.max_bytes is not None:
+            self.bytes -= self.sizeof(value)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def _evict(self):
+        _, value = self._data.popitem(last=False)
+        if self.max_bytes is not None:
+            self.bytes -= self.sizeof(value)
+        self.evictions += 1
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class TTLCache(object):
+    """
+    A bounded mapping whose entries expire ``ttl`` seconds after they were
+    last set. When full, the entry set longest ago is evicted.
+
+    Every entry lives for the same ``ttl``, so entries are kept in expiry
+    order and expired ones are dropped from the front as the cache is
+    used, without a timer.
+
+    :param clock:
+        An ``IReactorTime`` provider.
+    :param float ttl:
+        Seconds an entry lives for.
+    :param int maxsize:
+        The maximum number of entries to keep.
+    """
+
+    def __init__(self, clock, ttl, maxsize):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, not %r" % (maxsize,))
+        self.clock = clock
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        self._expire(self.clock.seconds())
+        return len(self._data)
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > self.clock.seconds()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= self.clock.seconds():
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        now = self.clock.seconds()
+        data = self._data
+        data.pop(key, None)
+        data[key] = (now + self.ttl, value)
+        self._expire(now)
+        while len(data) > self.maxsize:
+            data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None or entry[0] <= self.clock.seconds():
+            return default
+        return entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def expire(self):
+        """
+        Drop the entries that have expired. They are otherwise only
+        dropped as the cache is used.
+        """
+        self._expire(self.clock.seconds())
+
+    def _expire(self, now):
+        data = self._data
+        while data:
+            key = next(iter(data))
+            if data[key][0] > now:
+                break
+            del data[key]
+            self.expirations += 1
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
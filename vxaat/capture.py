@@ -0,0 +1,262 @@
+# -*- test-case-name: vxaat.tests.test_capture -*-
+"""
+Recording of inbound AAT requests, and their reply latencies, to compact
+binary files that can be replayed later.
+
+A capture file starts with :data:`MAGIC` and is followed by records:
+
+* a request: ``b'Q'``, the request's sequence number (uint32), its arrival
+  time (float64) and the number of arguments (uint16), then for each
+  argument the lengths of its name (uint8) and first value (uint16)
+  followed by the name and value;
+* a reply: ``b'A'``, the sequence number of the request (uint32), the
+  seconds it took to answer (float64) and the HTTP status code (uint16).
+
+All numbers are little-endian. Sequence numbers continue across the
+files a writer rotates through, so a reply may be in a later file than
+its request. Files from before the argument count was widened start with
+:data:`MAGIC_V1` and count arguments in a uint8; they can still be read.
+"""
+import mmap
+import os
+import struct
+from itertools import count
+
+
+MAGIC = b'VXAATCAP\x02'
+MAGIC_V1 = b'VXAATCAP\x01'
+
+REQUEST = b'Q'
+REPLY = b'A'
+
+_REQUEST_HEADER = struct.Struct('<cIdH')
+_REQUEST_HEADER_V1 = struct.Struct('<cIdB')
+_ARG_HEADER = struct.Struct('<BH')
+_REPLY = struct.Struct('<cIdH')
+
+
+class CaptureError(Exception):
+    """
+    Raised for a file that is not a capture.
+    """
+
+
+class CaptureWriter(object):
+    """
+    Appends requests and replies to capture files named ``<path>.<n>``,
+    starting a new file before one would grow past ``max_bytes``.
+
+    Records are buffered in memory and only written by :meth:`flush`.
+    Once ``buffer_bytes`` are buffered a flush is scheduled on ``clock``
+    if one is given, so recording a request does not touch the disk, and
+    otherwise made at once.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024,
+                 buffer_bytes=64 * 1024, clock=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.buffer_bytes = buffer_bytes
+        self.clock = clock
+        self._flush_call = None
+        self.files = []
+        self._file = None
+        self._written = 0
+        self._buffer = []
+        self._buffered = 0
+        self._pending = {}
+        self._seq = count()
+        self._index = 0
+
+    def request(self, request_id, timestamp, args):
+        """
+        Record a request's arguments, which are in the form of
+        ``request.args``.
+        """
+        seq = next(self._seq) & 0xFFFFFFFF
+        # Requests are recorded before they are validated, so anything
+        # past what the format can count is left out.
+        args = list(args.items())[:0xFFFF]
+        parts = [_REQUEST_HEADER.pack(REQUEST, seq, timestamp, len(args))]
+        for name, values in args:
+            name = _to_bytes(name)[:0xFF]
+            value = _to_bytes(values[0])[:0xFFFF]
+            parts.append(_ARG_HEADER.pack(len(name), len(value)))
+            parts.append(name)
+            parts.append(value)
+        self._pending[request_id] = (seq, timestamp)
+        self._append(b''.join(parts))
+
+    def reply(self, request_id, timestamp, code):
+        """
+        Record that a request was answered. Requests that were not
+        recorded are ignored.
+        """
+        pending = self._pending.pop(request_id, None)
+        if pending is not None:
+            seq, started = pending
+            self._append(_REPLY.pack(REPLY, seq, timestamp - started, code))
+
+    def forget(self, request_id):
+        """
+        Stop waiting for the reply to a request that will not get one.
+        """
+        self._pending.pop(request_id, None)
+
+    def _append(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered < self.buffer_bytes:
+            return
+        if self.clock is None:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(0, self.flush)
+
+    def flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if not self._buffer:
+            return
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self._file is None or (
+                self._written > len(MAGIC) and
+                self._written + len(data) > self.max_bytes):
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self._written += len(data)
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        while os.path.exists('%s.%d' % (self.path, self._index)):
+            self._index += 1
+        filename = '%s.%d' % (self.path, self._index)
+        self._file = open(filename, 'wb')
+        self._file.write(MAGIC)
+        self._written = len(MAGIC)
+        self.files.append(filename)
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def capture_files(path):
+    """
+    The capture files a writer created for ``path``, in the order they
+    were written.
+    """
+    directory, prefix = os.path.split(path)
+    files = []
+    for name in os.listdir(directory or '.'):
+        suffix = name[len(prefix) + 1:]
+        if name.startswith(prefix + '.') and suffix.isdigit():
+            files.append((int(suffix), os.path.join(directory, name)))
+    return [filename for _, filename in sorted(files)]
+
+
+def read_records(filename):
+    """
+    Yield the records in a capture file as ``(REQUEST, seq, timestamp,
+    args)`` and ``(REPLY, seq, latency, code)`` tuples, where ``args`` is
+    a dict of byte strings. A record cut short at the end of the file is
+    ignored.
+    """
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < len(MAGIC):
+            raise CaptureError('%s is not a capture file' % (filename,))
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic = data[:len(MAGIC)]
+        if magic == MAGIC:
+            header = _REQUEST_HEADER
+        elif magic == MAGIC_V1:
+            header = _REQUEST_HEADER_V1
+        else:
+            raise CaptureError('%s is not a capture file' % (filename,))
+        offset = len(MAGIC)
+        size = len(data)
+        while offset < size:
+            kind = data[offset:offset + 1]
+            if kind == REPLY:
+                if offset + _REPLY.size > size:
+                    return
+                _, seq, latency, code = _REPLY.unpack_from(data, offset)
+                offset += _REPLY.size
+                yield (REPLY, seq, latency, code)
+            elif kind == REQUEST:
+                record = _read_request(data, offset, size, header)
+                if record is None:
+                    return
+                offset, seq, timestamp, args = record
+                yield (REQUEST, seq, timestamp, args)
+            else:
+                raise CaptureError(
+                    'Unknown record %r at offset %d of %s'
+                    % (kind, offset, filename))
+    finally:
+        data.close()
+
+
+def _read_request(data, offset, size, header):
+    if offset + header.size > size:
+        return None
+    _, seq, timestamp, nargs = header.unpack_from(data, offset)
+    offset += header.size
+    args = {}
+    for _ in range(nargs):
+        if offset + _ARG_HEADER.size > size:
+            return None
+        name_len, value_len = _ARG_HEADER.unpack_from(data, offset)
+        offset += _ARG_HEADER.size
+        end = offset + name_len + value_len
+        if end > size:
+            return None
+        args[data[offset:offset + name_len]] = data[offset + name_len:end]
+        offset = end
+    return offset, seq, timestamp, args
+
+
+class CapturedRequest(object):
+    __slots__ = ('timestamp', 'args', 'latency', 'code')
+
+    def __init__(self, timestamp, args, latency=None, code=None):
+        self.timestamp = timestamp
+        self.args = args
+        self.latency = latency
+        self.code = code
+
+
+def load_requests(filenames):
+    """
+    Return the requests recorded in a writer's capture files, given in
+    the order they were written, with their reply latencies where those
+    were recorded.
+    """
+    requests = []
+    by_seq = {}
+    for filename in filenames:
+        for kind, seq, value, extra in read_records(filename):
+            if kind == REQUEST:
+                request = by_seq[seq] = CapturedRequest(value, extra)
+                requests.append(request)
+            else:
+                request = by_seq.pop(seq, None)
+                if request is not None:
+                    request.latency = value
+                    request.code = extra
+    return requests
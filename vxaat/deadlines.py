@@ -0,0 +1,88 @@
+# -*- test-case-name: vxaat.tests.test_deadlines -*-
+"""
+Deadlines for many outstanding items, driven by a single timer.
+"""
+import heapq
+from itertools import count
+
+
+class DeadlineQueue(object):
+    """
+    Calls ``expired(key)`` once the deadline scheduled for ``key`` passes.
+
+    Deadlines live in a heap, so scheduling and expiring cost O(log n).
+    Cancelled or rescheduled entries are left in the heap and skipped when
+    they reach the top. Only one ``DelayedCall`` is ever pending, for the
+    earliest deadline.
+
+    :param clock:
+        An ``IReactorTime`` provider.
+    :param expired:
+        Called with the key of each item whose deadline has passed.
+    """
+
+    def __init__(self, clock, expired):
+        self.clock = clock
+        self.expired = expired
+        self._heap = []
+        self._deadlines = {}
+        self._counter = count()
+        self._timer = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def schedule(self, key, deadline):
+        """
+        Set the deadline for ``key`` to the absolute time ``deadline``,
+        replacing any earlier deadline for it.
+        """
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+        if self._timer is None:
+            self._timer = self.clock.callLater(
+                max(0, deadline - self.clock.seconds()), self._expire)
+        elif deadline < self._timer.getTime():
+            self._timer.reset(max(0, deadline - self.clock.seconds()))
+
+    def cancel(self, key):
+        """
+        Forget the deadline for ``key``, if it has one.
+        """
+        self._deadlines.pop(key, None)
+        if not self._deadlines:
+            del self._heap[:]
+            self.stop()
+
+    def stop(self):
+        """
+        Stop the timer. Pending deadlines do not expire until the next call
+        to :meth:`schedule` starts it again.
+        """
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+
+    def _expire(self):
+        self._timer = None
+        now = self.clock.seconds()
+        heap = self._heap
+        deadlines = self._deadlines
+        while heap and heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(heap)
+            if deadlines.get(key) == deadline:
+                del deadlines[key]
+                self.expired(key)
+        # Drop stale entries so that the timer is set for a live deadline.
+        while heap and deadlines.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+        if heap:
+            delay = max(0, heap[0][0] - now)
+            if self._timer is None:
+                self._timer = self.clock.callLater(delay, self._expire)
+            elif heap[0][0] < self._timer.getTime():
+                self._timer.reset(delay)
@@ -0,0 +1,92 @@
+# -*- test-case-name: vxaat.tests.test_dedup -*-
+"""
+Suppression of requests the AAT gateway retries.
+"""
+from vxaat.cache import TTLCache
+
+
+class Deduplicator(object):
+    """
+    Tracks requests by a key identifying a session hop.
+
+    A request whose key matches one still in flight is attached to it and
+    answered with the same reply. A request whose key matches one
+    answered successfully within the last ``window`` seconds is answered
+    with the stored reply. Counts of both are kept in :attr:`suppressed`.
+
+    :param clock:
+        An ``IReactorTime`` provider.
+    :param float window:
+        How long to keep successful replies for.
+    :param int maxsize:
+        The most replies to keep.
+    """
+
+    def __init__(self, clock, window, maxsize):
+        self.suppressed = {'attached': 0, 'replayed': 0}
+        self._replies = TTLCache(clock, window, maxsize)
+        self._in_flight = {}
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def attach(self, key, request_id):
+        """
+        Attach the request to one in flight with the same key, if there is
+        one, and return whether it was.
+        """
+        waiters = self._in_flight.get(key)
+        if waiters is None:
+            return False
+        waiters.append(request_id)
+        self.suppressed['attached'] += 1
+        return True
+
+    def replay(self, key):
+        """
+        Return the stored reply for the key, or ``None``.
+        """
+        reply = self._replies.get(key)
+        if reply is not None:
+            self.suppressed['replayed'] += 1
+        return reply
+
+    def expire(self):
+        """
+        Drop the stored replies that are too old to replay.
+        """
+        self._replies.expire()
+
+    def cache_stats(self):
+        """
+        Return the size and counters of the stored replies.
+        """
+        return self._replies.stats()
+
+    def register(self, key, request_id):
+        self._in_flight[key] = []
+        self._keys[request_id] = key
+
+    def finished(self, request_id, data, store=True):
+        """
+        Record the reply to a request and return the ids of the requests
+        attached to it. The reply is only kept for replay if ``store``.
+        """
+        key = self._keys.pop(request_id, None)
+        if key is None:
+            return []
+        waiters = self._in_flight.pop(key)
+        if store:
+            self._replies.set(key, data)
+        return waiters
+
+    def lost(self, request_id):
+        """
+        Forget a request whose connection was lost and return the ids of
+        the requests attached to it, which nothing will now answer.
+        """
+        key = self._keys.pop(request_id, None)
+        if key is None:
+            return []
+        return self._in_flight.pop(key)
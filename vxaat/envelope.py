@@ -0,0 +1,65 @@
+# -*- test-case-name: vxaat.tests.test_envelope -*-
+"""
+The AAT fields of the messages the transport publishes, and how to read
+them whichever envelope a message was published in.
+
+A full envelope carries the provider at the top level of the message and
+in ``transport_metadata['aat_ussd']``, and the USSD session id in both
+``transport_metadata['aat_ussd']`` and ``helper_metadata``. A compact
+envelope carries each once: the provider at the top level and the session
+id, if there is one, in ``transport_metadata['aat_ussd']``.
+"""
+
+
+def aat_metadata(provider, ussd_session_id, worker_id=None, compact=False):
+    """
+    The transport's ``transport_metadata['aat_ussd']`` for a message.
+    """
+    metadata = {}
+    if not compact:
+        metadata['provider'] = provider
+    if ussd_session_id is not None or not compact:
+        metadata['ussd_session_id'] = ussd_session_id
+    if worker_id:
+        metadata['worker'] = worker_id
+    return metadata
+
+
+def helper_metadata(ussd_session_id, compact=False):
+    if compact:
+        return {}
+    return {'session_id': ussd_session_id}
+
+
+def get_provider(message):
+    """
+    The message's provider, from either envelope.
+    """
+    provider = message.get('provider')
+    if provider is None:
+        provider = message['transport_metadata'].get(
+            'aat_ussd', {}).get('provider')
+    return provider
+
+
+def get_ussd_session_id(message):
+    """
+    The message's USSD session id, from either envelope.
+    """
+    metadata = message['transport_metadata'].get('aat_ussd', {})
+    if metadata.get('ussd_session_id') is not None:
+        return metadata['ussd_session_id']
+    return message['helper_metadata'].get('session_id')
+
+
+def expand(message):
+    """
+    Add the fields a compact envelope leaves out to ``message`` and return
+    it.
+    """
+    metadata = message['transport_metadata'].setdefault('aat_ussd', {})
+    metadata.setdefault('provider', message.get('provider'))
+    metadata.setdefault('ussd_session_id', get_ussd_session_id(message))
+    message['helper_metadata'].setdefault(
+        'session_id', metadata['ussd_session_id'])
+    return message
@@ -0,0 +1,99 @@
+# -*- test-case-name: vxaat.tests.test_eventlog -*-
+"""
+Structured log records for the transport's request/reply path, formatted
+only when they are written and sampled per event type.
+"""
+import json
+import re
+
+
+_BARE_VALUE = re.compile(r'^[A-Za-z0-9_.:*#+/@-]+$')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return '%.6f' % (value,)
+    if not isinstance(value, (str, type(u''))):
+        value = u'%s' % (value,)
+    if _BARE_VALUE.match(value):
+        return value
+    return json.dumps(value)
+
+
+class EventRecord(object):
+    """
+    An event name and its fields, formatted as ``event key=value ...``
+    when converted to a string. Values that are not plain words are
+    quoted as JSON strings.
+    """
+    __slots__ = ('event', 'fields')
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        return str(' '.join([self.event] + [
+            '%s=%s' % (key, format_value(value))
+            for key, value in sorted(self.fields.items())]))
+
+
+class EventLog(object):
+    """
+    Logs :class:`EventRecord` objects through Twisted-style log functions,
+    which format them only if an observer writes them out.
+
+    Events logged with :meth:`info` are sampled at the rate given for
+    them in ``sample_rates``, or ``default_rate``: a rate of ``0.1`` logs
+    every tenth event of that type. Events logged with :meth:`warning`
+    are never sampled.
+
+    :param info:
+        Called as ``info(format=..., aat_record=..., aat_event=...,
+        aat_fields=...)`` for each info record.
+    :param warning:
+        Called the same way for each warning record.
+    :param dict sample_rates:
+        Event names mapped to the share, from 0 to 1, of them to log.
+    """
+
+    def __init__(self, info, warning, sample_rates=None, default_rate=1.0):
+        self._info = info
+        self._warning = warning
+        self.default_rate = default_rate
+        self.sample_rates = {}
+        for event, rate in (sample_rates or {}).items():
+            rate = float(rate)
+            if not 0 <= rate <= 1:
+                raise ValueError(
+                    'Sample rate for %r must be between 0 and 1, not %r'
+                    % (event, rate))
+            self.sample_rates[event] = rate
+        self._credit = {}
+
+    def sample(self, event):
+        """
+        Whether to log this occurrence of ``event``.
+        """
+        rate = self.sample_rates.get(event, self.default_rate)
+        if rate >= 1:
+            return True
+        credit = self._credit.get(event, 0.0) + rate
+        # Allow for rounding, so that ten events at 0.1 log one
+        if credit >= 1 - 1e-9:
+            credit -= 1
+            self._credit[event] = credit
+            return True
+        self._credit[event] = credit
+        return False
+
+    def info(self, event, **fields):
+        if self.sample(event):
+            self._emit(self._info, event, fields)
+
+    def warning(self, event, **fields):
+        self._emit(self._warning, event, fields)
+
+    def _emit(self, log, event, fields):
+        log(format='%(aat_record)s', aat_record=EventRecord(event, fields),
+            aat_event=event, aat_fields=fields)
@@ -0,0 +1,72 @@
+# -*- test-case-name: vxaat.tests.test_events -*-
+"""
+Buffering of outgoing events so they are published in batches.
+"""
+
+
+class EventBatcher(object):
+    """
+    Buffers items and passes them to ``publish`` in the order they were
+    added, in batches.
+
+    A batch is flushed ``interval`` seconds after its first item was
+    added (on the next reactor turn if ``interval`` is ``0``), or
+    straight away once ``max_size`` items are buffered.
+
+    :param clock:
+        An ``IReactorTime`` provider.
+    :param publish:
+        Called with each item when it is flushed.
+    :param float interval:
+        How long to buffer items for.
+    :param int max_size:
+        The most items to buffer.
+    :param flushed:
+        If given, called with the size of each batch and the reason it was
+        flushed: ``timer``, ``full`` or ``stop``.
+    """
+
+    def __init__(self, clock, publish, interval=0, max_size=1000,
+                 flushed=None):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.clock = clock
+        self.publish = publish
+        self.interval = interval
+        self.max_size = max_size
+        self.flushed = flushed
+        self._buffer = []
+        self._timer = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def add(self, item):
+        self._buffer.append(item)
+        if len(self._buffer) >= self.max_size:
+            self.flush('full')
+        elif self._timer is None:
+            self._timer = self.clock.callLater(
+                self.interval, self.flush, 'timer')
+
+    def flush(self, reason='timer'):
+        """
+        Publish everything buffered and return a list of what ``publish``
+        returned for each item.
+        """
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return []
+        if self.flushed is not None:
+            self.flushed(len(batch), reason)
+        return [self.publish(item) for item in batch]
+
+    def stop(self):
+        """
+        Publish everything buffered and stop the timer.
+        """
+        return self.flush('stop')
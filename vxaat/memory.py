@@ -0,0 +1,116 @@
+# -*- test-case-name: vxaat.tests.test_memory -*-
+"""
+Snapshots of the memory a process holds, for finding out where it grows.
+"""
+import gc
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def tracing():
+    """
+    Whether ``tracemalloc`` is available and tracing allocations.
+    """
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+def start_tracing(frames=1):
+    """
+    Start ``tracemalloc``, keeping ``frames`` frames of each allocation's
+    traceback, and return whether this call started it.
+    """
+    if tracemalloc is None:
+        raise RuntimeError('tracemalloc is not available here.')
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(frames)
+    return True
+
+
+def stop_tracing():
+    if tracing():
+        tracemalloc.stop()
+
+
+def _site(traceback):
+    return '; '.join(
+        '%s:%d' % (frame.filename, frame.lineno) for frame in traceback)
+
+
+class MemorySnapshot(object):
+    """
+    The memory in use, in bytes, by allocation site if ``tracemalloc`` is
+    tracing, and otherwise by the type of the objects the garbage
+    collector tracks. The second is much rougher: it only sees container
+    objects and counts their own size, not that of the strings and
+    numbers they hold.
+    """
+
+    def __init__(self, kind, sizes, counts):
+        self.kind = kind
+        self.sizes = sizes
+        self.counts = counts
+        self.total = sum(sizes.values())
+
+    @classmethod
+    def take(cls):
+        gc.collect()
+        if tracing():
+            return cls._from_tracemalloc()
+        return cls._from_gc()
+
+    @classmethod
+    def _from_tracemalloc(cls):
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+        sizes = {}
+        counts = {}
+        for stat in snapshot.statistics('traceback'):
+            site = _site(stat.traceback)
+            sizes[site] = sizes.get(site, 0) + stat.size
+            counts[site] = counts.get(site, 0) + stat.count
+        return cls('site', sizes, counts)
+
+    @classmethod
+    def _from_gc(cls):
+        sizes = {}
+        counts = {}
+        for obj in gc.get_objects():
+            kind = type(obj)
+            name = '%s.%s' % (kind.__module__, kind.__name__)
+            sizes[name] = sizes.get(name, 0) + sys.getsizeof(obj)
+            counts[name] = counts.get(name, 0) + 1
+        return cls('type', sizes, counts)
+
+    def top(self, limit=10):
+        """
+        The ``limit`` sites, or types, holding the most memory, as dicts
+        of their ``site``, ``bytes`` and ``count``.
+        """
+        sites = sorted(self.sizes, key=lambda s: (-self.sizes[s], s))
+        return [self._row(site, self.sizes[site], self.counts[site])
+                for site in sites[:limit]]
+
+    def compare(self, older, limit=10):
+        """
+        The ``limit`` sites, or types, whose memory changed the most since
+        the ``older`` snapshot, as dicts of their ``site`` and the change
+        in ``bytes`` and ``count``.
+        """
+        changes = {}
+        for site in set(self.sizes) | set(older.sizes):
+            size = self.sizes.get(site, 0) - older.sizes.get(site, 0)
+            count = self.counts.get(site, 0) - older.counts.get(site, 0)
+            if size or count:
+                changes[site] = (size, count)
+        sites = sorted(changes, key=lambda s: (-abs(changes[s][0]), s))
+        return [self._row(site, *changes[site]) for site in sites[:limit]]
+
+    def _row(self, site, size, count):
+        return {'site': site, 'bytes': size, 'count': count}
@@ -0,0 +1,148 @@
+# -*- test-case-name: vxaat.tests.test_metrics -*-
+"""
+Metrics for the AAT USSD transport, published through vumi's
+:class:`~vumi.blinkenlights.metrics.MetricManager`.
+"""
+import re
+
+from vumi.blinkenlights.metrics import AVG, MAX, MIN, Count, Metric
+
+from vxaat.cache import LRUCache
+
+
+_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9_-]+')
+
+
+def metric_name_part(value):
+    """
+    Make ``value`` safe to use as one dotted component of a metric name.
+    """
+    return _UNSAFE_CHARS.sub('_', u'%s' % (value,)) or '_'
+
+
+class Histogram(object):
+    """
+    A latency distribution, published as a metric with the average,
+    minimum and maximum of the values seen and a cumulative count per
+    bucket upper bound (``<name>.le_<ms>ms``, plus ``<name>.le_inf``).
+    """
+
+    def __init__(self, manager, name, buckets):
+        self.buckets = sorted(buckets)
+        self.summary = manager.register(Metric(name, [AVG, MIN, MAX]))
+        self.counts = [
+            manager.register(Count('%s.le_%dms' % (name, bound * 1000)))
+            for bound in self.buckets]
+        self.count_inf = manager.register(Count('%s.le_inf' % (name,)))
+
+    def record(self, value):
+        self.summary.set(value)
+        for bound, count in zip(self.buckets, self.counts):
+            if value <= bound:
+                count.inc()
+        self.count_inf.inc()
+
+
+class LatencyTracker(object):
+    """
+    Times the round trip from the arrival of an AAT request to the reply
+    being written, per normalised provider and session event.
+
+    Requests that time out are remembered in a bounded cache so that the
+    eventual (failed) reply can be timed too; those latencies go to the
+    ``late_latency`` histograms.
+    """
+
+    def __init__(self, manager, clock, buckets, late_maxsize=10000):
+        self.manager = manager
+        self.clock = clock
+        self.buckets = buckets
+        self._pending = {}
+        self._late = LRUCache(late_maxsize)
+        self._histograms = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self, message_id, provider, session_event):
+        self._pending[message_id] = (
+            self.clock.seconds(), provider, session_event)
+
+    def expire(self, message_id):
+        """
+        The request for ``message_id`` was closed without a reply.
+        """
+        started = self._pending.pop(message_id, None)
+        if started is not None:
+            self._late.set(message_id, started)
+
+    def finish(self, message_id):
+        """
+        Record the latency of a reply that was written to its request.
+        """
+        started = self._pending.pop(message_id, None)
+        if started is not None:
+            self._record('latency', started)
+
+    def finish_late(self, message_id):
+        """
+        Record the latency of a reply whose request had already gone.
+        """
+        started = self._pending.pop(message_id, None)
+        if started is None:
+            started = self._late.pop(message_id)
+        if started is not None:
+            self._record('late_latency', started)
+
+    def histogram(self, kind, provider, session_event):
+        # Keyed by name, since different values can make the same one
+        name = '%s.%s.%s' % (
+            kind, metric_name_part(provider), metric_name_part(session_event))
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram(
+                self.manager, name, self.buckets)
+        return histogram
+
+    def _record(self, kind, started):
+        timestamp, provider, session_event = started
+        self.histogram(kind, provider, session_event).record(
+            self.clock.seconds() - timestamp)
+
+
+class Counters(object):
+    """
+    Counts named ``<prefix>.<key>``, registered the first time each key is
+    counted.
+    """
+
+    def __init__(self, manager, prefix):
+        self.manager = manager
+        self.prefix = prefix
+        self._counts = {}
+
+    def inc(self, key):
+        name = '%s.%s' % (self.prefix, metric_name_part(key))
+        count = self._counts.get(name)
+        if count is None:
+            count = self._counts[name] = self.manager.register(Count(name))
+        count.inc()
+
+
+class SessionMetrics(object):
+    """
+    Hops per session and session duration, recorded when a session ends,
+    and a count of ended sessions per reason (``session.ended.<reason>``).
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.hops = manager.register(Metric('session.hops', [AVG, MAX]))
+        self.duration = manager.register(
+            Metric('session.duration', [AVG, MAX]))
+        self.ended = Counters(manager, 'session.ended')
+
+    def record(self, record, now, reason):
+        self.hops.set(record.hops)
+        self.duration.set(now - record.started)
+        self.ended.inc(reason)
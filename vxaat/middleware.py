@@ -0,0 +1,22 @@
+# -*- test-case-name: vxaat.tests.test_middleware -*-
+"""
+Middleware for the workers that consume the transport's messages.
+"""
+from vumi.middleware.base import BaseMiddleware
+
+from vxaat.envelope import expand
+
+
+class ExpandEnvelopeMiddleware(BaseMiddleware):
+    """
+    Restores the fields compact envelopes leave out of inbound messages,
+    for applications that read the provider or USSD session id from the
+    places full envelopes put them. Add it to the application's
+    ``middleware`` config::
+
+        middleware:
+          - expand_envelope: vxaat.middleware.ExpandEnvelopeMiddleware
+    """
+
+    def handle_inbound(self, message, connector_name):
+        return expand(message)
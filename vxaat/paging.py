@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# -*- test-case-name: vxaat.tests.test_paging -*-
+"""
+Splitting of long USSD replies into pages that fit a screen.
+
+Budgets are in octets. Text that only uses the GSM 03.38 default alphabet
+is encoded in 7 bit septets, with characters from the extension table
+taking two septets. Anything else is sent as UCS-2, at two octets per
+UTF-16 code unit.
+"""
+
+GSM7_BASIC = frozenset(
+    u'@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    u'¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+GSM7_EXTENDED = frozenset(u'\f^{}\\[~]|€')
+
+# The smallest budget that fits any one character: a surrogate pair in
+# UCS-2.
+MIN_BUDGET = 4
+
+
+def is_gsm7(text):
+    """
+    Whether ``text`` can be encoded in the GSM 03.38 alphabet.
+    """
+    for char in text:
+        if char not in GSM7_BASIC and char not in GSM7_EXTENDED:
+            return False
+    return True
+
+
+def gsm7_cost(char):
+    return 2 if char in GSM7_EXTENDED else 1
+
+
+def ucs2_cost(char):
+    # Characters outside the BMP are a surrogate pair in UTF-16.
+    return 2 if ord(char) > 0xFFFF else 1
+
+
+def capacity(text, budget):
+    """
+    Return the cost function for ``text`` and how many units of it fit in
+    ``budget`` octets.
+    """
+    if is_gsm7(text):
+        return gsm7_cost, budget * 8 // 7
+    return ucs2_cost, budget // 2
+
+
+def paginate(text, budget):
+    """
+    Split ``text`` into pages that each fit in ``budget`` octets, breaking
+    at the last whitespace that fits where there is one. The whitespace a
+    page is broken at is dropped. Text that fits is returned as the only
+    page.
+
+    :raises ValueError:
+        if a character of ``text`` does not fit in ``budget`` octets.
+    """
+    cost, limit = capacity(text, budget)
+    if limit < 1:
+        raise ValueError('A budget of %r octets is too small' % (budget,))
+    pages = []
+    start = 0
+    while True:
+        used = 0
+        end = start
+        split = None
+        length = len(text)
+        while end < length:
+            char = text[end]
+            used += cost(char)
+            if used > limit:
+                if char.isspace():
+                    split = end
+                break
+            if char.isspace():
+                split = end
+            end += 1
+        if end >= length:
+            pages.append(text[start:])
+            return pages
+        if split is not None and split > start:
+            pages.append(text[start:split])
+            start = split + 1
+        elif end > start:
+            pages.append(text[start:end])
+            start = end
+        else:
+            raise ValueError('A budget of %r octets cannot fit %r' % (
+                budget, text[start]))
+
+
+class PagedReply(object):
+    """
+    The pages of a reply still to be sent, and what the last of them
+    should be sent with.
+    """
+    __slots__ = ('pages', 'to_addr', 'session_event', 'options',
+                 'ussd_session_id')
+
+    def __init__(self, pages, to_addr, session_event, options=None,
+                 ussd_session_id=None):
+        self.pages = pages
+        self.to_addr = to_addr
+        self.session_event = session_event
+        self.options = options
+        self.ussd_session_id = ussd_session_id
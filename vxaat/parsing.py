@@ -0,0 +1,87 @@
+# -*- test-case-name: vxaat.tests.test_parsing -*-
+"""
+Parsing of the query parameters of AAT USSD requests.
+"""
+
+
+# AAT parameter names and the attributes they are parsed into
+FIELD_ATTRS = {
+    'msisdn': 'msisdn',
+    'provider': 'provider',
+    'request': 'request',
+    'ussdSessionId': 'ussd_session_id',
+    'to_addr': 'to_addr',
+}
+
+
+class AatRequest(object):
+    """
+    The decoded parameters of an AAT request. Parameters that were not
+    sent are ``None``.
+    """
+    __slots__ = ('msisdn', 'provider', 'request', 'ussd_session_id',
+                 'to_addr')
+
+    def __init__(self, msisdn=None, provider=None, request=None,
+                 ussd_session_id=None, to_addr=None):
+        self.msisdn = msisdn
+        self.provider = provider
+        self.request = request
+        self.ussd_session_id = ussd_session_id
+        self.to_addr = to_addr
+
+    def __repr__(self):
+        return '<AatRequest %s>' % (' '.join(
+            '%s=%r' % (attr, getattr(self, attr)) for attr in self.__slots__),)
+
+
+class RequestParser(object):
+    """
+    Validates and decodes request arguments in a single pass.
+
+    Errors are reported in the same shape as
+    :meth:`vumi.transports.httprpc.HttpRpcTransport.get_field_values`:
+    ``unexpected_parameter`` (only if ``strict``) and ``missing_parameter``
+    lists of field names.
+
+    :param expected_fields:
+        Fields that must be present.
+    :param optional_fields:
+        Fields that may be present.
+    :param bool strict:
+        Whether fields that are neither expected nor optional are errors.
+    :param str encoding:
+        The encoding of the argument values.
+    """
+
+    def __init__(self, expected_fields, optional_fields, strict=True,
+                 encoding='utf-8'):
+        self.expected_fields = [
+            (field, FIELD_ATTRS[field]) for field in expected_fields]
+        self.attrs = dict(
+            (field, FIELD_ATTRS[field])
+            for field in set(expected_fields) | set(optional_fields))
+        self.strict = strict
+        self.encoding = encoding
+
+    def parse(self, args):
+        """
+        Parse a ``request.args`` style dict of lists of byte strings.
+
+        :returns:
+            An ``(AatRequest, errors)`` tuple, where ``errors`` is a dict
+            that is empty if the request is valid.
+        """
+        record = AatRequest()
+        errors = {}
+        attrs = self.attrs
+        for field in args:
+            attr = attrs.get(field)
+            if attr is not None:
+                setattr(record, attr, args[field][0].decode(self.encoding))
+            elif self.strict:
+                errors.setdefault('unexpected_parameter', []).append(field)
+        for field, attr in self.expected_fields:
+            if getattr(record, attr) is None:
+                errors.setdefault('missing_parameter', []).append(field)
+        return record, errors
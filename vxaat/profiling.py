@@ -0,0 +1,156 @@
+# -*- test-case-name: vxaat.tests.test_profiling -*-
+"""
+Finding out where a thread spends its time: call timings for chosen
+functions, cProfile sessions and a stack sampler producing collapsed
+stacks.
+"""
+import cProfile
+import marshal
+import pstats
+import sys
+import threading
+from functools import wraps
+from io import BytesIO, StringIO
+from timeit import default_timer
+
+
+class FunctionTimes(object):
+    """
+    Counts the calls to, and time spent in, wrapped functions.
+    """
+
+    def __init__(self, timer=default_timer):
+        self.timer = timer
+        self._stats = {}
+
+    def wrap(self, name, func):
+        stats = self._stats[name] = [0, 0.0, 0.0]
+        timer = self.timer
+
+        @wraps(func)
+        def timed(*args, **kw):
+            start = timer()
+            try:
+                return func(*args, **kw)
+            finally:
+                elapsed = timer() - start
+                stats[0] += 1
+                stats[1] += elapsed
+                if elapsed > stats[2]:
+                    stats[2] = elapsed
+        return timed
+
+    def totals(self):
+        """
+        Return a dict of the total time in seconds spent in each function.
+        """
+        return dict(
+            (name, stats[1]) for name, stats in self._stats.items())
+
+    def snapshot(self):
+        """
+        Return a dict of the calls, total and maximum time in milliseconds
+        and mean time in microseconds of each function.
+        """
+        snapshot = {}
+        for name, (calls, total, longest) in self._stats.items():
+            snapshot[name] = {
+                'calls': calls,
+                'total_ms': total * 1000,
+                'max_ms': longest * 1000,
+                'mean_us': total / calls * 1000000 if calls else 0.0,
+            }
+        return snapshot
+
+
+class Profile(object):
+    """
+    A cProfile session of the thread it is started in.
+    """
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        self._profile.create_stats()
+        self._stats = self._profile.stats
+
+    def create_stats(self):
+        # Called by pstats.Stats, which takes the stats and then empties
+        # this attribute.
+        self.stats = dict(self._stats)
+
+    def text(self, sort='cumulative', limit=50):
+        """
+        The ``pstats`` report of the ``limit`` functions that sort first.
+        """
+        stream = BytesIO() if sys.version_info[0] == 2 else StringIO()
+        stats = pstats.Stats(self, stream=stream)
+        stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def dump(self):
+        """
+        The profile in the format ``pstats.Stats`` loads from a file.
+        """
+        return marshal.dumps(self._stats)
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return '%s:%s' % (code.co_filename, code.co_name)
+
+
+class StackSampler(object):
+    """
+    Samples the stack of another thread every ``interval`` seconds from a
+    thread of its own, and counts how often each stack was seen.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.counts = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='vxaat-stack-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        labels = []
+        while frame is not None:
+            labels.append(frame_label(frame))
+            frame = frame.f_back
+        stack = ';'.join(reversed(labels))
+        self.counts[stack] = self.counts.get(stack, 0) + 1
+        self.samples += 1
+
+    def collapsed(self):
+        """
+        The samples in the collapsed stack format flame graph tools read,
+        one ``frame;frame;frame count`` line per stack, commonest first.
+        """
+        lines = sorted(
+            self.counts.items(), key=lambda item: (-item[1], item[0]))
+        return ''.join('%s %d\n' % line for line in lines)
@@ -0,0 +1,133 @@
+# -*- test-case-name: vxaat.tests.test_providers -*-
+"""
+Normalisation of the provider names AAT sends.
+"""
+import re
+
+from vxaat.cache import LRUCache
+
+
+_MISSING = object()
+
+
+class ProviderRuleError(ValueError):
+    """
+    Raised for a provider rule that cannot be compiled.
+    """
+
+
+class ProviderNormaliser(object):
+    """
+    Maps raw provider values to normalised ones.
+
+    Exact ``mappings`` win over ``rules``, which are dicts with ``match``
+    (``iexact``, ``prefix`` or ``regex``), ``value`` and ``provider`` keys.
+    Case-insensitive matches are tried next, then prefixes (longest
+    first), then regular expressions in the order given. Results are
+    memoised in an LRU cache of ``cache_size`` entries.
+
+    A provider nothing matches is used as is. ``warn`` is called the first
+    time each one is seen; after that it is only counted, and
+    :meth:`log_summary` reports the counts. :attr:`providers` holds the
+    normalised values the mappings and rules can give.
+    """
+
+    MATCH_TYPES = ('iexact', 'prefix', 'regex')
+
+    def __init__(self, mappings=None, rules=(), cache_size=1024, warn=None):
+        self.exact = dict(mappings or {})
+        self.providers = set(self.exact.values())
+        self.iexact = {}
+        self.prefixes = []
+        self.regexes = []
+        for rule in rules:
+            self.add_rule(rule)
+        self.prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+        self.warn = warn
+        self.unknown_counts = {}
+        self.unknown_overflow = 0
+        self._cache = LRUCache(cache_size)
+
+    def add_rule(self, rule):
+        try:
+            match, value, provider = (
+                rule['match'], rule['value'], rule['provider'])
+        except (KeyError, TypeError):
+            raise ProviderRuleError(
+                "Provider rules need 'match', 'value' and 'provider' keys: "
+                "%r" % (rule,))
+        if match == 'iexact':
+            self.iexact.setdefault(value.lower(), provider)
+        elif match == 'prefix':
+            self.prefixes.append((value, provider))
+        elif match == 'regex':
+            try:
+                self.regexes.append((re.compile(value), provider))
+            except re.error as e:
+                raise ProviderRuleError(
+                    "Invalid provider regex %r: %s" % (value, e))
+        else:
+            raise ProviderRuleError(
+                "Unknown provider rule match type %r, expected one of %s"
+                % (match, ', '.join(self.MATCH_TYPES)))
+        self.providers.add(provider)
+
+    def match(self, provider):
+        """
+        Return the normalised value for ``provider``, or ``None`` if no
+        mapping or rule matches it. This does not use the cache.
+        """
+        if provider in self.exact:
+            return self.exact[provider]
+        normalised = self.iexact.get(provider.lower())
+        if normalised is not None:
+            return normalised
+        for prefix, normalised in self.prefixes:
+            if provider.startswith(prefix):
+                return normalised
+        for regex, normalised in self.regexes:
+            if regex.match(provider):
+                return normalised
+        return None
+
+    def normalise(self, provider):
+        normalised = self._cache.get(provider, _MISSING)
+        if normalised is _MISSING:
+            normalised = self.match(provider)
+            self._cache.set(provider, normalised)
+            if normalised is None and self.warn is not None:
+                self.warn(
+                    "No mapping exists for provider '%s', "
+                    "using '%s' as a fallback" % (provider, provider,))
+        if normalised is None:
+            counts = self.unknown_counts
+            if provider in counts:
+                counts[provider] += 1
+            elif len(counts) < self._cache.maxsize:
+                counts[provider] = 1
+            else:
+                self.unknown_overflow += 1
+            return provider
+        return normalised
+
+    def cache_stats(self):
+        """
+        Return the size and counters of the normalisation cache.
+        """
+        return self._cache.stats()
+
+    def log_summary(self, limit=10):
+        """
+        Report and reset the counts of unmapped providers seen since the
+        last summary, most frequent first.
+        """
+        counts, self.unknown_counts = self.unknown_counts, {}
+        overflow, self.unknown_overflow = self.unknown_overflow, 0
+        if not counts or self.warn is None:
+            return
+        top = sorted(counts.items(), key=lambda item: -item[1])
+        others = sum(count for _, count in top[limit:]) + overflow
+        self.warn(
+            "Messages from unmapped providers since the last summary: %s%s"
+            % (', '.join("'%s' (%d)" % item for item in top[:limit]),
+               ' and %d from others' % (others,) if others else ''))
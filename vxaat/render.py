@@ -0,0 +1,140 @@
+# -*- test-case-name: vxaat.tests.test_render -*-
+"""
+Rendering of AAT USSD response bodies.
+
+The output is byte-for-byte what serialising the equivalent
+``xml.etree.ElementTree`` tree with ``tostring(..., encoding='utf-8')``
+produces, without building the tree for every reply.
+"""
+
+ENCODING = 'utf-8'
+
+_REQUEST_OPEN = b'<request>'
+_REQUEST_CLOSE = b'</request>'
+_HEADERTEXT_OPEN = b'<headertext>'
+_HEADERTEXT_CLOSE = b'</headertext>'
+_HEADERTEXT_EMPTY = b'<headertext />'
+_OPTIONS_OPEN = b'<options>'
+_OPTIONS_CLOSE = b'</options>'
+
+# Attributes are written in sorted order, as ElementTree does.
+_HIDDEN_OPTION = (
+    b'<option callback="%s" command="1" display="false" order="1" />')
+_OPTION_OPEN = b'<option callback="%s" command="%s" display="true" order="%d"'
+_OPTION_CLOSE = b'</option>'
+
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return value.decode(ENCODING)
+    return value
+
+
+def escape_text(value):
+    """
+    Escape character data for use as element text.
+    """
+    value = _to_text(value)
+    if u'&' in value:
+        value = value.replace(u'&', u'&amp;')
+    if u'<' in value:
+        value = value.replace(u'<', u'&lt;')
+    if u'>' in value:
+        value = value.replace(u'>', u'&gt;')
+    return value.encode(ENCODING)
+
+
+def escape_attrib(value):
+    """
+    Escape character data for use as a double quoted attribute value.
+    """
+    value = _to_text(value)
+    if u'&' in value:
+        value = value.replace(u'&', u'&amp;')
+    if u'<' in value:
+        value = value.replace(u'<', u'&lt;')
+    if u'>' in value:
+        value = value.replace(u'>', u'&gt;')
+    if u'"' in value:
+        value = value.replace(u'"', u'&quot;')
+    if u'\n' in value:
+        value = value.replace(u'\n', u'&#10;')
+    return value.encode(ENCODING)
+
+
+def render_headertext(reply):
+    if not reply:
+        return _HEADERTEXT_EMPTY
+    return _HEADERTEXT_OPEN + escape_text(reply) + _HEADERTEXT_CLOSE
+
+
+def render_option(order, command, label, callback):
+    option = _OPTION_OPEN % (
+        escape_attrib(callback), escape_attrib(command), order)
+    if not label:
+        return option + b' />'
+    return option + b'>' + escape_text(label) + _OPTION_CLOSE
+
+
+def render_options(options, callback):
+    """
+    Render menu options the gateway displays itself, from a sequence of
+    ``(command, label, callback)`` tuples. Options with no callback of
+    their own use ``callback``.
+    """
+    return b''.join([
+        render_option(order, command, label, option_callback or callback)
+        for order, (command, label, option_callback)
+        in enumerate(options, 1)])
+
+
+def parse_options(options):
+    """
+    Turn a list of option dicts, each with a ``command``, a ``label`` and
+    optionally a ``callback`` URL, into ``(command, label, callback)``
+    tuples. Returns ``None`` if there are no options.
+
+    :raises ValueError: if the options are malformed.
+    """
+    if not options:
+        return None
+    if not isinstance(options, list):
+        raise ValueError('options must be a list: %r' % (options,))
+    menu = []
+    for option in options:
+        try:
+            command = option['command']
+            label = option['label']
+            callback = option.get('callback')
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError(
+                "options need 'command' and 'label' keys: %r" % (option,))
+        if command is None or command == '':
+            raise ValueError('option has no command: %r' % (option,))
+        menu.append((
+            u'%s' % (command,),
+            None if label is None else u'%s' % (label,),
+            None if callback is None else u'%s' % (callback,)))
+    return menu
+
+
+def render_body(reply, callback, continue_session=True, options=None):
+    """
+    Render a reply body. If the session continues, the body carries either
+    the given menu ``options`` (see :func:`render_options`) or the single
+    hidden option that sends the user's input to ``callback``.
+    """
+    if not continue_session:
+        return _REQUEST_OPEN + render_headertext(reply) + _REQUEST_CLOSE
+    if options:
+        rendered = render_options(options, callback)
+    else:
+        rendered = _HIDDEN_OPTION % (escape_attrib(callback),)
+    return b''.join([
+        _REQUEST_OPEN,
+        render_headertext(reply),
+        _OPTIONS_OPEN,
+        rendered,
+        _OPTIONS_CLOSE,
+        _REQUEST_CLOSE,
+    ])
@@ -0,0 +1,145 @@
+# -*- test-case-name: vxaat.tests.test_scaleout -*-
+"""
+Running several transport processes behind one port: listening with
+``SO_REUSEPORT`` and forwarding replies between processes over unix
+sockets.
+"""
+import os
+import socket
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.endpoints import UNIXClientEndpoint, connectProtocol
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import Int32StringReceiver
+
+from vxaat.sockets import SO_REUSEPORT, reuse_port_socket
+
+
+__all__ = [
+    'SO_REUSEPORT', 'reuse_port_socket', 'listen_reuse_port',
+    'ForwardingProtocol', 'Forwarder']
+
+
+def listen_reuse_port(reactor, port, factory, backlog=50, interface=''):
+    """
+    Like ``reactor.listenTCP``, but other processes may listen on the
+    same port and the kernel balances connections between them.
+    """
+    sock = reuse_port_socket(port, interface)
+    try:
+        sock.listen(backlog)
+        sock.setblocking(False)
+        return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    finally:
+        # The reactor has its own copy of the file descriptor.
+        sock.close()
+
+
+class ForwardingProtocol(Int32StringReceiver):
+    """
+    Length-prefixed messages over a unix socket.
+    """
+    MAX_LENGTH = 1024 * 1024
+
+    def __init__(self, received=None, lost=None):
+        self.received = received
+        self.lost = lost
+
+    def stringReceived(self, data):
+        if self.received is not None:
+            self.received(data)
+
+    def connectionLost(self, reason):
+        if self.lost is not None:
+            self.lost(self)
+
+
+class Forwarder(object):
+    """
+    Sends messages to, and receives messages from, other workers over
+    unix sockets named after their worker ids in ``socket_dir``.
+
+    Sending is fire and forget: a message written to a connection that
+    is then lost is not retried.
+
+    :param reactor:
+        An ``IReactorUNIX`` provider.
+    :param str socket_dir:
+        The directory the workers' sockets live in.
+    :param str worker_id:
+        This worker's id.
+    :param received:
+        Called with each message received from another worker.
+    """
+
+    def __init__(self, reactor, socket_dir, worker_id, received):
+        self.reactor = reactor
+        self.socket_dir = socket_dir
+        self.worker_id = worker_id
+        self.received = received
+        self.port = None
+        self.forwarded = 0
+        self._peers = {}
+        self._connecting = {}
+        self._inbound = set()
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.socket_dir, '%s.sock' % (worker_id,))
+
+    def listen(self):
+        factory = Factory.forProtocol(self._inbound_protocol)
+        self.port = self.reactor.listenUNIX(
+            self.socket_path(self.worker_id), factory, wantPID=True)
+        return self.port
+
+    def _inbound_protocol(self):
+        protocol = ForwardingProtocol(self.received, self._inbound.discard)
+        self._inbound.add(protocol)
+        return protocol
+
+    def forward(self, worker_id, data):
+        """
+        Send ``data`` to the worker ``worker_id``. Returns a ``Deferred``
+        that fails if the worker cannot be connected to.
+        """
+        self.forwarded += 1
+        protocol = self._peers.get(worker_id)
+        if protocol is not None:
+            protocol.sendString(data)
+            return succeed(None)
+        pending = self._connecting.get(worker_id)
+        if pending is None:
+            pending = self._connecting[worker_id] = []
+            d = connectProtocol(
+                UNIXClientEndpoint(
+                    self.reactor, self.socket_path(worker_id)),
+                ForwardingProtocol(lost=self._peer_lost))
+            d.addCallbacks(
+                self._connected, self._connect_failed,
+                callbackArgs=(worker_id,), errbackArgs=(worker_id,))
+        d = Deferred()
+        pending.append((data, d))
+        return d
+
+    def _connected(self, protocol, worker_id):
+        protocol.worker_id = worker_id
+        self._peers[worker_id] = protocol
+        for data, d in self._connecting.pop(worker_id):
+            protocol.sendString(data)
+            d.callback(None)
+
+    def _connect_failed(self, failure, worker_id):
+        for data, d in self._connecting.pop(worker_id):
+            d.errback(failure)
+
+    def _peer_lost(self, protocol):
+        if self._peers.get(protocol.worker_id) is protocol:
+            del self._peers[protocol.worker_id]
+
+    def stop(self):
+        for protocol in list(self._peers.values()) + list(self._inbound):
+            protocol.transport.loseConnection()
+        if self.port is not None:
+            port, self.port = self.port, None
+            return port.stopListening()
+        return succeed(None)
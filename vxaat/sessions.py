@@ -0,0 +1,86 @@
+# -*- test-case-name: vxaat.tests.test_sessions -*-
+"""
+In-process tracking of USSD sessions by AAT ``ussdSessionId``.
+"""
+from vxaat.deadlines import DeadlineQueue
+
+
+class SessionRecord(object):
+    __slots__ = (
+        'session_id', 'msisdn', 'provider', 'to_addr', 'started',
+        'last_seen', 'hops')
+
+    def __init__(self, session_id, msisdn, provider, to_addr, started):
+        self.session_id = session_id
+        self.msisdn = msisdn
+        self.provider = provider
+        self.to_addr = to_addr
+        self.started = started
+        self.last_seen = started
+        self.hops = 0
+
+    def __repr__(self):
+        return '<SessionRecord %s %s hops=%s>' % (
+            self.session_id, self.msisdn, self.hops)
+
+
+class SessionTable(object):
+    """
+    Sessions keyed by session id that expire after ``ttl`` seconds without
+    a request.
+
+    :param clock:
+        An ``IReactorTime`` provider.
+    :param float ttl:
+        Idle seconds after which a session expires.
+    :param expired:
+        Called with the :class:`SessionRecord` of each expired session.
+    """
+
+    def __init__(self, clock, ttl, expired):
+        self.clock = clock
+        self.ttl = ttl
+        self.expired = expired
+        self._sessions = {}
+        self._deadlines = DeadlineQueue(clock, self._expire)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def get(self, session_id):
+        return self._sessions.get(session_id)
+
+    def touch(self, session_id, msisdn, provider, to_addr, new=False):
+        """
+        Record a request for a session, creating the session if it is
+        unknown or ``new`` is true, and return its record.
+        """
+        now = self.clock.seconds()
+        record = self._sessions.get(session_id)
+        if record is None or new:
+            record = self._sessions[session_id] = SessionRecord(
+                session_id, msisdn, provider, to_addr, now)
+        record.last_seen = now
+        record.hops += 1
+        self._deadlines.schedule(session_id, now + self.ttl)
+        return record
+
+    def close(self, session_id):
+        """
+        Forget a session that has ended and return its record, or ``None``
+        if it is unknown.
+        """
+        record = self._sessions.pop(session_id, None)
+        if record is not None:
+            self._deadlines.cancel(session_id)
+        return record
+
+    def stop(self):
+        self._deadlines.stop()
+
+    def _expire(self, session_id):
+        record = self._sessions.pop(session_id)
+        self.expired(record)
@@ -0,0 +1,35 @@
+# -*- test-case-name: vxaat.tests.test_scaleout -*-
+"""
+Listening sockets that several processes can share with
+``SO_REUSEPORT``. This module has no dependencies, so that code on either
+Python can use it.
+"""
+import socket
+import sys
+
+
+if hasattr(socket, 'SO_REUSEPORT'):
+    SO_REUSEPORT = socket.SO_REUSEPORT
+elif sys.platform.startswith('linux'):
+    # Python 2's socket module does not define it.
+    SO_REUSEPORT = 15
+else:
+    SO_REUSEPORT = None
+
+
+def reuse_port_socket(port, interface=''):
+    """
+    Return a TCP socket bound to ``port`` with ``SO_REUSEPORT`` set, so
+    that other processes can bind the same port.
+    """
+    if SO_REUSEPORT is None:
+        raise RuntimeError('SO_REUSEPORT is not supported on this platform')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+    except Exception:
+        sock.close()
+        raise
+    return sock
@@ -0,0 +1,130 @@
+import json
+import marshal
+
+from twisted.internet.task import Clock
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.admin import (
+    FunctionsResource, MemoryResource, ProfileResource, summarise)
+from vxaat.profiling import FunctionTimes
+
+
+def mk_request(**args):
+    request = DummyRequest([])
+    request.args = dict((k, [v]) for k, v in args.items())
+    return request
+
+
+class TestProfileResource(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.resource = ProfileResource(self.clock, max_seconds=30)
+
+    def profile(self, **args):
+        request = mk_request(**args)
+        self.assertEqual(self.resource.render_GET(request), NOT_DONE_YET)
+        self.assertTrue(self.resource.active)
+        self.clock.advance(float(args.get('seconds', 10)))
+        self.assertFalse(self.resource.active)
+        self.assertEqual(request.finished, 1)
+        return request
+
+    def test_cprofile(self):
+        request = self.profile(seconds='2', sort='tottime')
+        body = b''.join(request.written)
+        self.assertTrue(b'Ordered by: internal time' in body)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('Content-Type'),
+            ['text/plain; charset=utf-8'])
+
+    def test_cprofile_pstats(self):
+        request = self.profile(format='pstats')
+        self.assertTrue(isinstance(
+            marshal.loads(b''.join(request.written)), dict))
+
+    def test_sample(self):
+        request = self.profile(seconds='0.5', mode='sample')
+        # Nothing runs on the reactor thread while the fake clock waits, so
+        # there may be no samples.
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('Content-Type'),
+            ['text/plain; charset=utf-8'])
+
+    def test_invalid_options(self):
+        for args in [{'seconds': 'x'}, {'seconds': '0'}, {'seconds': '31'},
+                     {'interval': '2'}, {'mode': 'strace'},
+                     {'format': 'svg'}, {'sort': 'name'}]:
+            request = mk_request(**args)
+            body = self.resource.render_GET(request)
+            self.assertEqual(request.responseCode, 400)
+            self.assertTrue('error' in json.loads(body))
+        self.assertFalse(self.resource.active)
+
+    def test_one_at_a_time(self):
+        self.resource.render_GET(mk_request())
+        request = mk_request()
+        body = self.resource.render_GET(request)
+        self.assertEqual(request.responseCode, 409)
+        self.assertEqual(
+            json.loads(body), {'error': 'A profile is already running.'})
+        self.clock.advance(10)
+
+    def test_client_gone(self):
+        request = mk_request()
+        self.resource.render_GET(request)
+        request.processingFailed(Exception('Connection lost'))
+        written = list(request.written)
+        self.clock.advance(10)
+        self.assertFalse(self.resource.active)
+        self.assertEqual(request.written, written)
+
+
+class TestFunctionsResource(VumiTestCase):
+
+    def test_render(self):
+        times = FunctionTimes()
+        times.wrap('generate_body', lambda: None)()
+        request = mk_request()
+        data = json.loads(FunctionsResource(times).render_GET(request))
+        self.assertEqual(data['generate_body']['calls'], 1)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('Content-Type'),
+            ['application/json; charset=utf-8'])
+
+
+class TestMemoryResource(VumiTestCase):
+
+    def test_render(self):
+        resource = MemoryResource()
+        request = mk_request(limit='5')
+        data = json.loads(resource.render_GET(request))
+        self.assertEqual(len(data['top']), 5)
+        self.assertFalse('growth' in data)
+
+        data = json.loads(resource.render_POST(mk_request()))
+        self.assertFalse('growth' in data)
+        data = json.loads(resource.render_GET(mk_request()))
+        self.assertEqual(data['baseline_bytes'], resource.baseline.total)
+        self.assertTrue('growth' in data)
+
+    def test_invalid_limit(self):
+        resource = MemoryResource()
+        for limit in ['x', '0', '101']:
+            request = mk_request(limit=limit)
+            body = resource.render_POST(request)
+            self.assertEqual(request.responseCode, 400)
+            self.assertTrue('error' in json.loads(body))
+        self.assertEqual(resource.baseline, None)
+
+
+class TestSummarise(VumiTestCase):
+
+    def test_summarise(self):
+        self.assertEqual(summarise([]), {})
+        self.assertEqual(
+            summarise([i / 1000.0 for i in range(1, 101)]),
+            {'p50': 50.0, 'p95': 95.0, 'p99': 99.0, 'max': 100.0})
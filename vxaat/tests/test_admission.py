@@ -0,0 +1,42 @@
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.admission import AdmissionControl
+
+
+class TestAdmissionControl(VumiTestCase):
+
+    def test_unlimited(self):
+        admission = AdmissionControl()
+        for i in range(100):
+            self.assertTrue(admission.admit(i, 'mtn'))
+        self.assertEqual(len(admission), 100)
+        self.assertEqual(admission.rejected, {})
+
+    def test_global_limit(self):
+        admission = AdmissionControl(max_requests=2)
+        self.assertTrue(admission.admit('a', 'mtn'))
+        self.assertTrue(admission.admit('b', 'vodacom'))
+        self.assertFalse(admission.admit('c', 'cellc'))
+        self.assertEqual(admission.rejected, {'cellc': 1})
+        admission.release('a')
+        self.assertTrue(admission.admit('c', 'cellc'))
+
+    def test_provider_limit(self):
+        admission = AdmissionControl(max_per_provider=1)
+        self.assertTrue(admission.admit('a', 'mtn'))
+        self.assertFalse(admission.admit('b', 'mtn'))
+        self.assertFalse(admission.admit('c', 'mtn'))
+        self.assertTrue(admission.admit('d', 'vodacom'))
+        self.assertEqual(admission.rejected, {'mtn': 2})
+        self.assertEqual(admission.in_flight('mtn'), 1)
+        admission.release('a')
+        self.assertEqual(admission.in_flight('mtn'), 0)
+        self.assertTrue(admission.admit('b', 'mtn'))
+
+    def test_release_unknown(self):
+        admission = AdmissionControl(max_requests=1)
+        admission.release('unknown')
+        self.assertTrue(admission.admit('a', 'mtn'))
+        admission.release('a')
+        admission.release('a')
+        self.assertEqual(len(admission), 0)
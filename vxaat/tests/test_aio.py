@@ -0,0 +1,613 @@
+# -*- coding: utf-8 -*-
+"""
+The scenarios of test_ussd, run against the asyncio engine. These need
+Python 3 and are skipped elsewhere; run them with::
+
+    python3 -m unittest vxaat.tests.test_aio
+"""
+import json
+import socket
+from unittest import TestCase, skipIf
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+else:
+    import http.client
+    from urllib.parse import quote, urlencode
+
+    from vxaat.aio import AatUssdEngine, ConfigError, InMemoryBroker
+    from vxaat.aio import messages
+    from vxaat.benchmarks import engines
+
+
+NEEDS_ASYNCIO = 'The asyncio engine needs Python 3.'
+
+# What vumi 0.6 publishes for a new session with the default envelope
+VUMI_INBOUND = (
+    '{"from_addr_type": null, "transport_name": "aat_ussd", '
+    '"in_reply_to": null, "group": null, '
+    '"timestamp": "2026-10-16 23:36:46.963454", '
+    '"from_addr": "27729042520", "message_type": "user_message", '
+    '"provider": "MTN", "to_addr": "*1234#", "to_addr_type": null, '
+    '"content": null, "routing_metadata": {}, '
+    '"message_version": "20110921", "transport_type": "ussd", '
+    '"helper_metadata": {"session_id": "s1"}, '
+    '"transport_metadata": {"aat_ussd": {"ussd_session_id": "s1", '
+    '"provider": "MTN"}}, "session_event": "new", "message_id": "m1"}')
+
+VUMI_ACK = (
+    '{"transport_name": "aat_ussd", "event_type": "ack", '
+    '"event_id": "975e108e438f415db93a035578783ebe", '
+    '"sent_message_id": "e181c404654145ffa68cf3f0f0a03807", '
+    '"helper_metadata": {}, "routing_metadata": {}, '
+    '"message_version": "20110921", '
+    '"timestamp": "2026-10-16 23:36:46.968015", "transport_metadata": {}, '
+    '"user_message_id": "e181c404654145ffa68cf3f0f0a03807", '
+    '"message_type": "event"}')
+
+
+def fetch(port, path, params, method='GET'):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        connection.request(method, '%s?%s' % (path, urlencode(params)))
+        response = connection.getresponse()
+        return response.status, response.read().decode('utf-8')
+    finally:
+        connection.close()
+
+
+@skipIf(asyncio is None, NEEDS_ASYNCIO)
+class TestAatUssdEngine(TestCase):
+
+    request_defaults = {
+        'msisdn': '27729042520',
+        'provider': 'MTN',
+    }
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.addCleanup(lambda: self.loop.run_until_complete(
+            self.loop.shutdown_default_executor()))
+        self.broker = InMemoryBroker(self.loop)
+
+    def wait(self, future):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(future, 10))
+
+    def get_engine(self, config={}):
+        defaults = {
+            'transport_name': 'aat_ussd',
+            'base_url': 'http://www.example.com/foo',
+            'web_path': '/api/aat/ussd/',
+            'web_port': 0,
+        }
+        defaults.update(config)
+        engine = AatUssdEngine(defaults, self.broker, self.loop)
+        self.wait(engine.start())
+        self.addCleanup(engine.stop)
+        return engine
+
+    def mk_request(self, engine, path=None, **params):
+        """
+        Make a request from another thread, and return a future for its
+        status and body.
+        """
+        args = dict(self.request_defaults)
+        args.update(params)
+        return self.mk_request_raw(engine, args, path)
+
+    def mk_request_raw(self, engine, params, path=None):
+        return self.loop.run_in_executor(
+            None, fetch, engine.port, path or engine.config.web_path, params)
+
+    def wait_for_inbound(self, count):
+        return self.wait(self.broker.wait_for_inbound(count))
+
+    def wait_for_events(self, count):
+        return self.wait(self.broker.wait_for_events(count))
+
+    def callback_url(self, to_addr):
+        return "http://www.example.com/foo/api/aat/ussd/?to_addr=%s" % (
+            quote(to_addr),)
+
+    def assert_inbound_message(self, msg, **field_values):
+        expected_field_values = {
+            'content': "",
+            'from_addr': self.request_defaults['msisdn'],
+        }
+        expected_field_values.update(field_values)
+        for field, expected_value in expected_field_values.items():
+            self.assertEqual(msg[field], expected_value)
+
+    def assert_outbound_message(self, msg, content, callback,
+                                continue_session=True):
+        headertext = '<headertext>%s</headertext>' % content
+
+        if continue_session:
+            options = (
+                '<options>'
+                '<option callback="%s" command="1" display="false"'
+                ' order="1" />'
+                '</options>'
+            ) % callback
+        else:
+            options = ""
+
+        xml = ''.join([
+            '<request>',
+            headertext,
+            options,
+            '</request>',
+        ])
+
+        self.assertEqual(msg, xml)
+
+    def assert_ack(self, ack, reply):
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['user_message_id'], reply['message_id'])
+        self.assertEqual(ack['sent_message_id'], reply['message_id'])
+
+    def assert_nack(self, nack, reply, reason):
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(nack['user_message_id'], reply['message_id'])
+        self.assertEqual(nack['nack_reason'], reason)
+
+    def reply_and_check(self, d, msg, reply_content, to_addr,
+                        continue_session=True):
+        reply = messages.reply(msg, reply_content, continue_session)
+        self.broker.publish_outbound(reply)
+        code, body = self.wait(d)
+        self.assertEqual(code, 200)
+        self.assert_outbound_message(
+            body, reply_content, self.callback_url(to_addr),
+            continue_session=continue_session)
+        [ack] = self.wait_for_events(1)
+        self.assert_ack(ack, reply)
+
+    def make_outbound(self, **fields):
+        fields.setdefault('to_addr', '27729042520')
+        fields.setdefault('from_addr', '9292')
+        fields.setdefault('transport_name', 'aat_ussd')
+        fields.setdefault('transport_type', 'ussd')
+        reply = messages.user_message(**fields)
+        self.broker.publish_outbound(reply)
+        return reply
+
+    def test_inbound_begin(self):
+        engine = self.get_engine()
+        ussd_string = "*1234#"
+
+        d = self.mk_request(engine, request=ussd_string)
+        [msg] = self.wait_for_inbound(1)
+        self.assert_inbound_message(
+            msg,
+            session_event=messages.SESSION_NEW,
+            to_addr=ussd_string,
+            content=None,
+        )
+        self.reply_and_check(
+            d, msg, 'We are the Knights Who Say ... Ni!', ussd_string)
+
+    def test_inbound_begin_with_different_provider(self):
+        engine = self.get_engine({
+            'provider_mappings': {'Camelot': 'camelot'}
+        })
+        ussd_string = "*1234#"
+
+        d = self.mk_request(engine, request=ussd_string, provider="Camelot")
+        [msg] = self.wait_for_inbound(1)
+        self.assert_inbound_message(
+            msg,
+            session_event=messages.SESSION_NEW,
+            to_addr=ussd_string,
+            content=None,
+            provider="camelot",
+        )
+        self.reply_and_check(
+            d, msg, 'We are the Knights Who Say ... Ni!', ussd_string)
+
+    def test_inbound_with_unknown_provider(self):
+        engine = self.get_engine({
+            'provider_mappings': {'Camelot': 'camelot'}
+        })
+        ussd_string = "*1234#"
+
+        with self.assertLogs('vxaat.aio.engine', 'WARNING') as logs:
+            d = self.mk_request(engine, request=ussd_string, provider="Tim")
+            [msg] = self.wait_for_inbound(1)
+        self.assertEqual(logs.records[0].getMessage(), (
+            "No mapping exists for provider 'Tim', using 'Tim' as a "
+            "fallback"))
+
+        self.assert_inbound_message(
+            msg,
+            session_event=messages.SESSION_NEW,
+            to_addr=ussd_string,
+            content=None,
+            provider="Tim",
+        )
+        self.broker.publish_outbound(
+            messages.reply(msg, "I... am an enchanter"))
+        self.wait(d)
+
+    def test_inbound_begin_with_close(self):
+        engine = self.get_engine()
+        ussd_string = "*code#"
+
+        d = self.mk_request(engine, request=ussd_string)
+        [msg] = self.wait_for_inbound(1)
+        self.assert_inbound_message(
+            msg,
+            session_event=messages.SESSION_NEW,
+            content=None,
+        )
+        self.reply_and_check(
+            d, msg, 'We are no longer the Knight who say Ni!', ussd_string,
+            continue_session=False)
+
+    def test_inbound_resume_and_reply_with_end(self):
+        engine = self.get_engine()
+        ussd_string = "*1234#"
+        user_content = "I didn't expect a kind of Spanish Inquisition!"
+
+        d = self.mk_request(
+            engine, request=user_content, to_addr=ussd_string)
+        [msg] = self.wait_for_inbound(1)
+        self.assert_inbound_message(
+            msg,
+            session_event=messages.SESSION_RESUME,
+            content=user_content,
+        )
+        self.reply_and_check(
+            d, msg, "Nobody expects the Spanish Inquisition!", ussd_string,
+            continue_session=False)
+
+    def test_inbound_resume_and_reply_with_resume(self):
+        engine = self.get_engine()
+        ussd_string = "xxxx"
+        user_content = "Well, what is it you want?"
+
+        d = self.mk_request(
+            engine, request=user_content, to_addr=ussd_string)
+        [msg] = self.wait_for_inbound(1)
+        self.assert_inbound_message(
+            msg,
+            session_event=messages.SESSION_RESUME,
+            content=user_content,
+            to_addr=ussd_string
+        )
+        self.reply_and_check(d, msg, "We want ... a shrubbery!", ussd_string)
+
+    def test_request_with_missing_parameters(self):
+        engine = self.get_engine()
+        code, body = self.wait(self.mk_request_raw(
+            engine, {"request": '', "provider": ''}))
+        self.assertEqual(
+            json.loads(body), {'missing_parameter': ['msisdn']})
+        self.assertEqual(code, 400)
+
+    def test_request_with_unexpected_parameters(self):
+        engine = self.get_engine()
+        code, body = self.wait(self.mk_request(
+            engine, unexpected_p1='', unexpected_p2=''))
+        self.assertEqual(code, 400)
+        body = json.loads(body)
+        self.assertEqual(set(['unexpected_parameter']), set(body.keys()))
+        self.assertEqual(
+            sorted(body['unexpected_parameter']),
+            ['unexpected_p1', 'unexpected_p2'])
+
+    def test_request_with_unexpected_parameters_permissive(self):
+        engine = self.get_engine({'validation_mode': 'permissive'})
+        d = self.mk_request(engine, request='*1234#', unexpected_p1='')
+        [msg] = self.wait_for_inbound(1)
+        self.assertEqual(msg['to_addr'], '*1234#')
+        self.broker.publish_outbound(messages.reply(msg, 'Ni!'))
+        code, _ = self.wait(d)
+        self.assertEqual(code, 200)
+
+    def test_no_reply_to_in_response(self):
+        self.get_engine()
+        msg = self.make_outbound(
+            content="Nudge, nudge, wink, wink. Know what I mean?",
+            message_id='1')
+        [nack] = self.wait_for_events(1)
+        self.assert_nack(nack, msg, "Outbound message is not a reply")
+
+    def test_no_content_in_reply(self):
+        self.get_engine()
+        msg = self.make_outbound(content="", message_id='1')
+        [nack] = self.wait_for_events(1)
+        self.assert_nack(nack, msg, "Outbound message has no content.")
+
+    def test_failed_request(self):
+        self.get_engine()
+        msg = self.make_outbound(
+            in_reply_to='xxxx', content="She turned me into a newt!",
+            message_id='1')
+        [nack] = self.wait_for_events(1)
+        self.assert_nack(nack, msg, "Response to http request failed.")
+
+    def test_metadata_handled(self):
+        engine = self.get_engine({
+            'provider_mappings': {'MTN': 'mtn'}
+        })
+        ussd_session_id = 'xxxx'
+        content = "*code#"
+
+        d = self.mk_request(
+            engine, request=content, ussdSessionId=ussd_session_id)
+        [msg] = self.wait_for_inbound(1)
+        self.assert_inbound_message(
+            msg,
+            session_event=messages.SESSION_NEW,
+            content=None,
+            helper_metadata={
+                'session_id': ussd_session_id,
+            },
+            transport_metadata={
+                'aat_ussd': {
+                    'provider': 'mtn',
+                    'ussd_session_id': ussd_session_id,
+                }
+            }
+        )
+        self.reply_and_check(d, msg, "We want ... a shrubbery!", content)
+
+    def test_compact_envelope(self):
+        engine = self.get_engine({
+            'provider_mappings': {'MTN': 'mtn'},
+            'compact_envelope': True,
+        })
+        d = self.mk_request(engine, request='*code#', ussdSessionId='xxxx')
+        [msg] = self.wait_for_inbound(1)
+        self.assert_inbound_message(
+            msg,
+            session_event=messages.SESSION_NEW,
+            content=None,
+            provider='mtn',
+            helper_metadata={},
+            transport_metadata={'aat_ussd': {'ussd_session_id': 'xxxx'}})
+        self.reply_and_check(d, msg, 'We want ... a shrubbery!', '*code#')
+
+    def test_callback_url_with_trailing_slash(self):
+        engine = self.get_engine({
+            "base_url": "http://www.example.com/foo/",
+        })
+        ussd_string = '*1234#'
+
+        d = self.mk_request(
+            engine, request="Well, what is it you want?",
+            to_addr=ussd_string)
+        [msg] = self.wait_for_inbound(1)
+        self.reply_and_check(d, msg, "We want ... a shrubbery!", ussd_string)
+
+    def test_outbound_unicode(self):
+        engine = self.get_engine()
+        ussd_string = '*1234#'
+
+        d = self.mk_request(
+            engine, request="One, two, ... five!", to_addr=ussd_string)
+        [msg] = self.wait_for_inbound(1)
+        self.reply_and_check(d, msg, "Thrëë, my lord.", ussd_string)
+
+    def test_reply_cache(self):
+        engine = self.get_engine({'reply_cache_size': 10})
+        ussd_string = '*1234#'
+
+        for i in range(2):
+            d = self.mk_request(engine, request="Ni!", to_addr=ussd_string)
+            [msg] = self.wait_for_inbound(1)
+            self.broker.clear()
+            self.reply_and_check(
+                d, msg, "We want ... a shrubbery!", ussd_string)
+            self.broker.clear()
+
+        self.assertEqual(engine.reply_cache.misses, 1)
+        self.assertEqual(engine.reply_cache.hits, 1)
+
+    def test_outbound_menu_options(self):
+        engine = self.get_engine({'reply_cache_size': 10})
+        d = self.mk_request(engine, request='*1234#')
+        [msg] = self.wait_for_inbound(1)
+        reply = messages.reply(msg, 'Choose', helper_metadata={'aat_ussd': {
+            'options': [
+                {'command': 1, 'label': 'Yes'},
+                {'command': '2', 'label': 'No & <never>',
+                 'callback': 'http://example.com/other'},
+            ],
+        }})
+        self.broker.publish_outbound(reply)
+        _, body = self.wait(d)
+        self.assertEqual(body, ''.join([
+            '<request>',
+            '<headertext>Choose</headertext>',
+            '<options>',
+            '<option callback="%s" command="1" display="true" order="1">'
+            'Yes</option>' % (self.callback_url('*1234#'),),
+            '<option callback="http://example.com/other" command="2"'
+            ' display="true" order="2">No &amp; &lt;never&gt;</option>',
+            '</options>',
+            '</request>',
+        ]))
+        [ack] = self.wait_for_events(1)
+        self.assert_ack(ack, reply)
+
+    def test_outbound_invalid_menu_options(self):
+        engine = self.get_engine()
+        d = self.mk_request(engine, request='*1234#')
+        [msg] = self.wait_for_inbound(1)
+        reply = messages.reply(msg, 'Choose', helper_metadata={'aat_ussd': {
+            'options': [{'label': 'Yes'}],
+        }})
+        with self.assertLogs('vxaat.aio.engine', 'WARNING') as logs:
+            self.broker.publish_outbound(reply)
+            [nack] = self.wait_for_events(1)
+        self.assert_nack(nack, reply, AatUssdEngine.INVALID_OPTIONS_ERROR)
+        self.assertEqual(len(logs.records), 1)
+        self.broker.clear()
+        self.reply_and_check(d, msg, 'Ni!', '*1234#')
+
+    def test_request_timeout(self):
+        engine = self.get_engine({
+            'request_timeout': 0,
+            'request_timeout_body': 'Too slow',
+            'request_cleanup_interval': 0,
+        })
+        d = self.mk_request(engine, request='*1234#')
+        self.wait_for_inbound(1)
+        with self.assertLogs('vxaat.aio.engine', 'WARNING') as logs:
+            engine.close_old_requests()
+        self.assertEqual(
+            logs.records[0].getMessage(), 'Timing out *1234#')
+        self.assertEqual(self.wait(d), (504, 'Too slow'))
+        self.assertEqual(engine.stats['timeouts'], 1)
+        self.assertEqual(engine.get_stats()['outstanding'], 0)
+
+    def test_request_lost(self):
+        engine = self.get_engine()
+        client = socket.create_connection(('127.0.0.1', engine.port))
+        self.addCleanup(client.close)
+        client.sendall(
+            b'GET /api/aat/ussd/?msisdn=27729042520&provider=MTN'
+            b'&request=%2A1234%23 HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        [msg] = self.wait_for_inbound(1)
+        client.close()
+        for _ in range(100):
+            if engine.stats['abandoned']:
+                break
+            self.wait(asyncio.sleep(0.01))
+        self.assertEqual(engine.stats['abandoned'], 1)
+        self.assertEqual(engine.get_stats()['outstanding'], 0)
+
+        self.broker.publish_outbound(messages.reply(msg, 'Ni!'))
+        [nack] = self.wait_for_events(1)
+        self.assertEqual(
+            nack['nack_reason'], AatUssdEngine.RESPONSE_FAILURE_ERROR)
+
+    def test_keep_alive_pipelined(self):
+        engine = self.get_engine()
+        self.broker.consume_inbound(lambda msg: self.broker.publish_outbound(
+            messages.reply(msg, 'You said %s' % (msg['to_addr'],))))
+
+        def pipeline():
+            client = socket.create_connection(('127.0.0.1', engine.port))
+            try:
+                client.sendall(b''.join(
+                    b'GET /api/aat/ussd/?msisdn=27729042520&provider=MTN'
+                    b'&request=' + code + b' HTTP/1.1\r\n'
+                    b'Host: localhost\r\n\r\n'
+                    for code in (b'first', b'second')))
+                data = b''
+                while data.count(b'</request>') < 2:
+                    chunk = client.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                return data
+            finally:
+                client.close()
+
+        data = self.wait(self.loop.run_in_executor(None, pipeline))
+        self.assertEqual(data.count(b'HTTP/1.1 200 OK'), 2)
+        self.assertTrue(
+            data.index(b'You said first') < data.index(b'You said second'))
+
+    def test_health(self):
+        engine = self.get_engine()
+        d = self.mk_request(engine, request='*1234#')
+        self.wait_for_inbound(1)
+        code, body = self.wait(self.mk_request_raw(engine, {}, '/health'))
+        self.assertEqual(code, 200)
+        self.assertEqual(
+            json.loads(body), {'pending_requests': 1, 'ready': True})
+        self.broker.publish_outbound(messages.reply(
+            self.broker.inbound[0], 'Bye', continue_session=False))
+        self.wait(d)
+
+    def test_unknown_path(self):
+        engine = self.get_engine()
+        code, _ = self.wait(self.mk_request_raw(engine, {}, '/other'))
+        self.assertEqual(code, 404)
+
+    def test_unsupported_config(self):
+        self.assertRaises(ConfigError, self.get_engine, {'page_budget': 10})
+
+    def test_invalid_provider_rule(self):
+        self.assertRaises(ConfigError, self.get_engine, {
+            'provider_rules': [{'match': 'glob', 'value': 'x',
+                                'provider': 'x'}],
+        })
+
+
+@skipIf(asyncio is None, NEEDS_ASYNCIO)
+class TestMessages(TestCase):
+
+    def test_inbound_fields(self):
+        expected = json.loads(VUMI_INBOUND)
+        message = messages.user_message(
+            message_id='m1',
+            content=None,
+            to_addr='*1234#',
+            from_addr='27729042520',
+            session_event=messages.SESSION_NEW,
+            transport_name='aat_ussd',
+            transport_type='ussd',
+            helper_metadata={'session_id': 's1'},
+            transport_metadata={'aat_ussd': {
+                'ussd_session_id': 's1', 'provider': 'MTN'}},
+            provider='MTN')
+        encoded = json.loads(messages.to_json(message))
+        self.assertEqual(
+            len(encoded['timestamp']), len(expected['timestamp']))
+        del encoded['timestamp'], expected['timestamp']
+        self.assertEqual(encoded, expected)
+
+    def test_ack_fields(self):
+        expected = json.loads(VUMI_ACK)
+        ack = messages.ack(
+            expected['user_message_id'], expected['sent_message_id'],
+            transport_name='aat_ussd')
+        encoded = json.loads(messages.to_json(ack))
+        for field in ('timestamp', 'event_id'):
+            self.assertEqual(len(encoded[field]), len(expected[field]))
+            del encoded[field], expected[field]
+        self.assertEqual(encoded, expected)
+
+    def test_from_json(self):
+        message = messages.from_json(VUMI_INBOUND)
+        self.assertEqual(message['timestamp'].microsecond, 963454)
+        self.assertEqual(message['to_addr'], '*1234#')
+        self.assertEqual(
+            messages.from_json(messages.to_json(message)), message)
+
+    def test_reply(self):
+        message = messages.from_json(VUMI_INBOUND)
+        reply = messages.reply(message, 'Hi', continue_session=False)
+        self.assertEqual(reply['in_reply_to'], 'm1')
+        self.assertEqual(reply['to_addr'], '27729042520')
+        self.assertEqual(reply['from_addr'], '*1234#')
+        self.assertEqual(reply['session_event'], messages.SESSION_CLOSE)
+        self.assertEqual(
+            reply['transport_metadata'], message['transport_metadata'])
+        self.assertEqual(
+            reply['routing_metadata'], {'endpoint_name': 'default'})
+
+
+@skipIf(asyncio is None, NEEDS_ASYNCIO)
+class TestEnginesBenchmark(TestCase):
+
+    def test_run_asyncio(self):
+        options = engines.parse_args([
+            '--engines', 'asyncio', '--sessions', '20', '--concurrency', '5'])
+        [result] = engines.run_engines(options)
+        self.assertEqual(result['engine'], 'asyncio')
+        self.assertEqual(result['broker'], 'InMemoryBroker')
+        self.assertEqual(result['completed_sessions'], 20)
+        self.assertEqual(result['hops'], 60)
+        self.assertEqual(result['acks'], 60)
+        self.assertEqual(result['timeouts'], 0)
+        self.assertEqual(result['http_errors'], 0)
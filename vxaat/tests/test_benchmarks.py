@@ -0,0 +1,310 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+from StringIO import StringIO
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.python import log
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.benchmarks import (
+    envelope, harness, hot_paths, loadgen, log_overhead, outbound,
+    processes, replay, scale, soak, stats)
+from vxaat.capture import CaptureWriter
+from vxaat.scaleout import SO_REUSEPORT, reuse_port_socket
+
+
+class TestEnvelope(VumiTestCase):
+
+    def test_cases_run(self):
+        cases = envelope.make_cases()
+        self.assertEqual([name for name, _ in cases], [
+            'encode.full', 'decode.full', 'encode.compact', 'decode.compact'])
+        for name, func in cases:
+            func()
+
+    def test_compact_is_smaller(self):
+        sizes = envelope.message_sizes()
+        self.assertTrue(sizes['compact'] < sizes['full'])
+
+
+class TestHarness(VumiTestCase):
+
+    def test_make_transport(self):
+        transport = harness.make_transport()
+        self.add_cleanup(harness.teardown_transport, transport)
+        request = harness.FakeRequest({
+            'msisdn': ['27729042520'],
+            'provider': ['MTN'],
+            'request': ['*1234#'],
+        })
+        transport.set_request('msg-1', request)
+        transport.handle_raw_inbound_message('msg-1', request)
+        connector = transport.connectors[transport.transport_name]
+        self.assertEqual(connector.inbound_count, 1)
+        self.assertEqual(connector.last_inbound['to_addr'], '*1234#')
+
+        transport.handle_outbound_message(
+            connector.last_inbound.reply('Ni!'))
+        self.assertTrue(request.finished)
+        self.assertEqual(connector.last_event['event_type'], 'ack')
+
+    def test_measure(self):
+        result = harness.measure(lambda: None, min_time=0.001, repeat=1)
+        self.assertEqual(
+            sorted(result.keys()),
+            ['calls', 'gc_objects_per_call', 'ops_per_sec', 'usec_per_call'])
+        self.assertTrue(result['ops_per_sec'] > 0)
+
+    def test_compare(self):
+        baseline = {
+            'a': {'ops_per_sec': 100.0},
+            'b': {'ops_per_sec': 100.0},
+            'c': {'ops_per_sec': 100.0},
+        }
+        results = {
+            'a': {'ops_per_sec': 95.0},
+            'b': {'ops_per_sec': 50.0},
+        }
+        self.assertEqual(harness.compare(baseline, results, 0.1), [
+            ('a', 100.0, 95.0, 0.95, False),
+            ('b', 100.0, 50.0, 0.5, True),
+        ])
+
+    def test_main(self):
+        output = self.mktemp()
+        out = StringIO()
+        cases = [('noop', lambda: None)]
+        self.assertEqual(harness.main(
+            cases, ['--min-time', '0.001', '--repeat', '1', '-o', output],
+            out=out), 0)
+        with open(output) as f:
+            data = json.load(f)
+        self.assertEqual(data['results'].keys(), ['noop'])
+        self.assertTrue('python' in data['meta'])
+
+        data['results']['noop']['ops_per_sec'] *= 1000
+        with open(output, 'w') as f:
+            json.dump(data, f)
+        self.assertEqual(harness.main(
+            cases, ['--min-time', '0.001', '--repeat', '1', '-c', output],
+            out=out), 1)
+        self.assertTrue('REGRESSION' in out.getvalue())
+
+
+class TestHotPaths(VumiTestCase):
+
+    def test_cases_run(self):
+        cases = hot_paths.make_cases()
+        names = [name for name, _ in cases]
+        self.assertTrue('cycle.new' in names)
+        self.assertTrue('generate_body.hostile' in names)
+        for name, func in cases:
+            func()
+
+    def test_capture_flushed(self):
+        capture_dir = self.mktemp()
+        os.mkdir(capture_dir)
+        cases = dict(hot_paths.make_cases(capture_dir))
+        # Enough cycles to fill the writer's buffer a few times
+        for _ in range(2000):
+            cases['cycle.resume.capture']()
+        [capture] = os.listdir(capture_dir)
+        self.assertTrue(
+            os.path.getsize(os.path.join(capture_dir, capture)) > 64 * 1024)
+
+
+class TestLogOverhead(VumiTestCase):
+
+    def test_cases_run(self):
+        observer = log_overhead.LevelObserver()
+        log.addObserver(observer)
+        self.add_cleanup(log.removeObserver, observer)
+        cases = log_overhead.make_cases(observer)
+        for name, func in cases:
+            if name == 'structured.written':
+                written = observer.written
+                func()
+                self.assertTrue(observer.written > written)
+            elif name == 'structured.filtered':
+                written = observer.written
+                func()
+                self.assertEqual(observer.written, written)
+            else:
+                func()
+
+
+class TestLoadgen(VumiTestCase):
+
+    @inlineCallbacks
+    def test_run_load(self):
+        options = loadgen.parse_args([
+            '--sessions', '4', '--concurrency', '2', '--depth', '3'])
+        results = yield loadgen.run_load(options)
+        self.assertEqual(results['completed_sessions'], 4)
+        self.assertEqual(results['hops'], 12)
+        self.assertEqual(results['acks'], 12)
+        self.assertEqual(results['timeouts'], 0)
+        self.assertEqual(results['http_errors'], 0)
+        self.assertEqual(results['failures'], 0)
+        self.assertTrue(results['latency_ms']['p99'] > 0)
+
+
+class TestOutbound(VumiTestCase):
+
+    @inlineCallbacks
+    def test_run_outbound(self):
+        options = outbound.parse_args([
+            '--burst', '20', '--prefetch', '5', '--repeat', '1'])
+        results = yield outbound.run_outbound(options)
+        self.assertEqual(
+            sorted(results), ['batched.prefetch_5', 'serial.prefetch_5'])
+        for result in results.values():
+            self.assertTrue(result['replies_per_sec'] > 0)
+
+
+class TestProcesses(VumiTestCase):
+
+    def test_spawn(self):
+        child = processes.spawn([
+            sys.executable, '-c',
+            'import os, sys; sys.stdout.write(os.environ["PYTHONPATH"])'])
+        output = child.communicate()[0]
+        self.assertEqual(
+            output.split(os.pathsep)[0], processes.PACKAGE_ROOT)
+
+    def test_reserve_port(self):
+        if SO_REUSEPORT is None:
+            self.skipTest('SO_REUSEPORT is not supported here')
+        reserved = processes.reserve_port()
+        self.add_cleanup(reserved.close)
+        sock = reuse_port_socket(reserved.getsockname()[1], '127.0.0.1')
+        sock.close()
+
+
+class TestReplay(VumiTestCase):
+
+    def setUp(self):
+        tempdir = tempfile.mkdtemp()
+        self.add_cleanup(shutil.rmtree, tempdir)
+        self.path = os.path.join(tempdir, 'capture')
+        writer = CaptureWriter(self.path)
+        for i, (session, request, to_addr) in enumerate([
+                ('s1', '*1234#', None),
+                ('s2', '*1234#', None),
+                ('s1', '1', '*1234#'),
+                ('s2', '0', '*1234#'),
+                ('s1', '0', '*1234#')]):
+            args = {
+                'msisdn': ['2770%s' % (session,)],
+                'provider': ['MTN'],
+                'ussdSessionId': [session],
+                'request': [request],
+            }
+            if to_addr is not None:
+                args['to_addr'] = [to_addr]
+            writer.request(i, 100 + i * 0.01, args)
+            writer.reply(i, 100.5 + i * 0.01, 200)
+        writer.close()
+
+    def test_group_sessions(self):
+        requests = replay.load_requests(replay.find_files([self.path]))
+        [s1, s2] = replay.group_sessions(requests)
+        self.assertEqual(
+            [r.args['request'] for r in s1], ['*1234#', '1', '0'])
+        self.assertEqual([r.args['request'] for r in s2], ['*1234#', '0'])
+
+    @inlineCallbacks
+    def test_run_replay(self):
+        requests = replay.load_requests(replay.find_files([self.path]))
+        for speed in ['max', '10']:
+            options = replay.parse_args([self.path, '--speed', speed])
+            results = yield replay.run_replay(options, requests)
+            self.assertEqual(results['requests'], 5)
+            self.assertEqual(results['sessions'], 2)
+            self.assertEqual(results['completed_sessions'], 2)
+            self.assertEqual(results['hops'], 5)
+            self.assertEqual(results['acks'], 5)
+            self.assertEqual(results['http_errors'], 0)
+            self.assertAlmostEqual(
+                results['recorded_latency_ms']['max'], 500)
+        self.assertTrue(results['lag_ms']['max'] >= 0)
+
+
+class TestScale(VumiTestCase):
+
+    def test_split(self):
+        self.assertEqual(scale._split(10, 3), [4, 3, 3])
+        self.assertEqual(scale._split(2, 3), [1, 1, 0])
+
+    def test_run_scale(self):
+        if SO_REUSEPORT is None:
+            self.skipTest('SO_REUSEPORT is not supported here')
+        argv = [
+            '--processes', '1,2', '--gateway-processes', '1',
+            '--sessions', '4', '--concurrency', '2', '--depth', '2',
+            '--forward-fraction', '1']
+        [one, two] = scale.run_scale(argv, scale.parse_args(argv))
+        self.assertEqual(one['processes'], 1)
+        self.assertEqual(two['processes'], 2)
+        for result in [one, two]:
+            self.assertEqual(result['completed_sessions'], 4)
+            self.assertEqual(result['hops'], 8)
+            self.assertEqual(result['acks'], 8)
+            self.assertEqual(result['forwarded'], 8)
+            self.assertEqual(result['timeouts'], 0)
+
+
+class TestSoak(VumiTestCase):
+
+    def test_run_soak(self):
+        options = soak.parse_args([
+            '--sessions', '300', '--warmup', '100', '--probe', '100',
+            '--abandon-rate', '0.2', '--unanswered-rate', '0.1'])
+        results = soak.run_soak(options)
+        self.assertEqual(results['requests'], results['messages'])
+        self.assertTrue(results['abandoned'] > 0)
+        self.assertTrue(results['unanswered'] > 0)
+        self.assertTrue(results['bytes_per_outstanding_request'] > 0)
+        self.assertTrue(results['passed'], results['top_growth'])
+
+    def test_run_soak_with_caches(self):
+        tempdir = tempfile.mkdtemp()
+        self.add_cleanup(shutil.rmtree, tempdir)
+        options = soak.parse_args([
+            '--sessions', '300', '--warmup', '100', '--probe', '100',
+            '--abandon-rate', '0.2', '--unanswered-rate', '0.1',
+            '--transport-config', json.dumps({
+                'dedup_window': 5,
+                'page_budget': 10,
+                'capture_path': os.path.join(tempdir, 'capture'),
+            })])
+        results = soak.run_soak(options)
+        self.assertTrue(results['abandoned'] > 0)
+        self.assertTrue(results['passed'], results['top_growth'])
+
+    def test_settle_time(self):
+        transport = harness.make_transport({
+            'request_timeout': 30, 'session_idle_timeout': 60})
+        self.add_cleanup(harness.teardown_transport, transport)
+        self.assertEqual(soak.settle_time(transport), 61)
+
+
+class TestStats(VumiTestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(stats.percentile(values, 50), 50)
+        self.assertEqual(stats.percentile(values, 99), 99)
+        self.assertEqual(stats.percentile(values, 100), 100)
+        self.assertEqual(stats.percentile([7], 95), 7)
+        self.assertEqual(stats.percentile([], 95), None)
+
+    def test_latency_summary(self):
+        summary = stats.latency_summary([0.001, 0.002, 0.003, 0.004])
+        self.assertEqual(summary['p50'], 2.0)
+        self.assertEqual(summary['max'], 4.0)
+        self.assertEqual(stats.latency_summary([]), {})
@@ -0,0 +1,140 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.cache import LRUCache, TTLCache
+
+
+class TestLRUCache(VumiTestCase):
+
+    def test_get_set(self):
+        cache = LRUCache(2)
+        cache.set('a', b'1')
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('b', b'x'), b'x')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_invalid_maxsize(self):
+        self.assertRaises(ValueError, LRUCache, 0)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+        cache.get('a')
+        cache.set('c', b'3')
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_replace_does_not_evict(self):
+        cache = LRUCache(2, max_bytes=10)
+        cache.set('a', b'1234')
+        cache.set('a', b'123456')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.bytes, 6)
+        self.assertEqual(cache.evictions, 0)
+
+    def test_max_bytes(self):
+        cache = LRUCache(10, max_bytes=10)
+        cache.set('a', b'1234')
+        cache.set('b', b'1234')
+        cache.set('c', b'1234')
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.bytes, 8)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_oversized_value_not_cached(self):
+        cache = LRUCache(10, max_bytes=4)
+        cache.set('a', b'1234')
+        cache.set('b', b'12345')
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+
+    def test_pop(self):
+        cache = LRUCache(10, max_bytes=10)
+        cache.set('a', b'1234')
+        self.assertEqual(cache.pop('a'), b'1234')
+        self.assertEqual(cache.pop('a'), None)
+        self.assertEqual(cache.bytes, 0)
+
+    def test_stats(self):
+        cache = LRUCache(1)
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+        cache.get('b')
+        cache.get('a')
+        self.assertEqual(cache.stats(), {
+            'size': 1,
+            'bytes': 0,
+            'hits': 1,
+            'misses': 1,
+            'evictions': 1,
+        })
+
+
+class TestTTLCache(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_get_set(self):
+        cache = TTLCache(self.clock, 10, 5)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertTrue('a' in cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_invalid_maxsize(self):
+        self.assertRaises(ValueError, TTLCache, self.clock, 10, 0)
+
+    def test_expires(self):
+        cache = TTLCache(self.clock, 10, 5)
+        cache.set('a', 1)
+        self.clock.advance(5)
+        cache.set('b', 2)
+        self.clock.advance(5)
+        self.assertEqual(cache.get('a'), None)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.expirations, 1)
+
+    def test_expire(self):
+        cache = TTLCache(self.clock, 10, 5)
+        cache.set('a', 1)
+        self.clock.advance(10)
+        self.assertEqual(len(cache._data), 1)
+        cache.expire()
+        self.assertEqual(len(cache._data), 0)
+        self.assertEqual(cache.expirations, 1)
+
+    def test_set_refreshes(self):
+        cache = TTLCache(self.clock, 10, 5)
+        cache.set('a', 1)
+        self.clock.advance(8)
+        cache.set('a', 2)
+        self.clock.advance(8)
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_evicts_oldest(self):
+        cache = TTLCache(self.clock, 10, 2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_pop(self):
+        cache = TTLCache(self.clock, 10, 2)
+        cache.set('a', 1)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a'), None)
+        cache.set('b', 2)
+        self.clock.advance(10)
+        self.assertEqual(cache.pop('b', 'gone'), 'gone')
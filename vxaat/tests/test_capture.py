@@ -0,0 +1,129 @@
+import os
+import shutil
+import struct
+import tempfile
+
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.capture import (
+    MAGIC, MAGIC_V1, REPLY, REQUEST, CaptureError, CaptureWriter,
+    capture_files, load_requests, read_records)
+
+
+class TestCapture(VumiTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.add_cleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'capture')
+
+    def test_round_trip(self):
+        writer = CaptureWriter(self.path)
+        writer.request('req-1', 10.0, {
+            b'msisdn': [b'27729042520'], b'request': [b'*1234#']})
+        writer.request(
+            'req-2', 10.5, {b'msisdn': [u'\u263a'.encode('utf-8')]})
+        writer.reply('req-1', 10.25, 200)
+        writer.close()
+        self.assertEqual(writer.files, [self.path + '.0'])
+        self.assertEqual(list(read_records(self.path + '.0')), [
+            (REQUEST, 0, 10.0, {
+                b'msisdn': b'27729042520', b'request': b'*1234#'}),
+            (REQUEST, 1, 10.5, {b'msisdn': u'\u263a'.encode('utf-8')}),
+            (REPLY, 0, 0.25, 200),
+        ])
+
+    def test_buffered(self):
+        writer = CaptureWriter(self.path, buffer_bytes=1024)
+        writer.request('req-1', 10.0, {b'msisdn': [b'27729042520']})
+        self.assertEqual(writer.files, [])
+        writer.flush()
+        self.assertEqual(len(list(read_records(self.path + '.0'))), 1)
+        writer.request('req-2', 10.0, {b'msisdn': [b'x' * 1024]})
+        self.assertEqual(len(list(read_records(self.path + '.0'))), 2)
+        writer.close()
+
+    def test_buffered_with_clock(self):
+        clock = Clock()
+        writer = CaptureWriter(self.path, buffer_bytes=1024, clock=clock)
+        writer.request('req-1', 10.0, {b'msisdn': [b'x' * 1024]})
+        writer.request('req-2', 10.0, {b'msisdn': [b'x' * 1024]})
+        self.assertEqual(writer.files, [])
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        clock.advance(0)
+        self.assertEqual(len(list(read_records(self.path + '.0'))), 2)
+        writer.request('req-3', 10.0, {b'msisdn': [b'x' * 1024]})
+        writer.close()
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(len(list(read_records(self.path + '.0'))), 3)
+
+    def test_many_args(self):
+        args = dict((('arg%d' % (i,)).encode('ascii'), [b'x'])
+                    for i in range(300))
+        writer = CaptureWriter(self.path)
+        writer.request('req-1', 10.0, args)
+        writer.close()
+        [(_, _, _, recorded)] = read_records(self.path + '.0')
+        self.assertEqual(recorded, dict(
+            (name, values[0]) for name, values in args.items()))
+
+    def test_read_v1(self):
+        filename = self.path + '.0'
+        with open(filename, 'wb') as f:
+            f.write(MAGIC_V1)
+            f.write(struct.pack('<cIdB', REQUEST, 0, 10.0, 1))
+            f.write(struct.pack('<BH', 6, 3) + b'msisdnabc')
+            f.write(struct.pack('<cIdH', REPLY, 0, 0.25, 200))
+        self.assertEqual(list(read_records(filename)), [
+            (REQUEST, 0, 10.0, {b'msisdn': b'abc'}),
+            (REPLY, 0, 0.25, 200),
+        ])
+
+    def test_reply_to_unknown_request(self):
+        writer = CaptureWriter(self.path)
+        writer.reply('req-1', 10.0, 200)
+        writer.close()
+        self.assertEqual(writer.files, [])
+
+    def test_rotation(self):
+        # An existing capture file is not overwritten
+        open(self.path + '.0', 'wb').close()
+        writer = CaptureWriter(self.path, max_bytes=100, buffer_bytes=0)
+        for i in range(6):
+            writer.request(i, float(i), {b'msisdn': [b'27729042520']})
+            writer.reply(i, i + 0.5, 200)
+        writer.close()
+        self.assertEqual(len(writer.files), 4)
+        self.assertEqual(writer.files[0], self.path + '.1')
+        for filename in writer.files:
+            self.assertTrue(os.path.getsize(filename) <= 100)
+        self.assertEqual(capture_files(self.path), [
+            self.path + '.%d' % (i,) for i in range(5)])
+        requests = load_requests(writer.files)
+        self.assertEqual(
+            [r.timestamp for r in requests], [0.0, 1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual([r.latency for r in requests], [0.5] * 6)
+        self.assertEqual([r.code for r in requests], [200] * 6)
+
+    def test_truncated(self):
+        writer = CaptureWriter(self.path)
+        writer.request('req-1', 10.0, {b'msisdn': [b'27729042520']})
+        writer.request('req-2', 11.0, {b'msisdn': [b'27729042520']})
+        writer.close()
+        filename = writer.files[0]
+        with open(filename, 'rb+') as f:
+            f.truncate(os.path.getsize(filename) - 3)
+        [request] = load_requests([filename])
+        self.assertEqual(request.timestamp, 10.0)
+        self.assertEqual(request.latency, None)
+
+    def test_not_a_capture(self):
+        filename = os.path.join(self.tempdir, 'other')
+        with open(filename, 'wb') as f:
+            f.write(b'x' * len(MAGIC))
+        self.assertRaises(CaptureError, list, read_records(filename))
+        with open(filename, 'wb') as f:
+            f.write(MAGIC + b'Z')
+        self.assertRaises(CaptureError, list, read_records(filename))
@@ -0,0 +1,83 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.deadlines import DeadlineQueue
+
+
+class TestDeadlineQueue(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.expired = []
+        self.queue = DeadlineQueue(self.clock, self.expired.append)
+
+    def test_expire(self):
+        self.queue.schedule('a', 2)
+        self.queue.schedule('b', 1)
+        self.queue.schedule('c', 3)
+        self.assertEqual(len(self.queue), 3)
+        self.clock.advance(1)
+        self.assertEqual(self.expired, ['b'])
+        self.clock.advance(1.5)
+        self.assertEqual(self.expired, ['b', 'a'])
+        self.assertTrue('c' in self.queue)
+        self.clock.advance(1)
+        self.assertEqual(self.expired, ['b', 'a', 'c'])
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_single_timer(self):
+        for i in range(100):
+            self.queue.schedule(i, 10 + i)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_earlier_deadline_resets_timer(self):
+        self.queue.schedule('a', 10)
+        self.queue.schedule('b', 5)
+        self.clock.advance(5)
+        self.assertEqual(self.expired, ['b'])
+
+    def test_cancel(self):
+        self.queue.schedule('a', 1)
+        self.queue.schedule('b', 2)
+        self.queue.cancel('a')
+        self.queue.cancel('unknown')
+        self.clock.advance(2)
+        self.assertEqual(self.expired, ['b'])
+
+    def test_cancel_last_stops_timer(self):
+        self.queue.schedule('a', 1)
+        self.queue.cancel('a')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.queue.schedule('b', 2)
+        self.clock.advance(2)
+        self.assertEqual(self.expired, ['b'])
+
+    def test_reschedule(self):
+        self.queue.schedule('a', 1)
+        self.queue.schedule('a', 3)
+        self.clock.advance(2)
+        self.assertEqual(self.expired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.expired, ['a'])
+
+    def test_schedule_from_expired(self):
+        def expired(key):
+            self.expired.append(key)
+            if key == 'a':
+                self.queue.schedule('c', self.clock.seconds() + 5)
+
+        queue = self.queue = DeadlineQueue(self.clock, expired)
+        queue.schedule('a', 1)
+        queue.schedule('b', 2)
+        self.clock.advance(1)
+        self.clock.advance(1)
+        self.assertEqual(self.expired, ['a', 'b'])
+        self.clock.advance(4)
+        self.assertEqual(self.expired, ['a', 'b', 'c'])
+
+    def test_stop(self):
+        self.queue.schedule('a', 1)
+        self.queue.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,63 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.dedup import Deduplicator
+
+
+class TestDeduplicator(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.dedup = Deduplicator(self.clock, 5, 10)
+
+    def test_attach(self):
+        self.assertFalse(self.dedup.attach('k', 'req-1'))
+        self.dedup.register('k', 'req-1')
+        self.assertTrue(self.dedup.attach('k', 'req-2'))
+        self.assertTrue(self.dedup.attach('k', 'req-3'))
+        self.assertEqual(
+            self.dedup.finished('req-1', b'body'), ['req-2', 'req-3'])
+        self.assertEqual(len(self.dedup), 0)
+        self.assertEqual(self.dedup.suppressed, {'attached': 2, 'replayed': 0})
+
+    def test_replay(self):
+        self.dedup.register('k', 'req-1')
+        self.dedup.finished('req-1', b'body')
+        self.assertFalse(self.dedup.attach('k', 'req-2'))
+        self.assertEqual(self.dedup.replay('k'), b'body')
+        self.clock.advance(5)
+        self.assertEqual(self.dedup.replay('k'), None)
+        self.assertEqual(self.dedup.suppressed, {'attached': 0, 'replayed': 1})
+
+    def test_failure_not_replayed(self):
+        self.dedup.register('k', 'req-1')
+        self.dedup.attach('k', 'req-2')
+        self.assertEqual(
+            self.dedup.finished('req-1', b'timeout', False), ['req-2'])
+        self.assertEqual(self.dedup.replay('k'), None)
+
+    def test_finished_unknown(self):
+        self.assertEqual(self.dedup.finished('req-1', b'body'), [])
+
+    def test_lost(self):
+        self.dedup.register('k', 'req-1')
+        self.dedup.attach('k', 'req-2')
+        self.assertEqual(self.dedup.lost('req-1'), ['req-2'])
+        self.assertEqual(len(self.dedup), 0)
+        self.assertFalse(self.dedup.attach('k', 'req-3'))
+        self.assertEqual(self.dedup.replay('k'), None)
+        self.assertEqual(self.dedup.lost('req-1'), [])
+
+    def test_cache_stats(self):
+        self.dedup.register('k', 'req-1')
+        self.dedup.finished('req-1', b'body')
+        self.dedup.replay('k')
+        self.clock.advance(5)
+        self.dedup.replay('k')
+        self.dedup.expire()
+        stats = self.dedup.cache_stats()
+        self.assertEqual(stats['size'], 0)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['expirations'], 1)
@@ -0,0 +1,61 @@
+from vumi.message import TransportUserMessage
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat import envelope
+
+
+def mk_message(compact, ussd_session_id='s1'):
+    return TransportUserMessage(
+        to_addr='*1234#',
+        from_addr='27729042520',
+        transport_name='aat_ussd',
+        transport_type='ussd',
+        provider='mtn',
+        helper_metadata=envelope.helper_metadata(ussd_session_id, compact),
+        transport_metadata={'aat_ussd': envelope.aat_metadata(
+            'mtn', ussd_session_id, 'worker-1', compact)})
+
+
+class TestEnvelope(VumiTestCase):
+
+    def test_aat_metadata(self):
+        self.assertEqual(envelope.aat_metadata('mtn', 's1'), {
+            'provider': 'mtn', 'ussd_session_id': 's1'})
+        self.assertEqual(envelope.aat_metadata('mtn', None), {
+            'provider': 'mtn', 'ussd_session_id': None})
+        self.assertEqual(
+            envelope.aat_metadata('mtn', 's1', 'worker-1', compact=True),
+            {'ussd_session_id': 's1', 'worker': 'worker-1'})
+        self.assertEqual(
+            envelope.aat_metadata('mtn', None, compact=True), {})
+
+    def test_helper_metadata(self):
+        self.assertEqual(envelope.helper_metadata('s1'), {'session_id': 's1'})
+        self.assertEqual(envelope.helper_metadata('s1', compact=True), {})
+
+    def test_accessors(self):
+        for compact in [False, True]:
+            msg = mk_message(compact)
+            self.assertEqual(envelope.get_provider(msg), 'mtn')
+            self.assertEqual(envelope.get_ussd_session_id(msg), 's1')
+            self.assertEqual(
+                envelope.get_ussd_session_id(mk_message(compact, None)),
+                None)
+
+    def test_accessors_other_places(self):
+        msg = mk_message(False)
+        msg['provider'] = None
+        msg['transport_metadata']['aat_ussd']['ussd_session_id'] = None
+        self.assertEqual(envelope.get_provider(msg), 'mtn')
+        self.assertEqual(envelope.get_ussd_session_id(msg), 's1')
+
+    def test_expand(self):
+        msg = envelope.expand(mk_message(True))
+        full = mk_message(False)
+        self.assertEqual(msg['helper_metadata'], full['helper_metadata'])
+        self.assertEqual(
+            msg['transport_metadata'], full['transport_metadata'])
+        msg = envelope.expand(mk_message(False))
+        self.assertEqual(msg['helper_metadata'], full['helper_metadata'])
+        self.assertEqual(
+            msg['transport_metadata'], full['transport_metadata'])
@@ -0,0 +1,78 @@
+from twisted.python import log
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.eventlog import EventLog, EventRecord, format_value
+
+
+class Formatted(object):
+    formatted = 0
+
+    def __str__(self):
+        Formatted.formatted += 1
+        return 'formatted'
+
+
+class TestEventRecord(VumiTestCase):
+
+    def test_format_value(self):
+        self.assertEqual(format_value(u'*1234#'), '*1234#')
+        self.assertEqual(format_value(0.25), '0.250000')
+        self.assertEqual(format_value(3), '3')
+        self.assertEqual(format_value(None), 'None')
+        self.assertEqual(format_value(u'a b'), '"a b"')
+        self.assertEqual(format_value(u''), '""')
+        self.assertEqual(format_value(u'\u263a'), '"\\u263a"')
+
+    def test_str(self):
+        record = EventRecord('inbound', {
+            'message_id': 'abc', 'to_addr': u'*1234#', 'latency': 0.5})
+        self.assertEqual(
+            str(record), 'inbound latency=0.500000 message_id=abc '
+            'to_addr=*1234#')
+
+
+class TestEventLog(VumiTestCase):
+
+    def setUp(self):
+        self.infos = []
+        self.warnings = []
+        self.event_log = EventLog(
+            lambda **kw: self.infos.append(kw),
+            lambda **kw: self.warnings.append(kw),
+            {'inbound': 0.1, 'outbound': 0})
+
+    def test_info(self):
+        self.event_log.info('next_page', message_id='abc')
+        [kw] = self.infos
+        self.assertEqual(kw['aat_event'], 'next_page')
+        self.assertEqual(kw['aat_fields'], {'message_id': 'abc'})
+        self.assertEqual(
+            log.textFromEventDict(dict(kw, message=(), isError=0)),
+            'next_page message_id=abc')
+
+    def test_sampled(self):
+        for i in range(25):
+            self.event_log.info('inbound', n=i)
+            self.event_log.info('outbound', n=i)
+        self.assertEqual(
+            [kw['aat_fields']['n'] for kw in self.infos], [9, 19])
+
+    def test_warnings_not_sampled(self):
+        for i in range(3):
+            self.event_log.warning('outbound', n=i)
+        self.assertEqual(len(self.warnings), 3)
+
+    def test_formatted_lazily(self):
+        Formatted.formatted = 0
+        self.event_log.info('next_page', value=Formatted())
+        self.event_log.info('inbound', value=Formatted())
+        self.assertEqual(Formatted.formatted, 0)
+        log.textFromEventDict(dict(self.infos[0], message=(), isError=0))
+        self.assertEqual(Formatted.formatted, 1)
+
+    def test_invalid_rate(self):
+        self.assertRaises(
+            ValueError, EventLog, None, None, {'inbound': 2})
+        self.assertRaises(
+            ValueError, EventLog, None, None, {'inbound': 'often'})
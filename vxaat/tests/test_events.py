@@ -0,0 +1,64 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.events import EventBatcher
+
+
+class TestEventBatcher(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.published = []
+        self.flushes = []
+
+    def mk_batcher(self, interval=0, max_size=10):
+        return EventBatcher(
+            self.clock, self.published.append, interval, max_size,
+            lambda size, reason: self.flushes.append((size, reason)))
+
+    def test_next_turn(self):
+        batcher = self.mk_batcher()
+        batcher.add('a')
+        batcher.add('b')
+        self.assertEqual(self.published, [])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0)
+        self.assertEqual(self.published, ['a', 'b'])
+        self.assertEqual(self.flushes, [(2, 'timer')])
+        self.assertEqual(len(batcher), 0)
+
+    def test_interval(self):
+        batcher = self.mk_batcher(interval=0.05)
+        batcher.add('a')
+        self.clock.advance(0.03)
+        batcher.add('b')
+        self.assertEqual(self.published, [])
+        self.clock.advance(0.02)
+        self.assertEqual(self.published, ['a', 'b'])
+        batcher.add('c')
+        self.clock.advance(0.05)
+        self.assertEqual(self.published, ['a', 'b', 'c'])
+
+    def test_full(self):
+        batcher = self.mk_batcher(interval=1, max_size=2)
+        batcher.add('a')
+        batcher.add('b')
+        self.assertEqual(self.published, ['a', 'b'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        batcher.add('c')
+        self.clock.advance(1)
+        self.assertEqual(self.published, ['a', 'b', 'c'])
+        self.assertEqual(self.flushes, [(2, 'full'), (1, 'timer')])
+
+    def test_stop(self):
+        batcher = self.mk_batcher(interval=1)
+        batcher.add('a')
+        self.assertEqual(batcher.stop(), [None])
+        self.assertEqual(self.published, ['a'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(batcher.stop(), [])
+        self.assertEqual(self.flushes, [(1, 'stop')])
+
+    def test_invalid_max_size(self):
+        self.assertRaises(ValueError, self.mk_batcher, max_size=0)
@@ -0,0 +1,41 @@
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.memory import MemorySnapshot, tracing
+
+
+class Held(object):
+    pass
+
+
+class TestMemorySnapshot(VumiTestCase):
+
+    def test_take(self):
+        before = MemorySnapshot.take()
+        held = [Held() for _ in range(100)]
+        after = MemorySnapshot.take()
+        self.assertEqual(after.kind, 'site' if tracing() else 'type')
+        self.assertTrue(after.total > before.total)
+        if after.kind == 'type':
+            self.assertTrue({
+                'site': 'vxaat.tests.test_memory.Held',
+                'bytes': after.sizes['vxaat.tests.test_memory.Held'],
+                'count': 100,
+            } in after.compare(before, 100))
+        del held
+
+    def test_top(self):
+        snapshot = MemorySnapshot(
+            'type', {'a': 10, 'b': 30, 'c': 20}, {'a': 1, 'b': 3, 'c': 2})
+        self.assertEqual(snapshot.total, 60)
+        self.assertEqual(snapshot.top(2), [
+            {'site': 'b', 'bytes': 30, 'count': 3},
+            {'site': 'c', 'bytes': 20, 'count': 2},
+        ])
+
+    def test_compare(self):
+        older = MemorySnapshot('type', {'a': 10, 'b': 30}, {'a': 1, 'b': 3})
+        newer = MemorySnapshot('type', {'a': 10, 'c': 20}, {'a': 1, 'c': 2})
+        self.assertEqual(newer.compare(older), [
+            {'site': 'b', 'bytes': -30, 'count': -3},
+            {'site': 'c', 'bytes': 20, 'count': 2},
+        ])
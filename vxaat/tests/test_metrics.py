@@ -0,0 +1,121 @@
+from twisted.internet.task import Clock
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.metrics import (
+    Counters, Histogram, LatencyTracker, SessionMetrics, metric_name_part)
+from vxaat.sessions import SessionRecord
+
+
+def values(manager, name):
+    return [value for _, value in manager[name].poll()]
+
+
+class TestMetricNamePart(VumiTestCase):
+
+    def test_safe(self):
+        self.assertEqual(metric_name_part('mtn'), 'mtn')
+        self.assertEqual(metric_name_part('cell-c_2'), 'cell-c_2')
+
+    def test_unsafe(self):
+        self.assertEqual(metric_name_part('Cell C.za'), 'Cell_C_za')
+        self.assertEqual(metric_name_part(''), '_')
+        self.assertEqual(metric_name_part(None), 'None')
+
+
+class TestHistogram(VumiTestCase):
+
+    def test_record(self):
+        manager = MetricManager('vumi.test.')
+        histogram = Histogram(manager, 'latency', [0.5, 2])
+        histogram.record(0.1)
+        histogram.record(1.0)
+        histogram.record(3.0)
+        self.assertEqual(values(manager, 'latency'), [0.1, 1.0, 3.0])
+        self.assertEqual(manager['latency'].aggs, ('avg', 'max', 'min'))
+        self.assertEqual(values(manager, 'latency.le_500ms'), [1.0])
+        self.assertEqual(values(manager, 'latency.le_2000ms'), [1.0, 1.0])
+        self.assertEqual(values(manager, 'latency.le_inf'), [1.0] * 3)
+
+
+class TestLatencyTracker(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.manager = MetricManager('vumi.test.')
+        self.tracker = LatencyTracker(self.manager, self.clock, [1])
+
+    def test_finish(self):
+        self.tracker.start('msg-1', 'mtn', 'new')
+        self.clock.advance(0.25)
+        self.tracker.finish('msg-1')
+        self.assertEqual(values(self.manager, 'latency.mtn.new'), [0.25])
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_finish_unknown(self):
+        self.tracker.finish('msg-1')
+        self.assertFalse('latency.mtn.new' in self.manager)
+
+    def test_finish_late(self):
+        self.tracker.start('msg-1', 'mtn', 'resume')
+        self.clock.advance(3)
+        self.tracker.expire('msg-1')
+        self.assertEqual(len(self.tracker), 0)
+        self.clock.advance(2)
+        self.tracker.finish_late('msg-1')
+        self.assertEqual(
+            values(self.manager, 'late_latency.mtn.resume'), [5])
+        self.assertFalse('latency.mtn.resume' in self.manager)
+
+    def test_finish_late_pending(self):
+        self.tracker.start('msg-1', 'mtn', 'resume')
+        self.clock.advance(1)
+        self.tracker.finish_late('msg-1')
+        self.assertEqual(
+            values(self.manager, 'late_latency.mtn.resume'), [1])
+
+    def test_same_metric_name(self):
+        self.tracker.start('msg-1', 'MTN NG', 'new')
+        self.tracker.start('msg-2', 'MTN.NG', 'new')
+        self.tracker.finish('msg-1')
+        self.tracker.finish('msg-2')
+        self.assertEqual(values(self.manager, 'latency.MTN_NG.new'), [0, 0])
+
+    def test_late_cache_bounded(self):
+        tracker = LatencyTracker(
+            self.manager, self.clock, [1], late_maxsize=1)
+        tracker.start('msg-1', 'mtn', 'new')
+        tracker.start('msg-2', 'mtn', 'new')
+        tracker.expire('msg-1')
+        tracker.expire('msg-2')
+        tracker.finish_late('msg-1')
+        self.assertFalse('late_latency.mtn.new' in self.manager)
+        tracker.finish_late('msg-2')
+        self.assertEqual(values(self.manager, 'late_latency.mtn.new'), [0])
+
+
+class TestCounters(VumiTestCase):
+
+    def test_inc(self):
+        manager = MetricManager('vumi.test.')
+        counters = Counters(manager, 'rejected')
+        counters.inc('mtn')
+        counters.inc('MTN NG')
+        counters.inc('MTN.NG')
+        self.assertEqual(values(manager, 'rejected.mtn'), [1.0])
+        self.assertEqual(values(manager, 'rejected.MTN_NG'), [1.0, 1.0])
+
+
+class TestSessionMetrics(VumiTestCase):
+
+    def test_record(self):
+        manager = MetricManager('vumi.test.')
+        metrics = SessionMetrics(manager)
+        record = SessionRecord('sess-1', '27831234567', 'mtn', '*1234#', 5)
+        record.hops = 3
+        metrics.record(record, 12, 'idle')
+        metrics.record(record, 13, 'idle')
+        self.assertEqual(values(manager, 'session.hops'), [3, 3])
+        self.assertEqual(values(manager, 'session.duration'), [7, 8])
+        self.assertEqual(values(manager, 'session.ended.idle'), [1.0, 1.0])
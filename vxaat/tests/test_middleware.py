@@ -0,0 +1,21 @@
+from vumi.message import TransportUserMessage
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.middleware import ExpandEnvelopeMiddleware
+
+
+class TestExpandEnvelopeMiddleware(VumiTestCase):
+
+    def test_handle_inbound(self):
+        mw = ExpandEnvelopeMiddleware('expand_envelope', {}, None)
+        msg = TransportUserMessage(
+            to_addr='*1234#',
+            from_addr='27729042520',
+            transport_name='aat_ussd',
+            transport_type='ussd',
+            provider='mtn',
+            transport_metadata={'aat_ussd': {'ussd_session_id': 's1'}})
+        msg = mw.handle_inbound(msg, 'aat_ussd')
+        self.assertEqual(msg['helper_metadata'], {'session_id': 's1'})
+        self.assertEqual(msg['transport_metadata'], {'aat_ussd': {
+            'provider': 'mtn', 'ussd_session_id': 's1'}})
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.paging import MIN_BUDGET, capacity, is_gsm7, paginate
+
+
+class TestPaging(VumiTestCase):
+
+    def test_is_gsm7(self):
+        self.assertTrue(is_gsm7(u'Hello @ £5 {ok} ÄÖ'))
+        self.assertFalse(is_gsm7(u'Ngiyabonga ē'))
+        self.assertFalse(is_gsm7(u'السلام'))
+
+    def test_capacity(self):
+        self.assertEqual(capacity(u'abc', 160)[1], 182)
+        self.assertEqual(capacity(u'abç', 160)[1], 80)
+
+    def test_fits(self):
+        self.assertEqual(paginate(u'x' * 182, 160), [u'x' * 182])
+
+    def test_breaks_at_whitespace(self):
+        text = u'one two three four five'
+        # 7 septets fit in 7 octets
+        pages = paginate(text, 7)
+        self.assertEqual(pages, [u'one two', u'three', u'four', u'five'])
+        self.assertEqual(u' '.join(pages), text)
+
+    def test_hard_break(self):
+        self.assertEqual(
+            paginate(u'abcdefghij', 4), [u'abcd', u'efgh', u'ij'])
+
+    def test_gsm7_extended_costs_two(self):
+        # 8 septets fit in 7 octets, each brace takes two
+        self.assertEqual(paginate(u'{{{{{', 7), [u'{{{{', u'{'])
+
+    def test_ucs2(self):
+        self.assertEqual(
+            paginate(u'ēēēē ēēē', 8), [u'ēēēē', u'ēēē'])
+
+    def test_newlines(self):
+        self.assertEqual(
+            paginate(u'1. Yes\n2. No\n3. Maybe', 12),
+            [u'1. Yes\n2. No', u'3. Maybe'])
+
+    def test_budget_too_small(self):
+        self.assertRaises(ValueError, paginate, u'ē', 1)
+
+    def test_character_too_wide(self):
+        # A GSM 03.38 extension character takes two septets, an astral
+        # character a surrogate pair.
+        self.assertRaises(ValueError, paginate, u'a{', 1)
+        self.assertRaises(ValueError, paginate, u'x\U0001F600', 3)
+
+    def test_min_budget(self):
+        self.assertEqual(
+            paginate(u'{\U0001F600', MIN_BUDGET), [u'{', u'\U0001F600'])
+        self.assertEqual(paginate(u'{{{', MIN_BUDGET), [u'{{', u'{'])
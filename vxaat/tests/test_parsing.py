@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.parsing import AatRequest, RequestParser
+
+
+class TestRequestParser(VumiTestCase):
+
+    def mk_parser(self, strict=True):
+        return RequestParser(
+            ['msisdn', 'provider'],
+            ['request', 'ussdSessionId', 'to_addr'],
+            strict=strict)
+
+    def test_parse(self):
+        record, errors = self.mk_parser().parse({
+            'msisdn': [b'27729042520'],
+            'provider': [b'MTN'],
+            'request': [u'Thrëë'.encode('utf-8')],
+            'ussdSessionId': [b'1234', b'5678'],
+        })
+        self.assertEqual(errors, {})
+        self.assertEqual(record.msisdn, u'27729042520')
+        self.assertEqual(record.provider, u'MTN')
+        self.assertEqual(record.request, u'Thrëë')
+        self.assertEqual(record.ussd_session_id, u'1234')
+        self.assertEqual(record.to_addr, None)
+
+    def test_empty_values_not_missing(self):
+        record, errors = self.mk_parser().parse({
+            'msisdn': [b''], 'provider': [b''],
+        })
+        self.assertEqual(errors, {})
+        self.assertEqual(record.msisdn, u'')
+
+    def test_missing(self):
+        _, errors = self.mk_parser().parse({'request': [b'*1234#']})
+        self.assertEqual(
+            sorted(errors['missing_parameter']), ['msisdn', 'provider'])
+        self.assertEqual(list(errors), ['missing_parameter'])
+
+    def test_unexpected(self):
+        _, errors = self.mk_parser().parse({
+            'msisdn': [b'27729042520'], 'provider': [b'MTN'], 'foo': [b''],
+        })
+        self.assertEqual(errors, {'unexpected_parameter': ['foo']})
+
+    def test_unexpected_permissive(self):
+        record, errors = self.mk_parser(strict=False).parse({
+            'msisdn': [b'27729042520'], 'provider': [b'MTN'], 'foo': [b''],
+        })
+        self.assertEqual(errors, {})
+        self.assertEqual(record.provider, u'MTN')
+
+    def test_record_shape(self):
+        record = AatRequest(msisdn=u'123')
+        self.assertRaises(AttributeError, setattr, record, 'foo', 1)
+        self.assertEqual(record.provider, None)
@@ -0,0 +1,97 @@
+import marshal
+import threading
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.profiling import FunctionTimes, Profile, StackSampler
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+class FakeTimer(object):
+    def __init__(self, *times):
+        self.times = list(times)
+
+    def __call__(self):
+        return self.times.pop(0)
+
+
+class TestFunctionTimes(VumiTestCase):
+
+    def test_wrap(self):
+        times = FunctionTimes(FakeTimer(1.0, 1.5, 2.0, 2.25))
+        timed = times.wrap('busy', busy)
+        self.assertEqual(timed.__name__, 'busy')
+        self.assertEqual(timed(3), 5)
+        self.assertEqual(timed(3), 5)
+        self.assertEqual(times.snapshot(), {'busy': {
+            'calls': 2,
+            'total_ms': 750.0,
+            'max_ms': 500.0,
+            'mean_us': 375000.0,
+        }})
+
+    def test_totals(self):
+        times = FunctionTimes(FakeTimer(1.0, 1.5, 2.0, 2.25))
+        timed = times.wrap('busy', busy)
+        times.wrap('idle', busy)
+        timed(3)
+        timed(3)
+        self.assertEqual(times.totals(), {'busy': 0.75, 'idle': 0.0})
+
+    def test_wrap_error(self):
+        times = FunctionTimes(FakeTimer(1.0, 1.5))
+        timed = times.wrap('busy', busy)
+        self.assertRaises(TypeError, timed, None)
+        self.assertEqual(times.snapshot()['busy']['calls'], 1)
+
+    def test_snapshot_no_calls(self):
+        times = FunctionTimes()
+        times.wrap('busy', busy)
+        self.assertEqual(times.snapshot()['busy']['mean_us'], 0.0)
+
+
+class TestProfile(VumiTestCase):
+
+    def test_profile(self):
+        profile = Profile()
+        profile.start()
+        busy(100)
+        profile.stop()
+        self.assertTrue('busy' in profile.text())
+        self.assertTrue('busy' in profile.text())
+        stats = marshal.loads(profile.dump())
+        self.assertTrue(any(name == 'busy' for _, _, name in stats))
+
+
+class TestStackSampler(VumiTestCase):
+
+    def test_sample(self):
+        sampler = StackSampler(threading.current_thread().ident)
+        sampler.sample()
+        sampler.sample()
+        self.assertEqual(sampler.samples, 2)
+        [(stack, count)] = sampler.counts.items()
+        self.assertEqual(count, 2)
+        self.assertTrue(stack.endswith(':test_sample;%s:sample' % (
+            StackSampler.sample.__code__.co_filename,)))
+        self.assertEqual(sampler.collapsed(), '%s 2\n' % (stack,))
+
+    def test_unknown_thread(self):
+        sampler = StackSampler(-1)
+        sampler.sample()
+        self.assertEqual(sampler.samples, 0)
+        self.assertEqual(sampler.collapsed(), '')
+
+    def test_start_stop(self):
+        stopped = threading.Event()
+        sampler = StackSampler(threading.current_thread().ident, 0.001)
+        sampler.start()
+        while sampler.samples < 2:
+            stopped.wait(0.001)
+        sampler.stop()
+        samples = sampler.samples
+        stopped.wait(0.01)
+        self.assertEqual(sampler.samples, samples)
@@ -0,0 +1,108 @@
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.providers import ProviderNormaliser, ProviderRuleError
+
+
+class TestProviderNormaliser(VumiTestCase):
+
+    RULES = [
+        {'match': 'iexact', 'value': 'Vodacom', 'provider': 'vodacom'},
+        {'match': 'prefix', 'value': 'CELL', 'provider': 'cellc'},
+        {'match': 'prefix', 'value': 'CELLC-TEST', 'provider': 'cellc-test'},
+        {'match': 'regex', 'value': r'^tk\d+$', 'provider': 'telkom'},
+    ]
+
+    def mk_normaliser(self, **kw):
+        self.warnings = []
+        kw.setdefault('warn', self.warnings.append)
+        return ProviderNormaliser({'MTN': 'mtn'}, self.RULES, **kw)
+
+    def test_exact(self):
+        normaliser = self.mk_normaliser()
+        self.assertEqual(normaliser.normalise('MTN'), 'mtn')
+        self.assertEqual(normaliser.match('mtn'), None)
+
+    def test_providers(self):
+        normaliser = self.mk_normaliser()
+        self.assertEqual(normaliser.providers, set([
+            'mtn', 'vodacom', 'cellc', 'cellc-test', 'telkom']))
+
+    def test_iexact(self):
+        normaliser = self.mk_normaliser()
+        self.assertEqual(normaliser.normalise('VODACOM'), 'vodacom')
+        self.assertEqual(normaliser.normalise('vodacom'), 'vodacom')
+
+    def test_prefix_longest_first(self):
+        normaliser = self.mk_normaliser()
+        self.assertEqual(normaliser.normalise('CELLC'), 'cellc')
+        self.assertEqual(normaliser.normalise('CELLC-TEST-1'), 'cellc-test')
+
+    def test_regex(self):
+        normaliser = self.mk_normaliser()
+        self.assertEqual(normaliser.normalise('tk12'), 'telkom')
+        self.assertEqual(normaliser.normalise('tk12x'), 'tk12x')
+
+    def test_exact_wins(self):
+        normaliser = ProviderNormaliser(
+            {'CELL': 'exact'}, self.RULES, warn=lambda msg: None)
+        self.assertEqual(normaliser.normalise('CELL'), 'exact')
+
+    def test_memoised(self):
+        normaliser = self.mk_normaliser()
+        normaliser.normalise('CELLC')
+        normaliser.match = None
+        self.assertEqual(normaliser.normalise('CELLC'), 'cellc')
+
+    def test_cache_stats(self):
+        normaliser = self.mk_normaliser(cache_size=1)
+        normaliser.normalise('CELLC')
+        normaliser.normalise('CELLC')
+        normaliser.normalise('MTN')
+        stats = normaliser.cache_stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_unknown_warns_once(self):
+        normaliser = self.mk_normaliser()
+        for _ in range(3):
+            self.assertEqual(normaliser.normalise('Tim'), 'Tim')
+        self.assertEqual(self.warnings, [
+            "No mapping exists for provider 'Tim', using 'Tim' as a fallback",
+        ])
+        self.assertEqual(normaliser.unknown_counts, {'Tim': 3})
+
+    def test_log_summary(self):
+        normaliser = self.mk_normaliser()
+        for provider in ['Tim', 'Tim', 'Arthur']:
+            normaliser.normalise(provider)
+        del self.warnings[:]
+        normaliser.log_summary()
+        self.assertEqual(self.warnings, [
+            "Messages from unmapped providers since the last summary: "
+            "'Tim' (2), 'Arthur' (1)",
+        ])
+        normaliser.log_summary()
+        self.assertEqual(len(self.warnings), 1)
+
+    def test_log_summary_limit(self):
+        normaliser = self.mk_normaliser(cache_size=2)
+        for provider in ['Tim', 'Tim', 'Arthur', 'Lancelot']:
+            normaliser.normalise(provider)
+        del self.warnings[:]
+        normaliser.log_summary(limit=1)
+        self.assertEqual(self.warnings, [
+            "Messages from unmapped providers since the last summary: "
+            "'Tim' (2) and 2 from others",
+        ])
+
+    def test_invalid_rules(self):
+        self.assertRaises(
+            ProviderRuleError, ProviderNormaliser, {},
+            [{'match': 'glob', 'value': '*', 'provider': 'x'}])
+        self.assertRaises(
+            ProviderRuleError, ProviderNormaliser, {},
+            [{'match': 'regex', 'value': '(', 'provider': 'x'}])
+        self.assertRaises(
+            ProviderRuleError, ProviderNormaliser, {}, [{'match': 'regex'}])
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+from xml.etree.ElementTree import Element, SubElement, tostring
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.render import (
+    escape_attrib, escape_text, parse_options, render_body)
+
+
+def etree_body(reply, callback, continue_session=True, menu=None):
+    """
+    The reference ElementTree implementation ``render_body`` replaces.
+    """
+    request = Element('request')
+    headertext = SubElement(request, 'headertext')
+    headertext.text = reply
+    if continue_session and menu:
+        options = SubElement(request, 'options')
+        for order, (command, label, option_callback) in enumerate(menu, 1):
+            option = SubElement(options, 'option', {
+                'command': command,
+                'order': str(order),
+                'callback': option_callback or callback,
+                'display': "true",
+            })
+            option.text = label
+    elif continue_session:
+        options = SubElement(request, 'options')
+        SubElement(options, 'option', {
+            'command': '1',
+            'order': '1',
+            'callback': callback,
+            'display': "false",
+        })
+    return tostring(request, encoding='utf-8')
+
+
+class TestRender(VumiTestCase):
+
+    CALLBACK = u'http://www.example.com/foo/api/aat/ussd/?to_addr=%2A1234%23'
+
+    REPLIES = [
+        u'We are the Knights Who Say ... Ni!',
+        u'Thrëë, my lord.',
+        u'السلام \U0001f600',
+        u'1. Yes\n2. No\n3. <Maybe> & "perhaps" \'later\'',
+        u'&amp; already escaped &lt;',
+        u'x' * 2000,
+        u'',
+        None,
+    ]
+
+    def assert_matches_etree(self, reply, callback, continue_session):
+        self.assertEqual(
+            render_body(reply, callback, continue_session),
+            etree_body(reply, callback, continue_session))
+
+    def test_matches_etree_continue(self):
+        for reply in self.REPLIES:
+            self.assert_matches_etree(reply, self.CALLBACK, True)
+
+    def test_matches_etree_close(self):
+        for reply in self.REPLIES:
+            self.assert_matches_etree(reply, self.CALLBACK, False)
+
+    def test_matches_etree_hostile_callback(self):
+        callbacks = [
+            u'http://example.com/?a=1&b=2',
+            u'http://example.com/?q="<quoted>"',
+            u'http://example.com/\nnewline',
+            u'http://exämple.com/',
+        ]
+        for callback in callbacks:
+            self.assert_matches_etree(u'Ni!', callback, True)
+
+    def test_matches_etree_options(self):
+        menus = [
+            [(u'1', u'Yes', None), (u'2', u'No', None)],
+            [(u'1', u'Thrëë & <four>', u'http://example.com/?a=1&b="2"')],
+            [(u'*', u'', None), (u'#', None, None)],
+            [(str(i), u'Option %d' % (i,), None) for i in range(12)],
+        ]
+        for menu in menus:
+            self.assertEqual(
+                render_body(u'Choose', self.CALLBACK, True, menu),
+                etree_body(u'Choose', self.CALLBACK, True, menu))
+
+    def test_options_ignored_on_close(self):
+        menu = [(u'1', u'Yes', None)]
+        self.assertEqual(
+            render_body(u'Bye', self.CALLBACK, False, menu),
+            etree_body(u'Bye', self.CALLBACK, False))
+
+    def test_bytes_input(self):
+        self.assertEqual(
+            render_body(b'Thr\xc3\xab\xc3\xab', b'http://example.com/', True),
+            render_body(u'Thrëë', u'http://example.com/', True))
+
+    def test_escape_text(self):
+        self.assertEqual(escape_text(u'<a & "b">'), b'&lt;a &amp; "b"&gt;')
+        self.assertEqual(escape_text(u'ë'), b'\xc3\xab')
+
+    def test_escape_attrib(self):
+        self.assertEqual(
+            escape_attrib(u'<a & "b">\n'),
+            b'&lt;a &amp; &quot;b&quot;&gt;&#10;')
+
+    def test_parse_options(self):
+        self.assertEqual(parse_options(None), None)
+        self.assertEqual(parse_options([]), None)
+        self.assertEqual(parse_options([
+            {'command': 1, 'label': 'Yes'},
+            {'command': '2', 'label': None, 'callback': 'http://x/'},
+        ]), [(u'1', u'Yes', None), (u'2', None, u'http://x/')])
+        for options in [{'command': 1}, [{'label': 'Yes'}], ['1'],
+                        [{'command': '', 'label': 'Yes'}]]:
+            self.assertRaises(ValueError, parse_options, options)
@@ -0,0 +1,93 @@
+import shutil
+import socket
+import tempfile
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.error import ConnectError
+from twisted.internet.protocol import Factory, Protocol
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.scaleout import (
+    SO_REUSEPORT, Forwarder, listen_reuse_port, reuse_port_socket)
+
+
+class TestReusePort(VumiTestCase):
+
+    def setUp(self):
+        if SO_REUSEPORT is None:
+            self.skipTest('SO_REUSEPORT is not supported here')
+
+    def test_shared_port(self):
+        factory = Factory.forProtocol(Protocol)
+        first = listen_reuse_port(reactor, 0, factory, interface='127.0.0.1')
+        self.add_cleanup(first.stopListening)
+        port = first.getHost().port
+        second = listen_reuse_port(
+            reactor, port, factory, interface='127.0.0.1')
+        self.add_cleanup(second.stopListening)
+        self.assertEqual(second.getHost().port, port)
+
+    def test_plain_listener_conflicts(self):
+        sock = reuse_port_socket(0, '127.0.0.1')
+        self.add_cleanup(sock.close)
+        plain = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.add_cleanup(plain.close)
+        self.assertRaises(
+            socket.error, plain.bind, ('127.0.0.1', sock.getsockname()[1]))
+
+
+class TestForwarder(VumiTestCase):
+
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.add_cleanup(shutil.rmtree, self.socket_dir)
+
+    def mk_forwarder(self, worker_id, received=None):
+        forwarder = Forwarder(
+            reactor, self.socket_dir, worker_id, received or (lambda d: None))
+        self.add_cleanup(forwarder.stop)
+        return forwarder
+
+    @inlineCallbacks
+    def test_forward(self):
+        received = []
+        done = Deferred()
+
+        def receive(data):
+            received.append(data)
+            if len(received) == 3:
+                done.callback(None)
+
+        self.mk_forwarder('w2', receive).listen()
+        sender = self.mk_forwarder('w1')
+        yield sender.forward('w2', b'one')
+        sender.forward('w2', b'two')
+        sender.forward('w2', b'x' * 100000)
+        yield done
+        self.assertEqual(received, [b'one', b'two', b'x' * 100000])
+        self.assertEqual(sender.forwarded, 3)
+
+    @inlineCallbacks
+    def test_forward_queued_while_connecting(self):
+        received = []
+        done = Deferred()
+
+        def receive(data):
+            received.append(data)
+            if len(received) == 2:
+                done.callback(None)
+
+        self.mk_forwarder('w2', receive).listen()
+        sender = self.mk_forwarder('w1')
+        d1 = sender.forward('w2', b'one')
+        d2 = sender.forward('w2', b'two')
+        yield d1
+        yield d2
+        yield done
+        self.assertEqual(received, [b'one', b'two'])
+
+    def test_forward_unreachable(self):
+        sender = self.mk_forwarder('w1')
+        return self.assertFailure(sender.forward('w2', b'one'), ConnectError)
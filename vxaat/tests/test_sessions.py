@@ -0,0 +1,60 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.sessions import SessionRecord, SessionTable
+
+
+class TestSessionRecord(VumiTestCase):
+
+    def test_slots(self):
+        record = SessionRecord('sess-1', '27831234567', 'mtn', '*1234#', 5)
+        self.assertEqual(record.last_seen, 5)
+        self.assertEqual(record.hops, 0)
+        self.assertRaises(AttributeError, setattr, record, 'foo', 1)
+
+
+class TestSessionTable(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.expired = []
+        self.table = SessionTable(self.clock, 10, self.expired.append)
+
+    def test_touch(self):
+        record = self.table.touch('sess-1', '27831234567', 'mtn', '*1234#')
+        self.assertEqual(record.hops, 1)
+        self.clock.advance(3)
+        self.assertTrue(
+            self.table.touch('sess-1', '27831234567', 'mtn', '*1234#')
+            is record)
+        self.assertEqual(record.hops, 2)
+        self.assertEqual(record.started, 0)
+        self.assertEqual(record.last_seen, 3)
+        self.assertEqual(len(self.table), 1)
+
+    def test_touch_new_resets(self):
+        self.table.touch('sess-1', '27831234567', 'mtn', '*1234#')
+        self.clock.advance(3)
+        record = self.table.touch(
+            'sess-1', '27831234567', 'mtn', '*1234#', new=True)
+        self.assertEqual(record.hops, 1)
+        self.assertEqual(record.started, 3)
+
+    def test_expire_when_idle(self):
+        record = self.table.touch('sess-1', '27831234567', 'mtn', '*1234#')
+        self.clock.advance(9)
+        self.table.touch('sess-1', '27831234567', 'mtn', '*1234#')
+        self.clock.advance(9)
+        self.assertEqual(self.expired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.expired, [record])
+        self.assertFalse('sess-1' in self.table)
+
+    def test_close(self):
+        record = self.table.touch('sess-1', '27831234567', 'mtn', '*1234#')
+        self.assertTrue(self.table.close('sess-1') is record)
+        self.assertEqual(self.table.close('sess-1'), None)
+        self.clock.advance(10)
+        self.assertEqual(self.expired, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
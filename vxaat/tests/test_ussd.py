@@ -1,20 +1,45 @@
 # -*- coding: utf-8 -*-
+import base64
 import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
 from urllib import quote
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, gatherResults, inlineCallbacks
+from twisted.internet.task import Clock, deferLater
+from twisted.python import log
 
+from vumi.config import ConfigError
+from vumi.errors import DuplicateConnectorError
 from vumi.message import TransportUserMessage
 from vumi.tests.helpers import VumiTestCase
+from vumi.transports.failures import FailureMessage
 from vumi.transports.httprpc.tests.helpers import HttpRpcTransportHelper
 from vumi.tests.utils import LogCatcher
+from vumi.utils import http_request_full
 
+from vxaat.capture import capture_files, load_requests
+from vxaat.scaleout import SO_REUSEPORT, Forwarder, reuse_port_socket
 from vxaat.ussd import AatUssdTransport
 
 
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
 class TestAatUssdTransport(VumiTestCase):
 
     def setUp(self):
+        # Removed after the transport has stopped listening in it
+        self.socket_dir = tempfile.mkdtemp()
+        self.add_cleanup(shutil.rmtree, self.socket_dir)
         request_defaults = {
             'msisdn': '27729042520',
             'provider': 'MTN',
@@ -287,6 +312,16 @@ class TestAatUssdTransport(VumiTestCase):
             sorted(body['unexpected_parameter']),
             ['unexpected_p1', 'unexpected_p2'])
 
+    @inlineCallbacks
+    def test_request_with_unexpected_parameters_permissive(self):
+        yield self.get_transport({'validation_mode': 'permissive'})
+        d = self.tx_helper.mk_request(request='*1234#', unexpected_p1='')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['to_addr'], '*1234#')
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d
+        self.assertEqual(response.code, 200)
+
     @inlineCallbacks
     def test_no_reply_to_in_response(self):
         yield self.get_transport()
@@ -352,6 +387,32 @@ class TestAatUssdTransport(VumiTestCase):
         [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
         self.assert_ack(ack, reply)
 
+    @inlineCallbacks
+    def test_compact_envelope(self):
+        yield self.get_transport({
+            'provider_mappings': {'MTN': 'mtn'},
+            'compact_envelope': True,
+            'page_budget': 160,
+            'provider_page_budgets': {'mtn': 20},
+        })
+
+        d = self.tx_helper.mk_request(request='*code#', ussdSessionId='xxxx')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assert_inbound_message(
+            msg,
+            session_event=TransportUserMessage.SESSION_NEW,
+            content=None,
+            provider='mtn',
+            helper_metadata={},
+            transport_metadata={'aat_ussd': {'ussd_session_id': 'xxxx'}})
+
+        # The provider's page budget is found from the top level field
+        self.tx_helper.dispatch_outbound(
+            msg.reply('We want ... a shrubbery!'))
+        response = yield d
+        self.assertTrue('<headertext>We want ... a</headertext>' in
+                        response.delivered_body)
+
     @inlineCallbacks
     def test_callback_url_with_trailing_slash(self):
         yield self.get_transport({
@@ -408,3 +469,1308 @@ class TestAatUssdTransport(VumiTestCase):
 
         [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
         self.assert_ack(ack, reply)
+
+    @inlineCallbacks
+    def test_reply_cache(self):
+        transport = yield self.get_transport({'reply_cache_size': 10})
+        ussd_string = '*1234#'
+        reply_content = "We want ... a shrubbery!"
+
+        for i in range(2):
+            d = self.tx_helper.mk_request(request="Ni!", to_addr=ussd_string)
+            [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+            self.tx_helper.clear_dispatched_inbound()
+            self.tx_helper.dispatch_outbound(msg.reply(reply_content))
+            response = yield d
+
+            self.assert_outbound_message(
+                response.delivered_body,
+                reply_content,
+                self.callback_url(ussd_string),
+            )
+
+        self.assertEqual(transport.reply_cache.misses, 1)
+        self.assertEqual(transport.reply_cache.hits, 1)
+
+    @inlineCallbacks
+    def test_reply_cache_disabled(self):
+        transport = yield self.get_transport()
+        self.assertEqual(transport.reply_cache, None)
+
+    def metric_values(self, transport, name):
+        return [value for _, value in transport.metrics[name].poll()]
+
+    @inlineCallbacks
+    def test_latency_metrics(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({
+            'metrics_prefix': 'vumi.test.',
+            'provider_mappings': {'MTN': 'mtn'},
+        })
+
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        clock.advance(0.25)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+        self.assertEqual(
+            self.metric_values(transport, 'latency.mtn.new'), [0.25])
+        self.assertEqual(
+            self.metric_values(transport, 'latency.mtn.new.le_500ms'), [1])
+
+    @inlineCallbacks
+    def test_latency_metrics_unmapped_providers(self):
+        transport = yield self.get_transport({
+            'metrics_prefix': 'vumi.test.',
+            'provider_mappings': {'MTN': 'mtn'},
+        })
+        for provider in ['MTN NG', 'MTN.NG', 'MTN']:
+            d = self.tx_helper.mk_request(request='*1234#', provider=provider)
+            [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+            self.tx_helper.clear_dispatched_inbound()
+            self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+            yield d
+        self.assertEqual(
+            len(self.metric_values(transport, 'latency.other.new')), 2)
+        self.assertEqual(
+            len(self.metric_values(transport, 'latency.mtn.new')), 1)
+        self.assertFalse('latency.MTN_NG.new' in transport.metrics)
+        events = yield self.tx_helper.wait_for_dispatched_events(3)
+        self.assertEqual(
+            [event['event_type'] for event in events], ['ack'] * 3)
+
+    @inlineCallbacks
+    def test_latency_metrics_late_reply(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({
+            'metrics_prefix': 'vumi.test.',
+            'provider_mappings': {'MTN': 'mtn'},
+            'request_timeout': 10,
+        })
+
+        d = self.tx_helper.mk_request(request='Ni!', to_addr='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        clock.advance(15)
+        response = yield d
+        self.assertEqual(response.code, 504)
+
+        clock.advance(1)
+        reply = msg.reply('Ni!')
+        self.tx_helper.dispatch_outbound(reply)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_nack(nack, reply, AatUssdTransport.RESPONSE_FAILURE_ERROR)
+        self.assertEqual(
+            self.metric_values(transport, 'late_latency.mtn.resume'), [16])
+        self.assertFalse('latency.mtn.resume' in transport.metrics)
+
+    @inlineCallbacks
+    def test_reply_deadline(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        yield self.get_transport({
+            'reply_deadline': 5,
+            'deadline_reply_content': 'Please try again.',
+        })
+
+        d = self.tx_helper.mk_request(request='Ni!', to_addr='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        clock.advance(5)
+        response = yield d
+        self.assertEqual(response.code, 200)
+        self.assert_outbound_message(
+            response.delivered_body, 'Please try again.', None,
+            continue_session=False)
+
+        reply = msg.reply('Ni!')
+        self.tx_helper.dispatch_outbound(reply)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_nack(nack, reply, AatUssdTransport.RESPONSE_FAILURE_ERROR)
+
+    @inlineCallbacks
+    def test_reply_before_deadline(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({'reply_deadline': 5})
+
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        clock.advance(4)
+        reply = msg.reply('Ni!')
+        self.tx_helper.dispatch_outbound(reply)
+        response = yield d
+        self.assert_outbound_message(
+            response.delivered_body, 'Ni!', self.callback_url('*1234#'))
+        self.assertEqual(len(transport.deadlines), 0)
+
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_ack(ack, reply)
+
+    @inlineCallbacks
+    def test_session_idle_timeout(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({
+            'session_idle_timeout': 60,
+            'provider_mappings': {'MTN': 'mtn'},
+            'metrics_prefix': 'vumi.test.',
+        })
+
+        d = self.tx_helper.mk_request(request='*1234#', ussdSessionId='s1')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+        self.assertEqual(transport.sessions.get('s1').hops, 1)
+
+        clock.advance(30)
+        d = self.tx_helper.mk_request(
+            request='1', to_addr='*1234#', ussdSessionId='s1')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+        self.assertEqual(transport.sessions.get('s1').hops, 2)
+
+        clock.advance(60)
+        [_, _, close] = yield self.tx_helper.wait_for_dispatched_inbound(3)
+        self.assert_inbound_message(
+            close,
+            session_event=TransportUserMessage.SESSION_CLOSE,
+            content=None,
+            to_addr='*1234#',
+            provider='mtn',
+            helper_metadata={'session_id': 's1'},
+            transport_metadata={
+                'aat_ussd': {'provider': 'mtn', 'ussd_session_id': 's1'},
+            },
+        )
+        self.assertEqual(len(transport.sessions), 0)
+        self.assertEqual(self.metric_values(transport, 'session.hops'), [2])
+        self.assertEqual(
+            self.metric_values(transport, 'session.duration'), [90])
+        self.assertEqual(
+            self.metric_values(transport, 'session.ended.idle'), [1])
+
+    @inlineCallbacks
+    def test_session_closed_by_reply(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({'session_idle_timeout': 60})
+
+        d = self.tx_helper.mk_request(request='*1234#', ussdSessionId='s1')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(
+            msg.reply('Goodbye', continue_session=False))
+        yield d
+        self.assertEqual(len(transport.sessions), 0)
+
+        clock.advance(60)
+        yield self.tx_helper.kick_delivery()
+        self.assertEqual(
+            len(self.tx_helper.get_dispatched_inbound()), 1)
+
+    @inlineCallbacks
+    def test_inbound_with_provider_rule(self):
+        yield self.get_transport({
+            'provider_rules': [
+                {'match': 'iexact', 'value': 'camelot', 'provider': 'camelot'},
+            ],
+        })
+        d = self.tx_helper.mk_request(request='*1234#', provider='CAMELOT')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['provider'], 'camelot')
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+    def test_invalid_provider_rule(self):
+        transport = AatUssdTransport({}, {
+            'transport_name': 'aat_ussd',
+            'base_url': 'http://www.example.com/foo',
+            'web_path': '/api/aat/ussd/',
+            'web_port': '0',
+            'provider_rules': [
+                {'match': 'glob', 'value': '*', 'provider': 'camelot'},
+            ],
+        })
+        self.assertRaises(ConfigError, transport.validate_config)
+
+    @inlineCallbacks
+    def test_unknown_provider_summary(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        yield self.get_transport({'unknown_provider_summary_interval': 60})
+
+        with LogCatcher() as lc:
+            for i in range(2):
+                d = self.tx_helper.mk_request(
+                    request='*1234#', provider='Tim')
+                [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+                self.tx_helper.clear_dispatched_inbound()
+                self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+                yield d
+            clock.advance(60)
+
+        self.assertEqual(lc.messages().count(
+            "No mapping exists for provider 'Tim', using 'Tim' as a fallback"),
+            1)
+        self.assertTrue(
+            "Messages from unmapped providers since the last summary: "
+            "'Tim' (2)" in lc.messages())
+
+    @inlineCallbacks
+    def test_admission_control(self):
+        transport = yield self.get_transport({
+            'max_inflight_requests': 1,
+            'busy_reply_content': 'Busy, try later.',
+            'provider_mappings': {'MTN': 'mtn'},
+            'metrics_prefix': 'vumi.test.',
+            'session_idle_timeout': 60,
+        })
+
+        d1 = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        response = yield self.tx_helper.mk_request(
+            request='*1234#', ussdSessionId='s2')
+        self.assertEqual(response.code, 200)
+        self.assert_outbound_message(
+            response.delivered_body, 'Busy, try later.', None,
+            continue_session=False)
+        self.assertEqual(
+            len(self.tx_helper.get_dispatched_inbound()), 1)
+        self.assertEqual(self.metric_values(transport, 'rejected.mtn'), [1])
+        self.assertFalse('s2' in transport.sessions)
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d1
+        self.assertEqual(len(transport.admission), 0)
+
+        d2 = self.tx_helper.mk_request(request='*1234#')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d2
+        self.assert_outbound_message(
+            response.delivered_body, 'Ni!', self.callback_url('*1234#'))
+
+    @inlineCallbacks
+    def test_admission_control_per_provider(self):
+        transport = yield self.get_transport({
+            'max_inflight_requests_per_provider': 1,
+            'provider_mappings': {'MTN': 'mtn', 'VOD': 'vodacom'},
+        })
+
+        d1 = self.tx_helper.mk_request(request='*1234#', provider='MTN')
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        response = yield self.tx_helper.mk_request(
+            request='*1234#', provider='MTN')
+        self.assertEqual(response.code, 200)
+        self.assert_outbound_message(
+            response.delivered_body,
+            'Sorry, the service is busy. Please try again later.', None,
+            continue_session=False)
+
+        d2 = self.tx_helper.mk_request(request='*1234#', provider='VOD')
+        [msg1, msg2] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.assertEqual(transport.admission.rejected, {'mtn': 1})
+
+        self.tx_helper.dispatch_outbound(msg1.reply('Ni!'))
+        self.tx_helper.dispatch_outbound(msg2.reply('Ni!'))
+        yield d1
+        yield d2
+
+    @inlineCallbacks
+    def test_event_batching(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({
+            'event_batching': True,
+            'metrics_prefix': 'vumi.test.',
+        })
+
+        d1 = self.tx_helper.mk_request(request='*1234#')
+        d2 = self.tx_helper.mk_request(request='*1234#')
+        [msg1, msg2] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        reply1 = msg1.reply('Ni!')
+        reply2 = msg2.reply('Ni!')
+        nack = self.tx_helper.make_outbound('Ni!')
+        yield self.tx_helper.dispatch_outbound(reply1)
+        yield self.tx_helper.dispatch_outbound(reply2)
+        yield self.tx_helper.dispatch_outbound(nack)
+        yield d1
+        yield d2
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+        self.assertEqual(len(transport.event_batcher), 3)
+
+        clock.advance(0)
+        [ack1, ack2, nack] = yield self.tx_helper.wait_for_dispatched_events(3)
+        self.assert_ack(ack1, reply1)
+        self.assert_ack(ack2, reply2)
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(
+            self.metric_values(transport, 'events.flush_size'), [3])
+        self.assertEqual(
+            self.metric_values(transport, 'events.flushes.timer'), [1])
+
+    @inlineCallbacks
+    def test_event_batching_flushed_on_teardown(self):
+        transport = yield self.get_transport({
+            'event_batching': True,
+            'event_batch_interval': 60,
+        })
+
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = msg.reply('Ni!')
+        yield self.tx_helper.dispatch_outbound(reply)
+        yield d
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+
+        yield transport.teardown_transport()
+        [ack] = self.tx_helper.get_dispatched_events()
+        self.assert_ack(ack, reply)
+
+    @inlineCallbacks
+    def test_outbound_menu_options(self):
+        yield self.get_transport({'reply_cache_size': 10})
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = msg.reply('Choose', helper_metadata={'aat_ussd': {
+            'options': [
+                {'command': 1, 'label': 'Yes'},
+                {'command': '2', 'label': 'No & <never>',
+                 'callback': 'http://example.com/other'},
+            ],
+        }})
+        self.tx_helper.dispatch_outbound(reply)
+        response = yield d
+        self.assertEqual(response.delivered_body, ''.join([
+            '<request>',
+            '<headertext>Choose</headertext>',
+            '<options>',
+            '<option callback="%s" command="1" display="true" order="1">'
+            'Yes</option>' % (self.callback_url('*1234#'),),
+            '<option callback="http://example.com/other" command="2"'
+            ' display="true" order="2">No &amp; &lt;never&gt;</option>',
+            '</options>',
+            '</request>',
+        ]))
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_ack(ack, reply)
+
+    @inlineCallbacks
+    def test_outbound_invalid_menu_options(self):
+        yield self.get_transport()
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = msg.reply('Choose', helper_metadata={'aat_ussd': {
+            'options': [{'label': 'Yes'}],
+        }})
+        with LogCatcher() as lc:
+            self.tx_helper.dispatch_outbound(reply)
+            [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_nack(
+            nack, reply, AatUssdTransport.INVALID_OPTIONS_ERROR)
+        self.assertEqual(len(lc.messages()), 1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d
+        self.assert_outbound_message(
+            response.delivered_body, 'Ni!', self.callback_url('*1234#'))
+
+    def assert_page(self, body, page, callback):
+        self.assertEqual(body, ''.join([
+            '<request>',
+            '<headertext>%s</headertext>' % (page,),
+            '<options>',
+            '<option callback="%s" command="#" display="true" order="1">'
+            'More</option>' % (callback,),
+            '</options>',
+            '</request>',
+        ]))
+
+    @inlineCallbacks
+    def test_pagination(self):
+        transport = yield self.get_transport({
+            'page_budget': 14,
+            'session_idle_timeout': 60,
+        })
+        callback = self.callback_url('*1234#')
+
+        d = self.tx_helper.mk_request(request='*1234#', ussdSessionId='s1')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = msg.reply(
+            'The Knights Who Say Ni demand a shrubbery',
+            continue_session=False)
+        self.tx_helper.dispatch_outbound(reply)
+        response = yield d
+        self.assert_page(response.delivered_body, 'The Knights Who', callback)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_ack(ack, reply)
+        self.assertTrue('s1' in transport.sessions)
+
+        response = yield self.tx_helper.mk_request(
+            request='#', to_addr='*1234#', ussdSessionId='s1')
+        self.assert_page(
+            response.delivered_body, 'Say Ni demand a', callback)
+
+        response = yield self.tx_helper.mk_request(
+            request='#', to_addr='*1234#', ussdSessionId='s1')
+        self.assert_outbound_message(
+            response.delivered_body, 'shrubbery', None,
+            continue_session=False)
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 1)
+        self.assertFalse('s1' in transport.sessions)
+        self.assertEqual(len(transport.page_cache), 0)
+
+        # Without pages left, "#" goes to the application
+        d = self.tx_helper.mk_request(
+            request='#', to_addr='*1234#', ussdSessionId='s1')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.assertEqual(msg['content'], '#')
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+    @inlineCallbacks
+    def test_pagination_abandoned(self):
+        transport = yield self.get_transport({
+            'page_budget': 160,
+            'provider_page_budgets': {'mtn': 7},
+            'provider_mappings': {'MTN': 'mtn'},
+        })
+
+        d = self.tx_helper.mk_request(request='*1234#', provider='VOD')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('one two three'))
+        response = yield d
+        self.assert_outbound_message(
+            response.delivered_body, 'one two three',
+            self.callback_url('*1234#'))
+
+        d = self.tx_helper.mk_request(request='*1234#', provider='MTN')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.tx_helper.dispatch_outbound(msg.reply('one two three'))
+        response = yield d
+        self.assert_page(
+            response.delivered_body, 'one two', self.callback_url('*1234#'))
+        self.assertEqual(len(transport.page_cache), 1)
+
+        d = self.tx_helper.mk_request(
+            request='1', to_addr='*1234#', provider='MTN')
+        [_, _, msg] = yield self.tx_helper.wait_for_dispatched_inbound(3)
+        self.assertEqual(len(transport.page_cache), 0)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+    @inlineCallbacks
+    def test_duplicate_attached(self):
+        transport = yield self.get_transport({
+            'dedup_window': 5,
+            'metrics_prefix': 'vumi.test.',
+        })
+
+        d1 = self.tx_helper.mk_request(
+            request='1', to_addr='*1234#', ussdSessionId='s1')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        d2 = self.tx_helper.mk_request(
+            request='1', to_addr='*1234#', ussdSessionId='s1')
+        d3 = self.tx_helper.mk_request(
+            request='2', to_addr='*1234#', ussdSessionId='s1')
+        [_, other] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.assertEqual(other['content'], '2')
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        self.tx_helper.dispatch_outbound(other.reply('Ekke Ekke!'))
+        [r1, r2, r3] = yield gatherResults([d1, d2, d3])
+        self.assertEqual(r1.delivered_body, r2.delivered_body)
+        self.assert_outbound_message(
+            r2.delivered_body, 'Ni!', self.callback_url('*1234#'))
+        self.assert_outbound_message(
+            r3.delivered_body, 'Ekke Ekke!', self.callback_url('*1234#'))
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 2)
+        self.assertEqual(
+            self.metric_values(transport, 'duplicates.attached'), [1])
+
+    @inlineCallbacks
+    def test_duplicate_replayed(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({'dedup_window': 5})
+
+        d = self.tx_helper.mk_request(request='*1234#', ussdSessionId='s1')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d
+
+        clock.advance(4)
+        replayed = yield self.tx_helper.mk_request(
+            request='*1234#', ussdSessionId='s1')
+        self.assertEqual(replayed.delivered_body, response.delivered_body)
+        self.assertEqual(len(self.tx_helper.get_dispatched_inbound()), 1)
+        self.assertEqual(
+            transport.dedup.suppressed, {'attached': 0, 'replayed': 1})
+
+        clock.advance(1)
+        d = self.tx_helper.mk_request(request='*1234#', ussdSessionId='s1')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+    @inlineCallbacks
+    def test_duplicate_next_pages_not_replayed(self):
+        transport = yield self.get_transport({
+            'dedup_window': 5,
+            'page_budget': 14,
+        })
+        callback = self.callback_url('*1234#')
+
+        d = self.tx_helper.mk_request(request='*1234#', ussdSessionId='s1')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply(
+            'The Knights Who Say Ni demand a shrubbery'))
+        response = yield d
+        self.assert_page(response.delivered_body, 'The Knights Who', callback)
+
+        response = yield self.tx_helper.mk_request(
+            request='#', to_addr='*1234#', ussdSessionId='s1')
+        self.assert_page(
+            response.delivered_body, 'Say Ni demand a', callback)
+        response = yield self.tx_helper.mk_request(
+            request='#', to_addr='*1234#', ussdSessionId='s1')
+        self.assert_outbound_message(
+            response.delivered_body, 'shrubbery', callback)
+        self.assertEqual(
+            transport.dedup.suppressed, {'attached': 0, 'replayed': 0})
+
+    @inlineCallbacks
+    def test_duplicate_after_busy_not_replayed(self):
+        transport = yield self.get_transport({
+            'dedup_window': 5,
+            'max_inflight_requests': 1,
+            'busy_reply_content': 'Busy, try later.',
+        })
+
+        d1 = self.tx_helper.mk_request(request='*1234#', ussdSessionId='s1')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        response = yield self.tx_helper.mk_request(
+            request='*1234#', ussdSessionId='s2')
+        self.assert_outbound_message(
+            response.delivered_body, 'Busy, try later.', None,
+            continue_session=False)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d1
+
+        d2 = self.tx_helper.mk_request(request='*1234#', ussdSessionId='s2')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.tx_helper.dispatch_outbound(msg.reply('Ekke Ekke!'))
+        response = yield d2
+        self.assert_outbound_message(
+            response.delivered_body, 'Ekke Ekke!', self.callback_url('*1234#'))
+        self.assertEqual(
+            transport.dedup.suppressed, {'attached': 0, 'replayed': 0})
+
+    def test_worker_id_needs_socket_dir(self):
+        transport = AatUssdTransport({}, {
+            'transport_name': 'aat_ussd',
+            'base_url': 'http://www.example.com/foo',
+            'web_path': '/api/aat/ussd/',
+            'web_port': '0',
+            'worker_id': 'w1',
+        })
+        self.assertRaises(ConfigError, transport.validate_config)
+
+    @inlineCallbacks
+    def test_forward_reply_to_owner(self):
+        socket_dir = self.socket_dir
+        yield self.get_transport({
+            'worker_id': 'w1',
+            'forwarding_socket_dir': socket_dir,
+        })
+        received = Deferred()
+        owner = Forwarder(reactor, socket_dir, 'w2', received.callback)
+        owner.listen()
+        self.add_cleanup(owner.stop)
+
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(
+            msg['transport_metadata']['aat_ussd']['worker'], 'w1')
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d
+        self.assert_outbound_message(
+            response.delivered_body, 'Ni!', self.callback_url('*1234#'))
+
+        msg['transport_metadata']['aat_ussd']['worker'] = 'w2'
+        reply = msg.reply('Ekke Ekke!')
+        self.tx_helper.dispatch_outbound(reply)
+        data = yield received
+        self.assertEqual(TransportUserMessage.from_json(data), reply)
+        self.assertEqual(len(self.tx_helper.get_dispatched_events()), 1)
+
+    @inlineCallbacks
+    def test_forward_reply_owner_unreachable(self):
+        yield self.get_transport({
+            'worker_id': 'w1',
+            'forwarding_socket_dir': self.socket_dir,
+        })
+        reply = self.tx_helper.make_outbound(
+            'Ni!', in_reply_to='1234',
+            transport_metadata={'aat_ussd': {'worker': 'w2'}})
+        with LogCatcher() as lc:
+            self.tx_helper.dispatch_outbound(reply)
+            [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_nack(nack, reply, AatUssdTransport.RESPONSE_FAILURE_ERROR)
+        self.assertTrue(any(
+            line.startswith('Could not forward reply (%s) to w2' % (
+                reply['message_id'],))
+            for line in self.log_lines(lc)))
+
+    @inlineCallbacks
+    def test_receive_forwarded_reply(self):
+        socket_dir = self.socket_dir
+        yield self.get_transport({
+            'worker_id': 'w1',
+            'forwarding_socket_dir': socket_dir,
+        })
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        peer = Forwarder(reactor, socket_dir, 'w2', lambda data: None)
+        self.add_cleanup(peer.stop)
+        reply = msg.reply('Ni!')
+        yield peer.forward('w1', reply.to_json())
+        response = yield d
+        self.assert_outbound_message(
+            response.delivered_body, 'Ni!', self.callback_url('*1234#'))
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_ack(ack, reply)
+
+    @inlineCallbacks
+    def test_reuse_port(self):
+        if SO_REUSEPORT is None:
+            self.skipTest('SO_REUSEPORT is not supported here')
+        transport = yield self.get_transport({'reuse_port': True})
+        port = transport.web_resource.getHost().port
+        sock = reuse_port_socket(port)
+        sock.close()
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d
+        self.assertEqual(response.code, 200)
+
+    def test_reuse_port_with_per_process_state(self):
+        if SO_REUSEPORT is None:
+            self.skipTest('SO_REUSEPORT is not supported here')
+        for config in [{'page_budget': 160}, {'dedup_window': 5},
+                       {'session_idle_timeout': 60},
+                       {'provider_page_budgets': {'mtn': 160}}]:
+            config.update({
+                'transport_name': 'aat_ussd',
+                'base_url': 'http://www.example.com/foo',
+                'web_path': '/api/aat/ussd/',
+                'web_port': '0',
+                'reuse_port': True,
+            })
+            transport = AatUssdTransport({}, config)
+            e = self.assertRaises(ConfigError, transport.validate_config)
+            self.assertTrue('reuse_port cannot be used' in str(e))
+
+    @inlineCallbacks
+    def test_capture(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        path = os.path.join(self.socket_dir, 'capture')
+        transport = yield self.get_transport({
+            'capture_path': path,
+            'request_timeout': 10,
+        })
+
+        d1 = self.tx_helper.mk_request(request='*1234#')
+        d2 = self.tx_helper.mk_request(
+            request='Ni!', to_addr='*1234#', ussdSessionId='123')
+        [msg, _] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        clock.advance(0.25)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d1
+        # Written by the periodic flush, not as requests arrive
+        self.assertEqual(capture_files(path), [])
+        clock.advance(15)
+        response = yield d2
+        self.assertEqual(response.code, 504)
+        clock.advance(1)
+        self.assertEqual(transport.capture.files, [path + '.0'])
+
+        [new, resume] = load_requests(capture_files(path))
+        self.assertEqual(new.args, {
+            'msisdn': '27729042520', 'provider': 'MTN', 'request': '*1234#'})
+        self.assertEqual((new.timestamp, new.latency, new.code),
+                         (0, 0.25, 200))
+        self.assertEqual(resume.args['ussdSessionId'], '123')
+        self.assertEqual(resume.args['to_addr'], '*1234#')
+        self.assertEqual((resume.latency, resume.code), (15.25, 504))
+
+    @inlineCallbacks
+    def test_capture_error(self):
+        path = os.path.join(self.socket_dir, 'capture')
+        transport = yield self.get_transport({'capture_path': path})
+
+        def broken(*args):
+            raise ValueError('Broken capture')
+        self.patch(transport.capture, 'request', broken)
+        self.patch(transport.capture, 'reply', broken)
+        response = yield self.tx_helper.mk_request(request='*1234#', foo='1')
+        self.assertEqual(response.code, 400)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 2)
+
+    def test_admin_path_needs_credentials(self):
+        transport = AatUssdTransport({}, {
+            'transport_name': 'aat_ussd',
+            'base_url': 'http://www.example.com/foo',
+            'web_path': '/api/aat/ussd/',
+            'web_port': '0',
+            'admin_path': '/admin/',
+            'admin_username': 'admin',
+        })
+        self.assertRaises(ConfigError, transport.validate_config)
+
+    def admin_request(self, transport, path, auth='admin:secret',
+                      method='GET'):
+        headers = {}
+        if auth is not None:
+            headers['Authorization'] = [
+                'Basic %s' % (base64.b64encode(auth),)]
+        return http_request_full(
+            transport.get_transport_url('admin/%s' % (path,)),
+            headers=headers, method=method)
+
+    @inlineCallbacks
+    def test_admin_functions(self):
+        transport = yield self.get_transport({
+            'admin_path': '/admin/',
+            'admin_username': 'admin',
+            'admin_password': 'secret',
+        })
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+        yield self.tx_helper.wait_for_dispatched_events(1)
+
+        response = yield self.admin_request(transport, 'functions')
+        self.assertEqual(response.code, 200)
+        functions = json.loads(response.delivered_body)
+        self.assertEqual(
+            sorted(functions), sorted(AatUssdTransport.TIMED_FUNCTIONS))
+        for name in AatUssdTransport.TIMED_FUNCTIONS:
+            self.assertEqual(
+                functions[name]['calls'], 0 if name == 'publish_nack' else 1)
+
+        for auth in [None, 'admin:wrong']:
+            response = yield self.admin_request(transport, 'functions', auth)
+            self.assertEqual(response.code, 401)
+
+    @inlineCallbacks
+    def test_admin_disabled(self):
+        transport = yield self.get_transport()
+        self.assertEqual(transport.function_times, None)
+        self.assertFalse('generate_body' in transport.__dict__)
+        response = yield self.admin_request(transport, 'functions')
+        self.assertEqual(response.code, 404)
+
+    @inlineCallbacks
+    def test_admin_memory_limit(self):
+        transport = yield self.get_transport({
+            'admin_path': '/admin/',
+            'admin_username': 'admin',
+            'admin_password': 'secret',
+        })
+        response = yield self.admin_request(transport, 'memory?limit=3')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(json.loads(response.delivered_body)['top']), 3)
+
+        response = yield self.admin_request(transport, 'memory?limit=0')
+        self.assertEqual(response.code, 400)
+
+    @inlineCallbacks
+    def test_admin_stats(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({
+            'admin_path': '/admin/',
+            'admin_username': 'admin',
+            'admin_password': 'secret',
+        })
+        response = yield self.tx_helper.mk_request(foo='bar')
+        self.assertEqual(response.code, 400)
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        clock.advance(2)
+
+        response = yield self.admin_request(transport, 'stats')
+        stats = json.loads(response.delivered_body)
+        self.assertEqual(stats['ready'], True)
+        self.assertEqual(stats['outstanding'], 1)
+        self.assertEqual(stats['request_age_ms']['p50'], 2000)
+        self.assertEqual(stats['counters']['requests'], 2)
+        self.assertEqual(stats['counters']['bad_requests'], 1)
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+        yield self.tx_helper.wait_for_dispatched_events(1)
+        response = yield self.admin_request(transport, 'stats')
+        stats = json.loads(response.delivered_body)
+        self.assertEqual(stats['outstanding'], 0)
+        self.assertEqual(stats['request_age_ms'], {})
+        self.assertEqual(stats['counters']['acks'], 1)
+
+    @inlineCallbacks
+    def test_admin_cache_stats(self):
+        transport = yield self.get_transport({
+            'admin_path': '/admin/',
+            'admin_username': 'admin',
+            'admin_password': 'secret',
+            'reply_cache_size': 10,
+            'dedup_window': 5,
+        })
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+        response = yield self.admin_request(transport, 'stats')
+        caches = json.loads(response.delivered_body)['caches']
+        self.assertEqual(
+            sorted(caches.keys()), ['dedup', 'providers', 'replies'])
+        self.assertEqual(caches['replies']['misses'], 1)
+        self.assertEqual(caches['replies']['size'], 1)
+        self.assertEqual(caches['dedup']['size'], 1)
+        self.assertEqual(caches['dedup']['expirations'], 0)
+        self.assertEqual(caches['providers']['misses'], 1)
+
+    @inlineCallbacks
+    def test_admin_drain(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({
+            'admin_path': '/admin/',
+            'admin_username': 'admin',
+            'admin_password': 'secret',
+            'drain_reply_content': 'Back soon.',
+        })
+        d1 = self.tx_helper.mk_request(request='*1234#')
+        [msg1] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        response = yield self.admin_request(transport, 'drain', method='POST')
+        self.assertEqual(response.code, 202)
+        self.assertEqual(json.loads(response.delivered_body)['ready'], False)
+        response = yield http_request_full(
+            transport.get_transport_url('health'), method='GET')
+        self.assertEqual(response.code, 503)
+        self.assertEqual(json.loads(response.delivered_body), {
+            'pending_requests': 1, 'ready': False})
+
+        # New sessions are closed, resumes are still served
+        response = yield self.tx_helper.mk_request(request='*1234#')
+        self.assert_outbound_message(
+            response.delivered_body, 'Back soon.', None,
+            continue_session=False)
+        d2 = self.tx_helper.mk_request(request='1', to_addr='*1234#')
+        [_, msg2] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+
+        self.tx_helper.dispatch_outbound(msg1.reply('Ni!'))
+        yield d1
+        response = yield self.admin_request(transport, 'drain')
+        self.assertEqual(response.code, 503)
+
+        self.tx_helper.dispatch_outbound(msg2.reply('Ni!', False))
+        yield d2
+        response = yield self.admin_request(transport, 'drain')
+        self.assertEqual(response.code, 200)
+        stats = json.loads(response.delivered_body)
+        self.assertEqual(stats['drained'], True)
+        self.assertEqual(stats['counters']['turned_away'], 1)
+        with LogCatcher() as lc:
+            clock.advance(1)
+        self.assertTrue('Drained, safe to stop.' in lc.messages())
+        self.assertFalse(transport.drain_check.running)
+
+    def log_lines(self, lc):
+        return [log.textFromEventDict(event) for event in lc.logs]
+
+    @inlineCallbacks
+    def test_text_log(self):
+        yield self.get_transport()
+        with LogCatcher() as lc:
+            d = self.tx_helper.mk_request(request='*1234#')
+            [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+            reply = msg.reply('Ni!')
+            self.tx_helper.dispatch_outbound(reply)
+            response = yield d
+        lines = self.log_lines(lc)
+        self.assertTrue(
+            'AatUssdTransport receiving inbound message (%s) from '
+            '27729042520 to *1234#.' % (msg['message_id'],) in lines)
+        self.assertTrue(
+            'AatUssdTransport outbound message (%s) with content: %r' % (
+                reply['message_id'], response.delivered_body) in lines)
+
+    @inlineCallbacks
+    def test_structured_log(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        yield self.get_transport({
+            'log_format': 'structured',
+            'log_sample_rates': {'inbound': 0.5},
+        })
+        with LogCatcher() as lc:
+            for i in range(2):
+                d = self.tx_helper.mk_request(request='*1234#')
+                [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+                self.tx_helper.clear_dispatched_inbound()
+                clock.advance(0.25)
+                reply = msg.reply('Ni!')
+                self.tx_helper.dispatch_outbound(reply)
+                yield d
+            yield self.tx_helper.mk_request(foo='bar')
+
+        events = [event for event in lc.logs if 'aat_event' in event]
+        records = [(event['aat_event'], event['aat_fields'])
+                   for event in events]
+        self.assertEqual(
+            [event for event, _ in records],
+            ['outbound', 'inbound', 'outbound', 'bad_request'])
+        self.assertEqual(records[1][1], {
+            'message_id': msg['message_id'],
+            'msisdn': '27729042520',
+            'provider': 'MTN',
+            'session_event': 'new',
+            'to_addr': '*1234#',
+        })
+        self.assertEqual(records[2][1], {
+            'message_id': reply['message_id'],
+            'in_reply_to': msg['message_id'],
+            'session_event': None,
+            'latency': 0.25,
+            'bytes': len(
+                '<request><headertext>Ni!</headertext><options><option '
+                'callback="%s" command="1" display="false" order="1" />'
+                '</options></request>' % (self.callback_url('*1234#'),)),
+        })
+        self.assertEqual(
+            log.textFromEventDict(events[-1]),
+            'bad_request errors="{\'unexpected_parameter\': [\'foo\']}" '
+            'message_id=%s' % (records[3][1]['message_id'],))
+
+    @inlineCallbacks
+    def test_structured_log_duplicates_and_options(self):
+        transport = yield self.get_transport({
+            'log_format': 'structured',
+            'dedup_window': 5,
+        })
+        with LogCatcher() as lc:
+            d1 = self.tx_helper.mk_request(
+                request='*1234#', ussdSessionId='s1')
+            [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+            d2 = self.tx_helper.mk_request(
+                request='*1234#', ussdSessionId='s1')
+            while not transport.dedup.suppressed['attached']:
+                yield deferLater(reactor, 0.01, lambda: None)
+            self.tx_helper.dispatch_outbound(msg.reply(
+                'Choose', helper_metadata={'aat_ussd': {
+                    'options': [{'label': 'Yes'}]}}))
+            yield self.tx_helper.wait_for_dispatched_events(1)
+            self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+            yield gatherResults([d1, d2])
+
+        records = dict(
+            (event['aat_event'], event['aat_fields'])
+            for event in lc.logs if 'aat_event' in event)
+        self.assertEqual(records['duplicate'], {
+            'message_id': records['duplicate']['message_id'],
+            'msisdn': '27729042520',
+            'kind': 'attached',
+        })
+        self.assertTrue(
+            "'command'" in records['invalid_options']['error'])
+
+    def test_invalid_log_config(self):
+        for config in [{'log_format': 'xml'},
+                       {'log_format': 'structured',
+                        'log_sample_rates': {'inbound': 5}}]:
+            config.update({
+                'transport_name': 'aat_ussd',
+                'base_url': 'http://www.example.com/foo',
+                'web_path': '/api/aat/ussd/',
+                'web_port': '0',
+            })
+            transport = AatUssdTransport({}, config)
+            self.assertRaises(ConfigError, transport.validate_config)
+
+    @inlineCallbacks
+    def test_static_menu(self):
+        transport = yield self.get_transport({
+            'static_menus': {
+                '*1234#': {
+                    'content': 'Welcome',
+                    'options': [{'command': '1', 'label': 'Balance'}],
+                },
+                '*5678#': 'Hello',
+            },
+        })
+        response = yield self.tx_helper.mk_request(request='*1234#')
+        self.assertEqual(response.delivered_body, ''.join([
+            '<request>',
+            '<headertext>Welcome</headertext>',
+            '<options>',
+            '<option callback="%s" command="1" display="true" order="1">'
+            'Balance</option>' % (self.callback_url('*1234#'),),
+            '</options>',
+            '</request>',
+        ]))
+        response = yield self.tx_helper.mk_request(request='*5678#')
+        self.assert_outbound_message(
+            response.delivered_body, 'Hello', self.callback_url('*5678#'))
+
+        # The application still hears about the sessions
+        [msg, _] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.assert_inbound_message(
+            msg,
+            session_event=TransportUserMessage.SESSION_NEW,
+            to_addr='*1234#',
+            from_addr='27729042520',
+            content=None)
+        self.assertEqual(
+            msg['transport_metadata']['aat_ussd']['static_menu'], True)
+        self.assertEqual(transport.stats['static_menus'], 2)
+
+        reply = msg.reply('Too late')
+        self.tx_helper.dispatch_outbound(reply)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_nack(nack, reply, AatUssdTransport.STATIC_MENU_ERROR)
+
+    @inlineCallbacks
+    def test_static_menu_other_dial(self):
+        yield self.get_transport({'static_menus': {'*5678#': 'Hello'}})
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertFalse(
+            'static_menu' in msg['transport_metadata']['aat_ussd'])
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d
+        self.assert_outbound_message(
+            response.delivered_body, 'Ni!', self.callback_url('*1234#'))
+
+    def test_invalid_static_menu(self):
+        for menu in [{'content': 'Hi', 'options': [{'label': 'Yes'}]},
+                     {'options': [{'command': '1', 'label': 'Yes'}]}]:
+            transport = AatUssdTransport({}, {
+                'transport_name': 'aat_ussd',
+                'base_url': 'http://www.example.com/foo',
+                'web_path': '/api/aat/ussd/',
+                'web_port': '0',
+                'static_menus': {'*1234#': menu},
+            })
+            self.assertRaises(ConfigError, transport.validate_config)
+
+    def test_invalid_page_budget(self):
+        for config in [{'page_budget': 1}, {'page_budget': -1},
+                       {'provider_page_budgets': {'mtn': 3}}]:
+            config.update({
+                'transport_name': 'aat_ussd',
+                'base_url': 'http://www.example.com/foo',
+                'web_path': '/api/aat/ussd/',
+                'web_port': '0',
+            })
+            transport = AatUssdTransport({}, config)
+            self.assertRaises(ConfigError, transport.validate_config)
+
+    @inlineCallbacks
+    def test_stall_warning(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({
+            'stall_threshold': 0.5,
+            'stall_check_interval': 10,
+        })
+        timer = transport.watchdog.timer = FakeTimer()
+        clock.advance(10)
+
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        timer.now = 12
+        transport.watchdog.check()
+        with LogCatcher() as lc:
+            clock.advance(10)
+        [line] = self.log_lines(lc)
+        self.assertTrue(line.startswith('Reactor stalled for 2000.0ms'))
+        self.assertTrue('handle_raw_inbound_message:' in line)
+        self.assertTrue('in test_stall_warning' in line)
+        stats = transport.get_stats()
+        self.assertEqual(stats['reactor']['stalls'], 1)
+
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        yield d
+
+    def test_invalid_stall_config(self):
+        transport = AatUssdTransport({}, {
+            'transport_name': 'aat_ussd',
+            'base_url': 'http://www.example.com/foo',
+            'web_path': '/api/aat/ussd/',
+            'web_port': '0',
+            'stall_threshold': 0.5,
+            'stall_check_interval': 0,
+        })
+        self.assertRaises(ConfigError, transport.validate_config)
+
+    @inlineCallbacks
+    def test_request_lost(self):
+        transport = yield self.get_transport()
+        d = self.tx_helper.mk_request(request='*1234#')
+        d.addErrback(lambda _: None)
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        d.cancel()
+        while transport._requests:
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(transport.stats['abandoned'], 1)
+
+        reply = msg.reply('Ni!')
+        self.tx_helper.dispatch_outbound(reply)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_nack(
+            nack, reply, AatUssdTransport.RESPONSE_FAILURE_ERROR)
+
+    @inlineCallbacks
+    def test_duplicate_timed_out(self):
+        clock = Clock()
+        self.patch(AatUssdTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport({
+            'dedup_window': 5,
+            'request_timeout': 10,
+        })
+
+        d1 = self.tx_helper.mk_request(
+            request='1', to_addr='*1234#', ussdSessionId='s1')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        d2 = self.tx_helper.mk_request(
+            request='1', to_addr='*1234#', ussdSessionId='s1')
+        while not transport.dedup.suppressed['attached']:
+            yield deferLater(reactor, 0.01, lambda: None)
+        # Sweep the first request before the retry attached to it
+        transport._requests = OrderedDict(sorted(
+            transport._requests.items(),
+            key=lambda item: item[0] != msg['message_id']))
+        clock.advance(15)
+        [r1, r2] = yield gatherResults([d1, d2])
+        self.assertEqual([r1.code, r2.code], [504, 504])
+        self.assertEqual(transport.stats['timeouts'], 1)
+
+        # Requests still time out after the retry was answered in the sweep
+        d3 = self.tx_helper.mk_request(
+            request='2', to_addr='*1234#', ussdSessionId='s1')
+        yield self.tx_helper.wait_for_dispatched_inbound(2)
+        clock.advance(15)
+        r3 = yield d3
+        self.assertEqual(r3.code, 504)
+
+    @inlineCallbacks
+    def test_request_lost_with_duplicates(self):
+        transport = yield self.get_transport({
+            'dedup_window': 5,
+            'capture_path': os.path.join(self.socket_dir, 'capture'),
+        })
+        d1 = self.tx_helper.mk_request(
+            request='1', to_addr='*1234#', ussdSessionId='s1')
+        d1.addErrback(lambda _: None)
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        d2 = self.tx_helper.mk_request(
+            request='1', to_addr='*1234#', ussdSessionId='s1')
+        while not transport.dedup.suppressed['attached']:
+            yield deferLater(reactor, 0.01, lambda: None)
+
+        d1.cancel()
+        retried = yield d2
+        self.assertEqual(
+            retried.code, transport.request_timeout_status_code)
+        self.assertEqual(len(transport.dedup), 0)
+        self.assertEqual(transport.capture._pending, {})
+
+        # The next retry is a new request rather than another waiter
+        d3 = self.tx_helper.mk_request(
+            request='1', to_addr='*1234#', ussdSessionId='s1')
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.tx_helper.dispatch_outbound(msg.reply('Ni!'))
+        response = yield d3
+        self.assert_outbound_message(
+            response.delivered_body, 'Ni!', self.callback_url('*1234#'))
+
+    @inlineCallbacks
+    def test_outbound_batch_error(self):
+        transport = yield self.get_transport({'outbound_prefetch_count': 10})
+        render_reply = transport.render_reply
+
+        def broken_render_reply(message):
+            if message['content'] == 'Broken':
+                raise ValueError('Broken reply')
+            return render_reply(message)
+        transport.render_reply = broken_render_reply
+
+        d = self.tx_helper.mk_request(request='*1234#')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        broken = msg.reply('Broken')
+        reply = msg.reply('Ni!')
+        self.tx_helper.dispatch_outbound(broken)
+        self.tx_helper.dispatch_outbound(reply)
+        response = yield d
+        self.assert_outbound_message(
+            response.delivered_body, 'Ni!', self.callback_url('*1234#'))
+
+        [nack, ack] = yield self.tx_helper.wait_for_dispatched_events(2)
+        self.assert_nack(
+            nack, broken, AatUssdTransport.RESPONSE_FAILURE_ERROR)
+        self.assert_ack(ack, reply)
+        [failure] = self.tx_helper.get_dispatched(
+            None, 'failures', FailureMessage)
+        self.assertEqual(failure['message'], broken.payload)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    @inlineCallbacks
+    def test_outbound_prefetch_duplicate_connector(self):
+        transport = yield self.get_transport({'outbound_prefetch_count': 10})
+        self.assertRaises(
+            DuplicateConnectorError,
+            transport.setup_ro_connector, transport.transport_name)
+
+    @inlineCallbacks
+    def test_outbound_batches(self):
+        transport = yield self.get_transport({'outbound_prefetch_count': 10})
+        consumer = transport.connectors[
+            transport.transport_name]._consumers['outbound']
+        self.assertEqual(consumer.prefetch_count, 10)
+        batches = []
+        flush_outbound = transport.flush_outbound
+
+        def record_flush():
+            batches.append(len(transport.outbound_batch))
+            flush_outbound()
+        transport.flush_outbound = record_flush
+
+        ds = [self.tx_helper.mk_request(request='*1234#', msisdn=msisdn)
+              for msisdn in ['27729042520', '27729042521', '27729042522']]
+        msgs = yield self.tx_helper.wait_for_dispatched_inbound(3)
+        for msg in msgs:
+            self.tx_helper.dispatch_outbound(msg.reply(
+                'Ni %s!' % (msg['from_addr'],)))
+        self.tx_helper.dispatch_outbound(msgs[0].reply(''))
+        responses = yield gatherResults(ds)
+        for msg, response in zip(msgs, responses):
+            self.assert_outbound_message(
+                response.delivered_body, 'Ni %s!' % (msg['from_addr'],),
+                self.callback_url('*1234#'))
+        self.assertEqual(batches, [4])
+
+        events = yield self.tx_helper.wait_for_dispatched_events(4)
+        self.assertEqual(
+            [event['event_type'] for event in events],
+            ['ack', 'ack', 'ack', 'nack'])
+        self.assertEqual(
+            events[3]['nack_reason'], AatUssdTransport.NO_CONTENT_ERROR)
@@ -0,0 +1,103 @@
+import gc
+import threading
+import time
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxaat.watchdog import GCTimes, StallWatchdog
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestGCTimes(VumiTestCase):
+
+    def test_callbacks(self):
+        timer = FakeTimer()
+        gc_times = GCTimes(timer)
+        gc_times.total = 0.0
+        gc_times('start', {})
+        timer.now = 0.25
+        gc_times('stop', {})
+        self.assertEqual(gc_times.total, 0.25)
+        self.assertEqual(gc_times.collections, 1)
+
+    def test_install(self):
+        gc_times = GCTimes()
+        gc_times.install()
+        self.add_cleanup(gc_times.uninstall)
+        if not hasattr(gc, 'callbacks'):
+            self.assertEqual(gc_times.total, None)
+            return
+        gc.collect()
+        self.assertEqual(gc_times.collections, 1)
+        self.assertTrue(gc_times.total > 0)
+
+
+class TestStallWatchdog(VumiTestCase):
+
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.stalls = []
+        self.watchdog = StallWatchdog(
+            threading.current_thread().ident, 0.1, 0.5, self.stalls.append,
+            self.timer)
+        self.watchdog.beat()
+
+    def advance(self, seconds):
+        self.timer.now += seconds
+
+    def test_beat(self):
+        self.advance(0.1)
+        self.watchdog.beat()
+        self.advance(0.3)
+        self.watchdog.check()
+        self.watchdog.beat()
+        self.assertEqual(self.stalls, [])
+        snapshot = self.watchdog.snapshot()
+        self.assertEqual(snapshot['beats'], 2)
+        self.assertEqual(snapshot['stalls'], 0)
+        self.assertAlmostEqual(snapshot['max_lag_ms'], 200)
+
+    def test_stall(self):
+        self.advance(1)
+        self.watchdog.check()
+        self.advance(1)
+        self.watchdog.beat()
+        [stall] = self.stalls
+        self.assertAlmostEqual(stall.lag, 1.9)
+        self.assertTrue('in test_stall' in stall.stack)
+        self.assertEqual(self.watchdog.snapshot()['stalls'], 1)
+
+    def test_stall_not_captured(self):
+        self.advance(1)
+        self.watchdog.check()
+        self.advance(0.1)
+        self.watchdog.beat()
+        # The stack captured in the last stall is not reused
+        self.advance(1)
+        self.watchdog.beat()
+        [_, stall] = self.stalls
+        self.assertAlmostEqual(stall.lag, 0.9)
+        self.assertEqual(stall.stack, None)
+
+    def test_thread(self):
+        watchdog = StallWatchdog(
+            threading.current_thread().ident, 0.001, 0.001,
+            self.stalls.append)
+        watchdog.start()
+        self.add_cleanup(watchdog.stop)
+        watchdog.beat()
+        # Stall until the watchdog thread has looked
+        for _ in range(500):
+            if watchdog._captured[1] is not None:
+                break
+            time.sleep(0.01)
+        watchdog.beat()
+        [stall] = self.stalls
+        self.assertTrue('in test_thread' in stall.stack)
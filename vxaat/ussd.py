@@ -1,13 +1,44 @@
 import json
+import threading
 from urllib import quote
-from xml.etree.ElementTree import Element, SubElement, tostring
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    gatherResults, inlineCallbacks, maybeDeferred)
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
 from twisted.web import http
 
+from vumi.blinkenlights.metrics import AVG, MAX, Count, Metric, MetricManager
 from vumi.message import TransportUserMessage
-from vumi.config import ConfigText, ConfigDict
+from vumi.config import (
+    ConfigText, ConfigDict, ConfigInt, ConfigList, ConfigFloat, ConfigBool,
+    ConfigError)
+from vumi.connectors import ReceiveOutboundConnector
+from vumi.service import build_web_site
 from vumi.transports.httprpc import HttpRpcTransport
+from vumi.transports.httprpc.httprpc import HttpRpcHealthResource
+
+from vxaat import envelope
+from vxaat.admin import (
+    AdminResource, ReadinessResource, authenticated, summarise)
+from vxaat.admission import AdmissionControl
+from vxaat.cache import LRUCache, TTLCache
+from vxaat.capture import CaptureWriter
+from vxaat.deadlines import DeadlineQueue
+from vxaat.dedup import Deduplicator
+from vxaat.eventlog import EventLog
+from vxaat.events import EventBatcher
+from vxaat.memory import start_tracing, stop_tracing, tracemalloc
+from vxaat.metrics import Counters, LatencyTracker, SessionMetrics
+from vxaat.paging import MIN_BUDGET, PagedReply, paginate
+from vxaat.parsing import RequestParser
+from vxaat.profiling import FunctionTimes
+from vxaat.providers import ProviderNormaliser, ProviderRuleError
+from vxaat.render import parse_options, render_body
+from vxaat.scaleout import SO_REUSEPORT, Forwarder, listen_reuse_port
+from vxaat.sessions import SessionTable
+from vxaat.watchdog import StallWatchdog
 
 
 class AatUssdTransportConfig(HttpRpcTransport.CONFIG_CLASS):
@@ -18,6 +49,222 @@ class AatUssdTransportConfig(HttpRpcTransport.CONFIG_CLASS):
         'Mappings from the provider values received from aat to normalised '
         'provider values',
         static=True, default={})
+    provider_rules = ConfigList(
+        'Rules for normalising provider values that have no exact entry in '
+        '`provider_mappings`. Each rule is a dict with a `match` type '
+        '(`iexact`, `prefix` or `regex`), the `value` to match and the '
+        'normalised `provider`. Case-insensitive rules are tried first, then '
+        'prefixes (longest first), then regular expressions in order.',
+        static=True, default=[])
+    provider_cache_size = ConfigInt(
+        'The number of raw provider values whose normalised value is '
+        'remembered.',
+        static=True, default=1024)
+    unknown_provider_summary_interval = ConfigInt(
+        'How often, in seconds, to log how many messages arrived from '
+        'providers with no mapping. Each such provider is also logged the '
+        'first time it is seen. `0` disables the summary.',
+        static=True, default=300)
+    reply_cache_size = ConfigInt(
+        'The number of rendered reply bodies to keep in an in-memory LRU '
+        'cache keyed by content, callback and session event. `0` disables '
+        'the cache.',
+        static=True, default=0)
+    reply_cache_max_bytes = ConfigInt(
+        'The maximum total size in bytes of the rendered reply bodies kept in '
+        'the reply cache. `0` means the cache is only bounded by '
+        '`reply_cache_size`.',
+        static=True, default=0)
+    metrics_prefix = ConfigText(
+        'The prefix for the names of the metrics the transport publishes. '
+        'No metrics are published if this is not set. Metrics per provider '
+        'count providers that `provider_mappings` and `provider_rules` do '
+        'not give as `other`.',
+        static=True, default=None)
+    latency_buckets = ConfigList(
+        'The upper bounds, in seconds, of the buckets of the reply latency '
+        'histograms.',
+        static=True, default=[0.5, 1, 2, 5, 10])
+    reply_deadline = ConfigFloat(
+        'The number of seconds after a request arrives at which the transport '
+        'stops waiting for the application, answers with '
+        '`deadline_reply_content` and closes the session. This should be '
+        'shorter than the AAT gateway\'s timeout. `0` disables the deadline.',
+        static=True, default=0)
+    deadline_reply_content = ConfigText(
+        'The content of the reply sent when `reply_deadline` passes.',
+        static=True,
+        default='Sorry, the service is busy. Please try again later.')
+    session_idle_timeout = ConfigFloat(
+        'The number of seconds without a request after which a USSD session '
+        'is considered abandoned. The transport then publishes a '
+        'session close message for it. Sessions are tracked by '
+        '`ussdSessionId` in memory. `0` disables session tracking.',
+        static=True, default=0)
+    max_inflight_requests = ConfigInt(
+        'The maximum number of requests waiting for a reply. Requests above '
+        'the limit are answered immediately with `busy_reply_content` and '
+        'the session is closed. With `reuse_port` the limit is per process. '
+        '`0` means no limit.',
+        static=True, default=0)
+    max_inflight_requests_per_provider = ConfigInt(
+        'The maximum number of requests waiting for a reply from each '
+        'normalised provider. `0` means no limit.',
+        static=True, default=0)
+    busy_reply_content = ConfigText(
+        'The content of the reply sent to requests rejected because too '
+        'many are in flight.',
+        static=True,
+        default='Sorry, the service is busy. Please try again later.')
+    event_batching = ConfigBool(
+        'Whether to buffer ack and nack events and publish them in batches '
+        'instead of as each reply is written, so that publishing them does '
+        'not delay other replies.',
+        static=True, default=False)
+    event_batch_interval = ConfigFloat(
+        'The number of seconds to buffer events for when `event_batching` is '
+        'on. `0` publishes them on the next reactor turn.',
+        static=True, default=0)
+    event_batch_size = ConfigInt(
+        'The most events to buffer when `event_batching` is on. A full '
+        'buffer is published straight away.',
+        static=True, default=1000)
+    page_budget = ConfigInt(
+        'The size in octets of the longest reply text sent on one screen. '
+        'Longer replies are split into pages, each with a `more_label` '
+        'option, and the rest of the pages are sent by the transport when '
+        'the user selects it. Text in the GSM 03.38 alphabet fits '
+        '8/7 characters per octet, anything else half a character per '
+        'octet. The budget should leave room for the option and be at '
+        'least 4 octets. `0` disables pagination.',
+        static=True, default=0)
+    provider_page_budgets = ConfigDict(
+        'Page budgets for particular normalised providers, overriding '
+        '`page_budget`. `0` disables pagination for a provider.',
+        static=True, default={})
+    more_command = ConfigText(
+        'The command of the option for the next page of a paginated reply.',
+        static=True, default='#')
+    more_label = ConfigText(
+        'The label of the option for the next page of a paginated reply.',
+        static=True, default='More')
+    page_cache_size = ConfigInt(
+        'The most paginated replies to keep the remaining pages of.',
+        static=True, default=10000)
+    page_cache_ttl = ConfigFloat(
+        'The number of seconds the remaining pages of a reply are kept for.',
+        static=True, default=300)
+    dedup_window = ConfigFloat(
+        'The number of seconds after a request is answered during which an '
+        'identical request (same `ussdSessionId`, `msisdn`, `request` and '
+        '`to_addr`) is treated as a gateway retry and answered with the same '
+        'reply from the application instead of being published. Identical '
+        'requests that arrive while the first is in flight wait for its '
+        'reply, or are answered like a timed out request if the gateway '
+        'hangs up on the first. This should be shorter than a user takes to '
+        'answer a screen, or repeated input will be mistaken for a retry. '
+        '`0` disables deduplication.',
+        static=True, default=0)
+    dedup_cache_size = ConfigInt(
+        'The most replies to keep for answering retries.',
+        static=True, default=10000)
+    worker_id = ConfigText(
+        'A name for this transport process that is unique among the '
+        'processes sharing `transport_name`. Inbound messages are tagged '
+        'with it so that replies consumed by another process can be '
+        'forwarded back to this one. Requires `forwarding_socket_dir`.',
+        static=True, default=None)
+    forwarding_socket_dir = ConfigText(
+        'A directory the processes sharing `transport_name` can all reach. '
+        'Each listens on a unix socket in it named after its `worker_id`, '
+        'for replies forwarded by the others.',
+        static=True, default=None)
+    reuse_port = ConfigBool(
+        'Whether to listen on `web_port` with SO_REUSEPORT, so that several '
+        'processes can share the port and the kernel balances connections '
+        'between them. The next request in a session may reach any of them, '
+        'so this cannot be used with `page_budget`, '
+        '`provider_page_budgets`, `dedup_window` or `session_idle_timeout`, '
+        'which keep state in one process.',
+        static=True, default=False)
+    capture_path = ConfigText(
+        'Record inbound requests and their reply latencies to capture files '
+        'named `<capture_path>.<n>`, for replaying with '
+        '`vxaat.benchmarks.replay`. Disabled if not set.',
+        static=True, default=None)
+    capture_max_bytes = ConfigInt(
+        'The size at which to start a new capture file.',
+        static=True, default=64 * 1024 * 1024)
+    capture_flush_interval = ConfigFloat(
+        'How often, in seconds, to write buffered records to the capture '
+        'file. Records are also written soon after 64KB are buffered.',
+        static=True, default=1.0)
+    drain_reply_content = ConfigText(
+        'The content of the reply that closes new sessions while the '
+        'transport drains.',
+        static=True,
+        default='The service is restarting. Please dial again in a moment.')
+    static_menus = ConfigDict(
+        'Dialled strings mapped to first screens the transport answers new '
+        'sessions with itself, without waiting for the application, which '
+        'is still sent the new session. Each screen is either its content '
+        "or a dict with `content` and `options` in the same form as "
+        "`helper_metadata['aat_ussd']['options']` on replies.",
+        static=True, default={})
+    log_format = ConfigText(
+        "How to log messages passing through the transport: 'text' for a "
+        "line of prose per message, or 'structured' for `event key=value` "
+        "records sampled at `log_sample_rates`.",
+        static=True, default='text')
+    log_sample_rates = ConfigDict(
+        "Structured log event types ('inbound', 'outbound', 'next_page', "
+        "'static_menu', 'busy', 'turned_away', 'duplicate') mapped to the "
+        "share of them to log, from 0 to 1. Unlisted types are all logged, "
+        "as are errors ('bad_request', 'nack', 'timeout', 'reply_deadline', "
+        "'forward_failed', 'invalid_options').",
+        static=True, default={})
+    admin_path = ConfigText(
+        'The path to serve the admin resource on, next to `web_path`. '
+        'Requires `admin_username` and `admin_password`. Disabled if not '
+        'set.',
+        static=True, default=None)
+    admin_username = ConfigText(
+        'The username the admin resource requires.',
+        static=True, default=None)
+    admin_password = ConfigText(
+        'The password the admin resource requires.',
+        static=True, default=None)
+    stall_threshold = ConfigFloat(
+        "Log a warning, with the reactor thread's stack and the time spent "
+        "in the transport's handlers and garbage collection, whenever the "
+        "reactor gets to a timer more than this many seconds late. "
+        "Disabled if 0.",
+        static=True, default=0)
+    stall_check_interval = ConfigFloat(
+        'How often, in seconds, to check that the reactor is getting to '
+        'its timers when `stall_threshold` is set.',
+        static=True, default=0.05)
+    trace_memory_frames = ConfigInt(
+        'Start tracemalloc, keeping this many frames of each allocation, '
+        'so that `<admin_path>/memory` reports allocation sites instead of '
+        'object types. Needs Python 3. Disabled if 0.',
+        static=True, default=0)
+    outbound_prefetch_count = ConfigInt(
+        "Consume replies in micro-batches: take up to this many replies "
+        "from the broker at a time, instead of `amqp_prefetch_count`, and "
+        "write all the replies that have arrived in one pass before "
+        "publishing their acks and nacks. Replies are acknowledged to the "
+        "broker as they are queued, not once they are written. Disabled if "
+        "0.",
+        static=True, default=0)
+    compact_envelope = ConfigBool(
+        "Publish each AAT field of inbound messages once: the provider "
+        "only at the top level and the USSD session id only in "
+        "`transport_metadata['aat_ussd']`. Applications can read them "
+        "with `vxaat.envelope.get_provider` and `get_ussd_session_id`, or "
+        "restore the full envelope with "
+        "`vxaat.middleware.ExpandEnvelopeMiddleware`.",
+        static=True, default=False)
 
 
 class AatUssdTransport(HttpRpcTransport):
@@ -32,15 +279,598 @@ class AatUssdTransport(HttpRpcTransport):
     # errors
     RESPONSE_FAILURE_ERROR = "Response to http request failed."
     NOT_REPLY_ERROR = "Outbound message is not a reply"
+    STATIC_MENU_ERROR = "Request was answered with a static menu."
     NO_CONTENT_ERROR = "Outbound message has no content."
+    INVALID_OPTIONS_ERROR = "Outbound message has invalid menu options."
 
     CONFIG_CLASS = AatUssdTransportConfig
 
+    # Timed for the admin resource and stall warnings when either is enabled
+    TIMED_FUNCTIONS = (
+        'generate_body', 'handle_raw_inbound_message',
+        'handle_outbound_message', 'render_reply', 'finish_request',
+        'publish_ussd_message', 'publish_ack', 'publish_nack')
+
+    STATS_COUNTERS = (
+        'requests', 'bad_requests', 'acks', 'nacks', 'timeouts', 'busy',
+        'turned_away', 'static_menus', 'abandoned')
+
+    # The provider in metric names for providers without a mapping or rule
+    OTHER_PROVIDER = 'other'
+
+    # How often to check whether a draining transport is done
+    DRAIN_CHECK_INTERVAL = 1.0
+
+    # How many requests answered by the reply deadline to remember, so that
+    # late replies to them can be dropped without rendering them.
+    EXPIRED_REQUESTS_CACHE_SIZE = 10000
+
+    # How many requests answered with a static menu to remember, so that
+    # replies to them can be dropped.
+    STATIC_REQUESTS_CACHE_SIZE = 10000
+
+    def validate_config(self):
+        super(AatUssdTransport, self).validate_config()
+        config = self.get_static_config()
+        try:
+            self.provider_normaliser = ProviderNormaliser(
+                config.provider_mappings, config.provider_rules,
+                config.provider_cache_size, self.log.warning)
+        except ProviderRuleError as e:
+            raise ConfigError(str(e))
+        self.request_parser = RequestParser(
+            self.EXPECTED_FIELDS, self.OPTIONAL_FIELDS,
+            self._validation_mode == self.STRICT_MODE, self.ENCODING)
+        if bool(config.worker_id) != bool(config.forwarding_socket_dir):
+            raise ConfigError(
+                'worker_id and forwarding_socket_dir must be set together.')
+        if config.reuse_port and SO_REUSEPORT is None:
+            raise ConfigError('SO_REUSEPORT is not supported here.')
+        if config.reuse_port:
+            per_process = [name for name, enabled in [
+                ('page_budget', config.page_budget > 0),
+                ('provider_page_budgets', config.provider_page_budgets),
+                ('dedup_window', config.dedup_window > 0),
+                ('session_idle_timeout', config.session_idle_timeout > 0),
+            ] if enabled]
+            if per_process:
+                raise ConfigError(
+                    'reuse_port cannot be used with %s, which keep state in '
+                    'one process.' % (', '.join(per_process),))
+        budgets = [('page_budget', config.page_budget)] + [
+            ('provider_page_budgets[%r]' % (provider,), budget)
+            for provider, budget in config.provider_page_budgets.items()]
+        for name, budget in budgets:
+            if budget != 0 and budget < MIN_BUDGET:
+                raise ConfigError(
+                    '%s must be 0 or at least %d octets, not %r.'
+                    % (name, MIN_BUDGET, budget))
+        self.static_menus = {}
+        for dialled, screen in config.static_menus.items():
+            if not isinstance(screen, dict):
+                screen = {'content': screen}
+            try:
+                options = parse_options(screen.get('options'))
+            except ValueError as e:
+                raise ConfigError(
+                    'Invalid static menu for %r: %s' % (dialled, e))
+            if not screen.get('content'):
+                raise ConfigError(
+                    'Static menu for %r has no content.' % (dialled,))
+            self.static_menus[dialled] = (screen['content'], options)
+        if config.log_format not in ('text', 'structured'):
+            raise ConfigError(
+                "log_format must be 'text' or 'structured', not %r"
+                % (config.log_format,))
+        self.event_log = None
+        if config.log_format == 'structured':
+            try:
+                self.event_log = EventLog(
+                    self.log.info, self.log.warning, config.log_sample_rates)
+            except ValueError as e:
+                raise ConfigError(str(e))
+        if config.admin_path and not (
+                config.admin_username and config.admin_password):
+            raise ConfigError(
+                'admin_path requires admin_username and admin_password.')
+        if config.stall_threshold > 0 and config.stall_check_interval <= 0:
+            raise ConfigError(
+                'stall_check_interval must be positive when stall_threshold '
+                'is set.')
+        if config.trace_memory_frames > 0 and tracemalloc is None:
+            raise ConfigError('tracemalloc is not available here.')
+
+    def setup_connectors(self):
+        # The connectors hold on to handle_outbound_message, so it must be
+        # wrapped before they are set up.
+        config = self.get_static_config()
+        self.function_times = None
+        if config.admin_path or config.stall_threshold > 0:
+            self.function_times = FunctionTimes()
+            for name in self.TIMED_FUNCTIONS:
+                setattr(self, name, self.function_times.wrap(
+                    name, getattr(self, name)))
+        return super(AatUssdTransport, self).setup_connectors()
+
+    def setup_ro_connector(self, connector_name, middleware=True):
+        outbound_prefetch_count = (
+            self.get_static_config().outbound_prefetch_count)
+        if outbound_prefetch_count <= 0:
+            return super(AatUssdTransport, self).setup_ro_connector(
+                connector_name, middleware)
+
+        # BaseWorker.setup_connector uses amqp_prefetch_count for every
+        # connector, so the count is swapped in as the connector is made.
+        def connector_cls(worker, name, prefetch_count=None, middlewares=None):
+            return ReceiveOutboundConnector(
+                worker, name, prefetch_count=outbound_prefetch_count,
+                middlewares=middlewares)
+        return self.setup_connector(
+            connector_cls, connector_name, middleware=middleware)
+
     @inlineCallbacks
     def setup_transport(self):
-        yield super(AatUssdTransport, self).setup_transport()
         config = self.get_static_config()
         self.provider_mappings = config.provider_mappings
+        self.provider_summary = LoopingCall(
+            self.provider_normaliser.log_summary)
+        self.provider_summary.clock = self.get_clock()
+        if config.unknown_provider_summary_interval > 0:
+            self.provider_summary.start(
+                config.unknown_provider_summary_interval, now=False)
+
+        self.reply_cache = None
+        if config.reply_cache_size > 0:
+            self.reply_cache = LRUCache(
+                config.reply_cache_size,
+                max_bytes=config.reply_cache_max_bytes or None)
+
+        self.metrics = None
+        self.latency_tracker = None
+        if config.metrics_prefix:
+            self.metrics = yield self.start_publisher(
+                MetricManager, config.metrics_prefix)
+            self.latency_tracker = LatencyTracker(
+                self.metrics, self.get_clock(), config.latency_buckets)
+
+        self.reply_deadline = config.reply_deadline
+        self.deadlines = None
+        if self.reply_deadline > 0:
+            self.deadlines = DeadlineQueue(
+                self.get_clock(), self.handle_reply_deadline)
+            self.deadline_body = self.generate_body(
+                config.deadline_reply_content, None,
+                TransportUserMessage.SESSION_CLOSE)
+            self.expired_requests = LRUCache(self.EXPIRED_REQUESTS_CACHE_SIZE)
+
+        self.admission = None
+        self.rejection_counts = None
+        if (config.max_inflight_requests > 0 or
+                config.max_inflight_requests_per_provider > 0):
+            self.admission = AdmissionControl(
+                config.max_inflight_requests,
+                config.max_inflight_requests_per_provider)
+            self.busy_body = self.generate_body(
+                config.busy_reply_content, None,
+                TransportUserMessage.SESSION_CLOSE)
+            if self.metrics is not None:
+                self.rejection_counts = Counters(self.metrics, 'rejected')
+
+        self.event_batcher = None
+        if config.event_batching:
+            self.event_batcher = EventBatcher(
+                self.get_clock(), self.publish_batched_event,
+                config.event_batch_interval, config.event_batch_size,
+                self.record_event_flush)
+            if self.metrics is not None:
+                self.event_flush_size = self.metrics.register(
+                    Metric('events.flush_size', [AVG, MAX]))
+                self.event_flushes = Counters(self.metrics, 'events.flushes')
+
+        self.page_cache = None
+        if config.page_budget > 0 or config.provider_page_budgets:
+            self.page_budget = config.page_budget
+            self.page_budgets = config.provider_page_budgets
+            self.more_option = [(config.more_command, config.more_label, None)]
+            self.page_cache = TTLCache(
+                self.get_clock(), config.page_cache_ttl,
+                config.page_cache_size)
+
+        self.dedup = None
+        self.duplicate_counts = None
+        if config.dedup_window > 0:
+            self.dedup = Deduplicator(
+                self.get_clock(), config.dedup_window,
+                config.dedup_cache_size)
+            if self.metrics is not None:
+                self.duplicate_counts = Counters(self.metrics, 'duplicates')
+
+        self.compact_envelope = config.compact_envelope
+        self.reuse_port = config.reuse_port
+        self.worker_id = config.worker_id
+        self.forwarder = None
+        if self.worker_id:
+            self.forwarder = Forwarder(
+                reactor, config.forwarding_socket_dir,
+                self.worker_id, self.handle_forwarded_message)
+            self.forwarder.listen()
+
+        self.static_bodies = None
+        if self.static_menus:
+            self.static_bodies = dict(
+                (dialled, self.generate_body(
+                    content, self.get_callback_url(dialled),
+                    TransportUserMessage.SESSION_RESUME, options))
+                for dialled, (content, options) in self.static_menus.items())
+            self.static_requests = LRUCache(self.STATIC_REQUESTS_CACHE_SIZE)
+
+        self.stats = dict.fromkeys(self.STATS_COUNTERS, 0)
+        self.draining = False
+        self.drain_reply_content = config.drain_reply_content
+        self.drain_check = LoopingCall(self.check_drained)
+        self.drain_check.clock = self.get_clock()
+
+        self.capture = None
+        if config.capture_path:
+            self.capture = CaptureWriter(
+                config.capture_path, config.capture_max_bytes,
+                clock=self.get_clock())
+            self.capture_flush = LoopingCall(self.capture.flush)
+            self.capture_flush.clock = self.get_clock()
+            self.capture_flush.start(config.capture_flush_interval, now=False)
+
+        self.sessions = None
+        self.session_metrics = None
+        if config.session_idle_timeout > 0:
+            self.sessions = SessionTable(
+                self.get_clock(), config.session_idle_timeout,
+                self.handle_session_expired)
+            if self.metrics is not None:
+                self.session_metrics = SessionMetrics(self.metrics)
+
+        self.outbound_batch = None
+        if config.outbound_prefetch_count > 0:
+            self.outbound_batch = []
+            self.outbound_flush = None
+            if self.metrics is not None:
+                self.outbound_batch_size = self.metrics.register(
+                    Metric('outbound.batch_size', [AVG, MAX]))
+
+        self.started_tracing = False
+        if config.trace_memory_frames > 0:
+            self.started_tracing = start_tracing(config.trace_memory_frames)
+
+        self.watchdog = None
+        if config.stall_threshold > 0:
+            self.watchdog = StallWatchdog(
+                threading.current_thread().ident,
+                config.stall_check_interval, config.stall_threshold,
+                self.handle_stall)
+            self.handler_totals = self.function_times.totals()
+            if self.metrics is not None:
+                self.stall_lag = self.metrics.register(
+                    Metric('reactor.stall_lag', [AVG, MAX]))
+                self.stall_count = self.metrics.register(
+                    Count('reactor.stalls'))
+            self.watchdog_beat = LoopingCall(self.beat_watchdog)
+            self.watchdog_beat.clock = self.get_clock()
+            self.watchdog.start()
+            self.watchdog_beat.start(config.stall_check_interval, now=False)
+
+        # This starts the web server, so everything requests need must
+        # already be in place.
+        yield super(AatUssdTransport, self).setup_transport()
+
+    @inlineCallbacks
+    def teardown_transport(self):
+        if self.outbound_batch is not None and self.outbound_flush is not None:
+            self.outbound_flush.cancel()
+            self.flush_outbound()
+        yield super(AatUssdTransport, self).teardown_transport()
+        if self.forwarder is not None:
+            yield self.forwarder.stop()
+        if self.event_batcher is not None:
+            yield gatherResults(self.event_batcher.stop())
+        if self.provider_summary.running:
+            self.provider_summary.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.deadlines is not None:
+            self.deadlines.stop()
+        if self.sessions is not None:
+            self.sessions.stop()
+        if self.capture is not None:
+            self.capture_flush.stop()
+            self.capture.close()
+        if self.drain_check.running:
+            self.drain_check.stop()
+        if self.watchdog is not None:
+            self.watchdog_beat.stop()
+            self.watchdog.stop()
+        if self.started_tracing:
+            stop_tracing()
+
+    def start_web_resources(self, resources, port, site_class=None):
+        config = self.get_static_config()
+        resources = [
+            (ReadinessResource(self)
+             if isinstance(resource, HttpRpcHealthResource) else resource,
+             path)
+            for resource, path in resources]
+        if config.admin_path:
+            resources = resources + [(authenticated(
+                AdminResource(self), config.admin_username,
+                config.admin_password, config.web_auth_domain),
+                config.admin_path)]
+        if not self.reuse_port:
+            return super(AatUssdTransport, self).start_web_resources(
+                resources, port, site_class)
+        resources = dict((path, resource) for resource, path in resources)
+        site_factory = build_web_site(resources, site_class=site_class)
+        return listen_reuse_port(reactor, port, site_factory)
+
+    def get_health_response(self):
+        return json.dumps({
+            'pending_requests': len(self._requests),
+            'ready': not self.draining,
+        })
+
+    def get_stats(self):
+        now = self.clock.seconds()
+        ages = sorted(now - r['timestamp'] for r in self._requests.values())
+        return {
+            'ready': not self.draining,
+            'draining': self.draining,
+            'drained': self.is_drained(),
+            'outstanding': len(ages),
+            'open_sessions': (
+                len(self.sessions) if self.sessions is not None else None),
+            'request_age_ms': summarise(ages),
+            'counters': dict(self.stats),
+            'caches': self.get_cache_stats(),
+            'reactor': (
+                self.watchdog.snapshot() if self.watchdog is not None
+                else None),
+        }
+
+    def get_cache_stats(self):
+        """
+        Return the size, hits, misses, evictions and, for caches whose
+        entries expire, expirations of each cache that is enabled.
+        """
+        caches = {'providers': self.provider_normaliser.cache_stats()}
+        if self.reply_cache is not None:
+            caches['replies'] = self.reply_cache.stats()
+        if self.page_cache is not None:
+            caches['pages'] = self.page_cache.stats()
+        if self.dedup is not None:
+            caches['dedup'] = self.dedup.cache_stats()
+        return caches
+
+    def start_drain(self):
+        """
+        Stop accepting new sessions, keep serving the ones in progress and
+        log when none are left.
+        """
+        if self.draining:
+            return
+        self.log.info('Draining, new sessions will be closed.')
+        self.draining = True
+        self.drain_body = self.generate_body(
+            self.drain_reply_content, None,
+            TransportUserMessage.SESSION_CLOSE)
+        self.drain_check.start(self.DRAIN_CHECK_INTERVAL)
+
+    def is_drained(self):
+        """
+        Whether the transport is draining and has no requests waiting for
+        replies or, if it tracks them, open sessions.
+        """
+        return self.draining and not self._requests and (
+            self.sessions is None or len(self.sessions) == 0)
+
+    def check_drained(self):
+        if self.is_drained():
+            self.log.info('Drained, safe to stop.')
+            self.drain_check.stop()
+
+    def beat_watchdog(self):
+        self.watchdog.beat()
+        self.handler_totals = self.function_times.totals()
+
+    def handle_stall(self, stall):
+        totals = self.function_times.totals()
+        handlers = sorted(
+            ((total - self.handler_totals.get(name, 0.0), name)
+             for name, total in totals.items()), reverse=True)
+        handlers = ','.join(
+            '%s:%.1fms' % (name, elapsed * 1000)
+            for elapsed, name in handlers if elapsed > 0) or 'none'
+        gc_ms = stall.gc_time * 1000 if stall.gc_time is not None else None
+        if self.metrics is not None:
+            self.stall_lag.set(stall.lag)
+            self.stall_count.inc()
+        if self.event_log is not None:
+            self.event_log.warning(
+                'stall', lag_ms=stall.lag * 1000, handlers=handlers,
+                gc_ms=gc_ms, stack=stall.stack)
+        else:
+            self.log.warning(
+                format='Reactor stalled for %(lag_ms).1fms, handlers: '
+                       '%(handlers)s, gc: %(gc_ms)s, stack:\n%(stack)s',
+                lag_ms=stall.lag * 1000, handlers=handlers,
+                gc_ms='%.1fms' % (gc_ms,) if gc_ms is not None else 'unknown',
+                stack=stall.stack or '(not captured)\n')
+
+    def publish_ack(self, user_message_id, sent_message_id, **kw):
+        self.stats['acks'] += 1
+        if self.event_batcher is None:
+            return super(AatUssdTransport, self).publish_ack(
+                user_message_id, sent_message_id, **kw)
+        kw.update(user_message_id=user_message_id,
+                  sent_message_id=sent_message_id, event_type='ack')
+        self.event_batcher.add(kw)
+
+    def publish_nack(self, user_message_id, reason, **kw):
+        self.stats['nacks'] += 1
+        if self.event_log is not None:
+            self.event_log.warning(
+                'nack', message_id=user_message_id, reason=reason)
+        if self.event_batcher is None:
+            return super(AatUssdTransport, self).publish_nack(
+                user_message_id, reason, **kw)
+        kw.update(user_message_id=user_message_id, nack_reason=reason,
+                  event_type='nack')
+        self.event_batcher.add(kw)
+
+    def publish_batched_event(self, kw):
+        return self.publish_event(**kw)
+
+    def record_event_flush(self, size, reason):
+        if self.metrics is not None:
+            self.event_flush_size.set(size)
+            self.event_flushes.inc(reason)
+
+    def on_timeout(self, message_id, time):
+        self.stats['timeouts'] += 1
+        if self.event_log is not None:
+            self.event_log.warning(
+                'timeout', message_id=message_id, latency=time)
+        if self.latency_tracker is not None:
+            self.latency_tracker.expire(message_id)
+
+    def manually_close_requests(self):
+        # Timing out a request also answers the retries attached to it,
+        # which may come later in the same sweep.
+        for request_id, request_data in list(self._requests.items()):
+            if request_id not in self._requests:
+                continue
+            response_time = self.clock.seconds() - request_data['timestamp']
+            if response_time > self.request_timeout:
+                self.on_timeout(request_id, response_time)
+                self.close_request(request_id)
+
+    def finish_request(self, request_id, data, code=http.OK, headers={},
+                       replay=False):
+        """
+        Answer the request and any retries attached to it. Only ``replay``
+        bodies, the application's replies, are kept to answer later
+        retries with; the transport's own answers, like next pages and
+        fallbacks, would be stale or wrong for them.
+        """
+        if self.capture is not None:
+            self.capture_reply(request_id, code)
+        response_id = super(AatUssdTransport, self).finish_request(
+            request_id, data, code, headers)
+        if self.dedup is not None:
+            for waiter_id in self.dedup.finished(
+                    request_id, data, replay and code == http.OK):
+                if self.capture is not None:
+                    self.capture_reply(waiter_id, code)
+                super(AatUssdTransport, self).finish_request(
+                    waiter_id, data, code, headers)
+        return response_id
+
+    def capture_request(self, message_id, request):
+        # Recording a request must never stop it being answered
+        try:
+            self.capture.request(
+                message_id, self.clock.seconds(), request.args)
+        except Exception:
+            self.log.err(None, 'Could not capture request (%s).' % (
+                message_id,))
+
+    def capture_reply(self, request_id, code):
+        try:
+            self.capture.reply(request_id, self.clock.seconds(), code)
+        except Exception:
+            self.log.err(None, 'Could not capture reply (%s).' % (
+                request_id,))
+
+    def set_request(self, request_id, request_object, timestamp=None):
+        super(AatUssdTransport, self).set_request(
+            request_id, request_object, timestamp)
+        request_object.notifyFinish().addErrback(
+            self.handle_request_lost, request_id)
+
+    def handle_request_lost(self, failure, request_id):
+        # The gateway hung up. Forget the request now rather than holding
+        # on to it until it times out.
+        if request_id not in self._requests:
+            return
+        self.stats['abandoned'] += 1
+        if self.latency_tracker is not None:
+            self.latency_tracker.expire(request_id)
+        if self.capture is not None:
+            self.capture.forget(request_id)
+        self.remove_request(request_id)
+        if self.dedup is not None:
+            # Retries attached to the lost request would otherwise wait for
+            # a reply that may never come, and keep its key in flight.
+            for waiter_id in self.dedup.lost(request_id):
+                self.finish_request(
+                    waiter_id, self.request_timeout_body,
+                    self.request_timeout_status_code)
+
+    def remove_request(self, request_id):
+        super(AatUssdTransport, self).remove_request(request_id)
+        if self.deadlines is not None:
+            self.deadlines.cancel(request_id)
+        if self.admission is not None:
+            self.admission.release(request_id)
+
+    def handle_reply_deadline(self, message_id):
+        if self.event_log is not None:
+            self.event_log.warning(
+                'reply_deadline', message_id=message_id,
+                to_addr=self.get_request_to_addr(message_id))
+        else:
+            self.log.warning(
+                format='Reply deadline passed for %(to_addr)s, sending '
+                       'fallback reply.',
+                to_addr=self.get_request_to_addr(message_id))
+        if self.latency_tracker is not None:
+            self.latency_tracker.expire(message_id)
+        self.expired_requests.set(message_id, True)
+        self.finish_request(message_id, self.deadline_body)
+
+    def end_session(self, ussd_session_id, reason='reply'):
+        record = self.sessions.close(ussd_session_id)
+        if record is not None and self.session_metrics is not None:
+            self.session_metrics.record(record, self.clock.seconds(), reason)
+
+    def reject_request(self, message_id, provider, ussd_session_id):
+        self.stats['busy'] += 1
+        if self.event_log is not None:
+            self.event_log.info(
+                'busy', message_id=message_id, provider=provider)
+        if self.rejection_counts is not None:
+            self.rejection_counts.inc(self.get_metric_provider(provider))
+        if self.sessions is not None and ussd_session_id is not None:
+            self.end_session(ussd_session_id, 'busy')
+        return self.finish_request(message_id, self.busy_body)
+
+    def handle_session_expired(self, record):
+        if self.session_metrics is not None:
+            self.session_metrics.record(record, self.clock.seconds(), 'idle')
+        return self.publish_ussd_message(
+            message_id=self.generate_message_id(),
+            content=None,
+            to_addr=record.to_addr,
+            from_addr=record.msisdn,
+            session_event=TransportUserMessage.SESSION_CLOSE,
+            provider=record.provider,
+            ussd_session_id=record.session_id,
+        )
+
+    def get_request_age(self, request_id):
+        """
+        Seconds since the request arrived, or ``None`` if it has gone.
+        """
+        request = self._requests.get(request_id)
+        if request is None:
+            return None
+        return self.clock.seconds() - request['timestamp']
 
     def get_callback_url(self, to_addr):
         config = self.get_static_config()
@@ -49,141 +879,462 @@ class AatUssdTransport(HttpRpcTransport):
             config.web_path,
             quote(to_addr))
 
-    def get_optional_field_values(self, request, optional_fields=frozenset()):
-        values = {}
-        for field in optional_fields:
-            if field in request.args:
-                raw_value = request.args.get(field)[0]
-                values[field] = raw_value.decode(self.ENCODING)
-            else:
-                values[field] = None
-        return values
-
     def normalise_provider(self, provider):
-        if provider not in self.provider_mappings:
-            self.log.warning(
-                "No mapping exists for provider '%s', "
-                "using '%s' as a fallback" % (provider, provider,))
+        return self.provider_normaliser.normalise(provider)
+
+    def get_metric_provider(self, provider):
+        # Unmapped providers come straight from requests, so they share one
+        # set of metrics rather than registering new ones without limit.
+        if provider in self.provider_normaliser.providers:
             return provider
-        else:
-            return self.provider_mappings[provider]
+        return self.OTHER_PROVIDER
 
     @inlineCallbacks
     def handle_raw_inbound_message(self, message_id, request):
-        values, errors = self.get_field_values(
-            request,
-            self.EXPECTED_FIELDS,
-            self.OPTIONAL_FIELDS,
-        )
-
-        optional_values = self.get_optional_field_values(
-            request,
-            self.OPTIONAL_FIELDS
-        )
+        self.stats['requests'] += 1
+        if self.capture is not None:
+            self.capture_request(message_id, request)
+        values, errors = self.request_parser.parse(request.args)
 
         if errors:
-            self.log.info('Unhappy incoming message: %s ' % (errors,))
+            if self.event_log is not None:
+                self.event_log.warning(
+                    'bad_request', message_id=message_id, errors=errors)
+            else:
+                self.log.info(
+                    format='Unhappy incoming message: %(errors)s ',
+                    errors=errors)
+            self.stats['bad_requests'] += 1
             yield self.finish_request(
                 message_id, json.dumps(errors), code=http.BAD_REQUEST
             )
             return
 
-        from_addr = values['msisdn']
-        provider = self.normalise_provider(values['provider'])
-        ussd_session_id = optional_values['ussdSessionId']
+        if self.draining and values.to_addr is None:
+            self.stats['turned_away'] += 1
+            if self.event_log is not None:
+                self.event_log.info(
+                    'turned_away', message_id=message_id,
+                    msisdn=values.msisdn)
+            yield self.finish_request(message_id, self.drain_body)
+            return
+
+        from_addr = values.msisdn
+        provider = self.normalise_provider(values.provider)
+        ussd_session_id = values.ussd_session_id
+
+        if self.dedup is not None:
+            dedup_key = (
+                ussd_session_id, from_addr, values.request, values.to_addr)
+            if self.handle_duplicate(message_id, dedup_key):
+                return
+            self.dedup.register(dedup_key, message_id)
+
+        if self.page_cache is not None and values.to_addr is not None:
+            # Any other input abandons the rest of a paginated reply
+            page_key = self.get_page_key(ussd_session_id, from_addr)
+            paged = self.page_cache.pop(page_key)
+            if paged is not None and values.request == self.more_option[0][0]:
+                if self.event_log is not None:
+                    self.event_log.info(
+                        'next_page', message_id=message_id, msisdn=from_addr)
+                else:
+                    self.log.info(
+                        format='AatUssdTransport sending next page '
+                        '(%(message_id)s) to %(from_addr)s.',
+                        message_id=message_id, from_addr=from_addr)
+                if self.sessions is not None and ussd_session_id is not None:
+                    self.sessions.touch(
+                        ussd_session_id, from_addr, provider, paged.to_addr)
+                yield self.send_next_page(message_id, page_key, paged)
+                return
+
+        if (self.static_bodies is not None and values.to_addr is None and
+                values.request in self.static_bodies):
+            yield self.send_static_menu(
+                message_id, values.request, from_addr, provider,
+                ussd_session_id)
+            return
+
+        if (self.admission is not None and
+                not self.admission.admit(message_id, provider)):
+            self.reject_request(message_id, provider, ussd_session_id)
+            return
 
-        if optional_values['to_addr'] is not None:
+        if values.to_addr is not None:
             session_event = TransportUserMessage.SESSION_RESUME
-            to_addr = optional_values['to_addr']
-            content = optional_values['request']
+            to_addr = values.to_addr
+            content = values.request
         else:
             session_event = TransportUserMessage.SESSION_NEW
-            to_addr = optional_values['request']
+            to_addr = values.request
             content = None
 
-        self.log.info(
-            'AatUssdTransport receiving inbound message (%s) from %s to %s.'
-            % (message_id, from_addr, to_addr))
+        if self.event_log is not None:
+            self.event_log.info(
+                'inbound', message_id=message_id, msisdn=from_addr,
+                provider=provider, session_event=session_event,
+                to_addr=to_addr)
+        else:
+            self.log.info(
+                format='AatUssdTransport receiving inbound message '
+                '(%(message_id)s) from %(from_addr)s to %(to_addr)s.',
+                message_id=message_id, from_addr=from_addr, to_addr=to_addr)
+
+        if self.latency_tracker is not None:
+            self.latency_tracker.start(
+                message_id, self.get_metric_provider(provider), session_event)
+        if self.deadlines is not None:
+            self.deadlines.schedule(
+                message_id, self.clock.seconds() + self.reply_deadline)
+
+        if self.sessions is not None and ussd_session_id is not None:
+            self.sessions.touch(
+                ussd_session_id, from_addr, provider, to_addr,
+                new=session_event == TransportUserMessage.SESSION_NEW)
 
-        yield self.publish_message(
+        yield self.publish_ussd_message(
+            message_id=message_id,
+            content=content,
+            to_addr=to_addr,
+            from_addr=from_addr,
+            session_event=session_event,
+            provider=provider,
+            ussd_session_id=ussd_session_id,
+        )
+
+    def handle_duplicate(self, message_id, dedup_key):
+        """
+        Answer or attach the request if it repeats one in flight or just
+        answered, and return whether it did.
+        """
+        if self.dedup.attach(dedup_key, message_id):
+            kind = 'attached'
+        else:
+            body = self.dedup.replay(dedup_key)
+            if body is None:
+                return False
+            kind = 'replayed'
+            self.finish_request(message_id, body)
+        if self.event_log is not None:
+            self.event_log.info(
+                'duplicate', message_id=message_id, msisdn=dedup_key[1],
+                kind=kind)
+        else:
+            self.log.info(
+                format='AatUssdTransport suppressed duplicate request '
+                '(%(message_id)s) from %(from_addr)s: %(kind)s.',
+                message_id=message_id, from_addr=dedup_key[1], kind=kind)
+        if self.duplicate_counts is not None:
+            self.duplicate_counts.inc(kind)
+        return True
+
+    def send_static_menu(self, message_id, to_addr, from_addr, provider,
+                         ussd_session_id):
+        """
+        Answer a new session with its static first screen and then tell
+        the application about the session.
+        """
+        self.stats['static_menus'] += 1
+        self.finish_request(message_id, self.static_bodies[to_addr])
+        self.static_requests.set(message_id, True)
+        if self.event_log is not None:
+            self.event_log.info(
+                'static_menu', message_id=message_id, msisdn=from_addr,
+                provider=provider, to_addr=to_addr)
+        else:
+            self.log.info(
+                format='AatUssdTransport answering new session '
+                '(%(message_id)s) from %(from_addr)s to %(to_addr)s with a '
+                'static menu.',
+                message_id=message_id, from_addr=from_addr, to_addr=to_addr)
+        if self.sessions is not None and ussd_session_id is not None:
+            self.sessions.touch(
+                ussd_session_id, from_addr, provider, to_addr, new=True)
+        return self.publish_ussd_message(
+            message_id=message_id,
+            content=None,
+            to_addr=to_addr,
+            from_addr=from_addr,
+            session_event=TransportUserMessage.SESSION_NEW,
+            provider=provider,
+            ussd_session_id=ussd_session_id,
+            static_menu=True,
+        )
+
+    def get_page_key(self, ussd_session_id, msisdn):
+        if ussd_session_id is not None:
+            return ussd_session_id
+        return msisdn
+
+    def get_reply_pages(self, message):
+        """
+        Return the pages of the message's content if it is too long for
+        the provider's page budget, otherwise ``None``.
+        """
+        if self.page_cache is None or not message['content']:
+            return None
+        budget = self.page_budgets.get(
+            envelope.get_provider(message), self.page_budget)
+        if not budget:
+            return None
+        pages = paginate(message['content'], budget)
+        if len(pages) == 1:
+            return None
+        return pages
+
+    def get_page_body(self, page, to_addr):
+        return self.generate_body(
+            page, self.get_callback_url(to_addr),
+            TransportUserMessage.SESSION_RESUME, self.more_option)
+
+    def send_next_page(self, message_id, page_key, paged):
+        page = paged.pages.pop(0)
+        if paged.pages:
+            self.page_cache.set(page_key, paged)
+            return self.finish_request(
+                message_id, self.get_page_body(page, paged.to_addr))
+
+        if (self.sessions is not None and
+                paged.session_event == TransportUserMessage.SESSION_CLOSE):
+            self.end_session(paged.ussd_session_id)
+        return self.finish_request(message_id, self.generate_body(
+            page, self.get_callback_url(paged.to_addr), paged.session_event,
+            paged.options))
+
+    def publish_ussd_message(self, message_id, content, to_addr, from_addr,
+                             session_event, provider, ussd_session_id,
+                             static_menu=False):
+        aat_metadata = self.get_aat_metadata(provider, ussd_session_id)
+        if static_menu:
+            # The user has already been sent the first screen
+            aat_metadata['static_menu'] = True
+        return self.publish_message(
             message_id=message_id,
             content=content,
             to_addr=to_addr,
             from_addr=from_addr,
             session_event=session_event,
             transport_type=self.transport_type,
-            helper_metadata={
-                'session_id': ussd_session_id,
-            },
+            helper_metadata=envelope.helper_metadata(
+                ussd_session_id, self.compact_envelope),
             transport_metadata={
-                'aat_ussd': {
-                    'provider': provider,
-                    'ussd_session_id': ussd_session_id,
-                }
+                'aat_ussd': aat_metadata,
             },
             provider=provider,
         )
 
-    def generate_body(self, reply, callback, session_event):
-        request = Element('request')
-        headertext = SubElement(request, 'headertext')
-        headertext.text = reply
+    def get_aat_metadata(self, provider, ussd_session_id):
+        return envelope.aat_metadata(
+            provider, ussd_session_id, self.worker_id, self.compact_envelope)
 
+    def generate_body(self, reply, callback, session_event, options=None):
         # If this is not a session close event, then send options
-        if session_event != TransportUserMessage.SESSION_CLOSE:
-            options = SubElement(request, 'options')
-            SubElement(
-                options,
-                'option',
-                {
-                    'command': '1',
-                    'order': '1',
-                    'callback': callback,
-                    'display': "false"
-                }
-            )
-
-        return tostring(
-            request,
-            encoding='utf-8',
+        return render_body(
+            reply,
+            callback,
+            session_event != TransportUserMessage.SESSION_CLOSE,
+            options,
         )
 
-    @inlineCallbacks
+    def get_menu_options(self, message):
+        """
+        Return the menu options in the message's
+        ``helper_metadata['aat_ussd']['options']`` as a list of
+        ``(command, label, callback)`` tuples, or ``None`` if there are
+        none. Each option is a dict with a ``command``, a ``label`` and
+        optionally a ``callback`` URL to use instead of the transport's.
+
+        :raises ValueError: if the options are malformed.
+        """
+        return parse_options(
+            message['helper_metadata'].get('aat_ussd', {}).get('options'))
+
+    def get_reply_body(self, content, to_addr, session_event, options=None):
+        if self.reply_cache is None or options:
+            return self.generate_body(
+                content, self.get_callback_url(to_addr), session_event,
+                options)
+
+        key = (content, to_addr, session_event)
+        body = self.reply_cache.get(key)
+        if body is None:
+            body = self.generate_body(
+                content, self.get_callback_url(to_addr), session_event)
+            self.reply_cache.set(key, body)
+        return body
+
     def handle_outbound_message(self, message):
-        # Generate outbound message
+        if self.forwarder is not None:
+            owner = message['transport_metadata'].get(
+                'aat_ussd', {}).get('worker')
+            if owner is not None and owner != self.worker_id:
+                return self.forward_reply(owner, message)
+        if self.outbound_batch is not None:
+            # Return straight away, so that the consumer hands over every
+            # reply that has already arrived before the batch is flushed.
+            self.outbound_batch.append(message)
+            if self.outbound_flush is None:
+                self.outbound_flush = self.clock.callLater(
+                    0, self.flush_outbound)
+            return
+        return self.send_reply(message)
+
+    def forward_reply(self, owner, message):
+        """
+        Send a reply to the process holding the request it answers, which
+        then publishes its ack or nack.
+        """
+        d = self.forwarder.forward(owner, message.to_json())
+        d.addErrback(self.forward_reply_failed, owner, message)
+        return d
+
+    def forward_reply_failed(self, failure, owner, message):
+        if self.event_log is not None:
+            self.event_log.warning(
+                'forward_failed', message_id=message['message_id'],
+                worker=owner, reason=failure.getErrorMessage())
+        else:
+            self.log.warning(
+                format='Could not forward reply (%(message_id)s) to '
+                       '%(worker)s: %(reason)s',
+                message_id=message['message_id'], worker=owner,
+                reason=failure.getErrorMessage())
+        return self.publish_nack(
+            message['message_id'], self.RESPONSE_FAILURE_ERROR)
+
+    def handle_forwarded_message(self, data):
+        d = maybeDeferred(
+            self.send_reply, TransportUserMessage.from_json(data))
+        d.addErrback(self.log.err)
+        return d
+
+    def send_reply(self, message):
+        self.publish_reply_event(message, self.render_reply(message))
+
+    def flush_outbound(self):
+        """
+        Write the replies queued since the last flush, then publish their
+        acks and nacks.
+        """
+        batch, self.outbound_batch = self.outbound_batch, []
+        self.outbound_flush = None
+        results = []
+        for message in batch:
+            try:
+                results.append((message, self.render_reply(message)))
+            except Exception:
+                # Reported as the consumer reports an unbatched reply that
+                # fails, and nacked so that the application hears of it.
+                failure = Failure()
+                self.send_failure(
+                    message, failure.value, failure.getTraceback())
+                self.log.err(failure, 'Could not send reply (%s).' % (
+                    message['message_id'],))
+                results.append((message, self.RESPONSE_FAILURE_ERROR))
+        for message, error in results:
+            self.publish_reply_event(message, error)
+        if self.metrics is not None:
+            self.outbound_batch_size.set(len(batch))
+
+    def publish_reply_event(self, message, error):
         message_id = message['message_id']
-        body = self.generate_body(
-            message['content'],
-            self.get_callback_url(message['from_addr']),
-            message['session_event']
-        )
-        self.log.info('AatUssdTransport outbound message (%s) with content: %r'
-                      % (message_id, body,))
+        # we don't yield on these publishes because if a message store is
+        # used, that causes the worker to wait for Riak before processing
+        # the message and responding to USSD messages is time critical.
+        if error is None:
+            self.publish_ack(
+                user_message_id=message_id, sent_message_id=message_id)
+        else:
+            self.publish_nack(message_id, error)
+
+    def render_reply(self, message):
+        """
+        Render a reply and write it to its request, if it can be. Returns
+        ``None`` if it was written and otherwise the reason to nack it.
+        """
+        message_id = message['message_id']
+
+        # The request was answered with the fallback reply
+        if (self.deadlines is not None and
+                self.expired_requests.pop(message['in_reply_to'])):
+            if self.latency_tracker is not None:
+                self.latency_tracker.finish_late(message['in_reply_to'])
+            return self.RESPONSE_FAILURE_ERROR
+
+        # The request was answered with a static menu
+        if (self.static_bodies is not None and
+                self.static_requests.pop(message['in_reply_to'])):
+            return self.STATIC_MENU_ERROR
+
+        try:
+            options = self.get_menu_options(message)
+        except ValueError as e:
+            if self.event_log is not None:
+                self.event_log.warning(
+                    'invalid_options', message_id=message_id, error=str(e))
+            else:
+                self.log.warning(
+                    format='Invalid menu options in %(message_id)s: '
+                           '%(error)s',
+                    message_id=message_id, error=str(e))
+            return self.INVALID_OPTIONS_ERROR
+
+        # Generate outbound message
+        pages = self.get_reply_pages(message)
+        if pages is None:
+            body = self.get_reply_body(
+                message['content'],
+                message['from_addr'],
+                message['session_event'],
+                options,
+            )
+        else:
+            body = self.get_page_body(pages[0], message['from_addr'])
+        if self.event_log is not None:
+            self.event_log.info(
+                'outbound', message_id=message_id,
+                in_reply_to=message['in_reply_to'],
+                session_event=message['session_event'],
+                latency=self.get_request_age(message['in_reply_to']),
+                bytes=len(body))
+        else:
+            self.log.info(
+                format='AatUssdTransport outbound message (%(message_id)s) '
+                'with content: %(body)r',
+                message_id=message_id, body=body)
 
         # Errors
         if not message['content']:
-            yield self.publish_nack(message_id, self.NO_CONTENT_ERROR)
-            return
+            return self.NO_CONTENT_ERROR
         if not message['in_reply_to']:
-            yield self.publish_nack(message_id, self.NOT_REPLY_ERROR)
-            return
+            return self.NOT_REPLY_ERROR
 
         # Finish Request
         response_id = self.finish_request(
             message['in_reply_to'],
             body,
+            replay=True,
         )
 
         # Response failure
         if response_id is None:
-            # we don't yield on this publish because if a message store is
-            # used, that causes the worker to wait for Riak before processing
-            # the message and responding to USSD messages is time critical.
-            self.publish_nack(message_id, self.RESPONSE_FAILURE_ERROR)
-            return
+            if self.latency_tracker is not None:
+                self.latency_tracker.finish_late(message['in_reply_to'])
+            return self.RESPONSE_FAILURE_ERROR
 
-        # we don't yield on this publish because if a message store is
-        # used, that causes the worker to wait for Riak before processing
-        # the message and responding to USSD messages is time critical.
-        self.publish_ack(
-            user_message_id=message_id, sent_message_id=message_id)
+        if self.latency_tracker is not None:
+            self.latency_tracker.finish(message['in_reply_to'])
+
+        aat_metadata = message['transport_metadata'].get('aat_ussd', {})
+        if pages is not None:
+            self.page_cache.set(
+                self.get_page_key(
+                    aat_metadata.get('ussd_session_id'), message['to_addr']),
+                PagedReply(
+                    pages[1:], message['from_addr'], message['session_event'],
+                    options, aat_metadata.get('ussd_session_id')))
+        elif (self.sessions is not None and
+                message['session_event'] ==
+                TransportUserMessage.SESSION_CLOSE):
+            self.end_session(aat_metadata.get('ussd_session_id'))
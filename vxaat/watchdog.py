@@ -0,0 +1,163 @@
+# -*- test-case-name: vxaat.tests.test_watchdog -*-
+"""
+Noticing when an event loop thread stops getting back to its timers, and
+what it was doing instead.
+"""
+import gc
+import sys
+import threading
+import traceback
+from timeit import default_timer
+
+
+class GCTimes(object):
+    """
+    Adds up the time spent in garbage collections, on Pythons that call
+    ``gc.callbacks``. ``total`` stays ``None`` where they are not called.
+    """
+
+    def __init__(self, timer=default_timer):
+        self.timer = timer
+        self.total = None
+        self.collections = 0
+        self._started = None
+
+    def install(self):
+        if hasattr(gc, 'callbacks'):
+            self.total = 0.0
+            gc.callbacks.append(self)
+
+    def uninstall(self):
+        if hasattr(gc, 'callbacks') and self in gc.callbacks:
+            gc.callbacks.remove(self)
+
+    def __call__(self, phase, info):
+        if phase == 'start':
+            self._started = self.timer()
+        elif self._started is not None:
+            self.total += self.timer() - self._started
+            self.collections += 1
+            self._started = None
+
+
+class Stall(object):
+    """
+    A stretch of ``lag`` seconds, beyond the expected interval, between two
+    beats, with the watched thread's stack once it had gone on for longer
+    than the threshold. ``stack`` is ``None`` if the watchdog thread did
+    not get to look in time.
+    """
+    __slots__ = ('lag', 'stack', 'gc_time')
+
+    def __init__(self, lag, stack, gc_time):
+        self.lag = lag
+        self.stack = stack
+        self.gc_time = gc_time
+
+
+class StallWatchdog(object):
+    """
+    Watches a thread that calls :meth:`beat` every ``interval`` seconds.
+
+    Each beat measures the lag since the previous one beyond ``interval``.
+    A thread of the watchdog's own, once started, wakes every ``interval``
+    seconds and, if the watched thread has gone more than ``threshold``
+    seconds past its next beat, captures its stack. The next beat passes
+    the :class:`Stall` to ``on_stall``, on the watched thread.
+    """
+
+    def __init__(self, thread_id, interval, threshold, on_stall,
+                 timer=default_timer):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.threshold = threshold
+        self.on_stall = on_stall
+        self.timer = timer
+        self.gc_times = GCTimes(timer)
+        self.beats = 0
+        self.stalls = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self._last_beat = None
+        self._last_gc = None
+        # The beat count the captured stack belongs to, and the stack
+        self._captured = (None, None)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.gc_times.install()
+        self._thread = threading.Thread(
+            target=self._run, name='vxaat-stall-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.gc_times.uninstall()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        """
+        Capture the watched thread's stack if it is stalled and has not
+        been captured in this stall yet. Called from the watchdog thread.
+        """
+        beats, last_beat = self.beats, self._last_beat
+        if last_beat is None or self._captured[0] == beats:
+            return
+        if self.timer() - last_beat - self.interval < self.threshold:
+            return
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is not None:
+            stack = ''.join(traceback.format_stack(frame))
+            self._captured = (beats, stack)
+
+    def beat(self):
+        """
+        Record a beat of the watched thread, and report the stall it ends,
+        if any. The first beat only starts the measurements.
+        """
+        now = self.timer()
+        if self._last_beat is None:
+            self._last_beat = now
+            self._last_gc = self.gc_times.total
+            return
+        lag = max(now - self._last_beat - self.interval, 0.0)
+        captured_beat, stack = self._captured
+        gc_total = self.gc_times.total
+        gc_time = None
+        if gc_total is not None:
+            gc_time = gc_total - self._last_gc
+            self._last_gc = gc_total
+        self._last_beat = now
+        self.total_lag += lag
+        if lag > self.max_lag:
+            self.max_lag = lag
+        if captured_beat != self.beats:
+            stack = None
+        self.beats += 1
+        if lag >= self.threshold:
+            self.stalls += 1
+            self.on_stall(Stall(lag, stack, gc_time))
+
+    def snapshot(self):
+        """
+        Return a dict of the beats, stalls and lags, and garbage collection
+        times where they are known, in milliseconds.
+        """
+        gc_total = self.gc_times.total
+        return {
+            'beats': self.beats,
+            'stalls': self.stalls,
+            'total_lag_ms': self.total_lag * 1000,
+            'max_lag_ms': self.max_lag * 1000,
+            'gc_ms': gc_total * 1000 if gc_total is not None else None,
+            'gc_collections': (
+                self.gc_times.collections if gc_total is not None else None),
+        }